@@ -0,0 +1,122 @@
+import numpy as np
+from db.database import DatabaseEngine, _FETCH_BATCH_SIZE
+from db.utils import VectorFormat
+from .synthetic import encode_vectors_binary, encode_vectors_json
+
+class InMemoryDatabaseEngine(DatabaseEngine):
+    """
+    Stand-in for the I/O surface of DatabaseEngine used by builds and 
+    searches, serving the source table from memory. Vectors are kept encoded as the database 
+    would send them, so that decoding is measured with the real decoders, 
+    and saved data is encoded in the same batches sent to the database.
+    """
+    def __init__(self, ids:np.ndarray, vectors:np.ndarray, vector_format:VectorFormat = VectorFormat.BINARY, fetch_batch_size:int = _FETCH_BATCH_SIZE) -> None:
+        super().__init__()
+        self._source_table_schema = "dbo"
+        self._source_table_name = "benchmark"
+        self._source_id_column_name = "id"
+        self._source_vector_column_name = "vector"
+        self._vector_dimensions = vectors.shape[1]
+        self._source_vector_format = vector_format
+        self._index_id = 1
+        self.initialize_internal_variables()
+
+        encode = encode_vectors_binary if vector_format == VectorFormat.BINARY else encode_vectors_json
+        self._rows = list(zip(ids.tolist(), encode(vectors)))
+        self._fetch_batch_size = fetch_batch_size
+        self.statuses:list = []
+        self.saved:dict = {}
+        self.build_history:list = []
+
+    def initialize(self):
+        pass
+
+    def update_index_metadata(self, status:str):
+        self.statuses.append(status)
+
+    def finalize_index_metadata(self, vectors_count:int, watermark:tuple = (None, None), baseline_distance:float = None, tuning = None, index_type:str = 'ivfflat', pq_subspaces:int = None, scalar_quantizer = None, top_clusters:int = None, size_stats:dict = None, training_count:int = None, model:tuple = None):
+        self.statuses.append("CREATED")
+        if (model != None):
+            self.saved["model"] = model
+        self.saved["size_stats"] = size_stats
+        self.saved["scalar_quantizer"] = scalar_quantizer
+
+    def begin_version(self) -> int:
+        self._version = 1
+        return self._version
+
+    def discard_version(self) -> bool:
+        self._version = None
+        return False
+
+    def save_build_history(self, build_id:str, build_status:str, build_mode:str, phases:list):
+        self.build_history = phases
+
+    def get_source_row_count(self) -> int:
+        return len(self._rows)
+
+    def get_source_watermark(self) -> tuple:
+        return (self._rows[-1][0] if self._rows else 0, bytes(8))
+
+    def get_id_ranges(self, partitions:int) -> list:
+        if (not self._rows):
+            return []
+        min_id, max_id = self._rows[0][0], self._rows[-1][0]
+        width = (max_id - min_id) // partitions + 1
+        counts = np.bincount((np.array([r[0] for r in self._rows]) - min_id) // width, minlength=partitions)
+        return [(min_id + p * width, min_id + (p + 1) * width - 1, int(c)) for p, c in enumerate(counts) if c > 0]
+
+    def _fetch_batches(self, query:str, *params):
+        # Sampling queries read the first rows, so that runs are repeatable
+        rows = self._rows
+        if ("top (?)" in query):
+            rows = rows[:params[0]]
+        elif ("between ? and ?" in query):
+            rows = [r for r in rows if params[0] <= r[0] <= params[1]]
+        for s in range(0, len(rows), self._fetch_batch_size):
+            yield rows[s:s + self._fetch_batch_size]
+
+    def save_clusters_centroids(self, centroids, workers:int = 1, parents:np.ndarray = None):
+        batches = self._get_centroids_batches(centroids, parents)
+        self.saved["centroids"] = centroids
+        self.saved["centroids_bytes"] = sum(len(b[0]) for b in batches)
+
+    def save_top_clusters_centroids(self, top_centroids:np.ndarray = None, first_cluster_ids:np.ndarray = None, last_cluster_ids:np.ndarray = None):
+        self.saved["top_centroids"] = top_centroids
+
+    def save_clusters_items(self, ids, labels, workers:int = 1, codes:np.ndarray = None, sq_vectors:np.ndarray = None):
+        batches = self._get_items_batches(ids, labels, self._get_items_columns(codes, sq_vectors))
+        self.saved["items"] = (ids, labels)
+        self.saved["codes"] = codes
+        self.saved["sq_vectors"] = sq_vectors
+        self.saved["items_bytes"] = sum(len(p) for b in batches for p in b if isinstance(p, bytes))
+
+    def load_model(self):
+        return self.saved.get("model")
+
+    def save_pq_codebooks(self, codebooks:np.ndarray):
+        self.saved["pq_codebooks"] = codebooks
+
+    def create_pq_similarity_function(self, subspaces:int, top_clusters:int = None):
+        pass
+
+    def create_similarity_function(self, top_clusters:int = None):
+        pass
+
+    def load_clusters_centroids(self) -> np.ndarray:
+        return np.array(self.saved["centroids"], dtype=np.float32)
+
+    def load_clusters_items(self, with_vectors:bool = True, quantized:bool = False):
+        ids, labels = self.saved["items"]
+        if (quantized):
+            return np.asarray(labels, dtype=np.int32), np.asarray(ids, dtype=np.int32), self.saved["sq_vectors"]
+        vectors = None
+        if (with_vectors):
+            positions = {id: p for p, id in enumerate(r[0] for r in self._rows)}
+            _, vectors, _ = self._decode_rows([self._rows[positions[int(id)]] for id in ids])
+        return np.asarray(labels, dtype=np.int32), np.asarray(ids, dtype=np.int32), vectors
+
+    def load_vectors_by_ids(self, ids:list):
+        wanted = set(int(id) for id in ids)
+        batch_ids, vectors, _ = self._decode_rows([r for r in self._rows if r[0] in wanted])
+        return batch_ids, vectors
@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import datetime
+import subprocess
+import numpy as np
+import sklearn
+from db.kmeans import KMeansIndex
+from db.database import _FETCH_BATCH_SIZE
+from db.utils import BuildOptions, BuildMode, ClusteringMetric, VectorFormat, decode_vectors_binary, decode_vectors_json
+from .synthetic import generate_clustered_vectors
+from .engine import InMemoryDatabaseEngine
+
+_logger = logging.getLogger("uvicorn")
+
+# Build phases making up each benchmarked stage
+_STAGES = {
+    "load": ["LOADING_DATA", "SAMPLING_DATA"],
+    "cluster": ["SEEDING_CLUSTERS", "KMEANS_CLUSTERING", "CLUSTERING_CENTROIDS"],
+    "assign": ["ASSIGNING_CLUSTERS"],
+    "encode": ["TRAINING_PQ", "ENCODING_PQ", "QUANTIZING_VECTORS"],
+    "save": ["SAVING_CENTROIDS", "SAVING_CENTROIDS_ELEMENTS"]
+}
+
+def _get_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(__file__)).stdout.strip() or None
+    except OSError:
+        return None
+
+def _stage(name:str, elapsed:float, rows:int, bytes_count:int = None) -> dict:
+    return {
+        "stage": name,
+        "elapsed_seconds": elapsed,
+        "rows": rows,
+        "rows_per_second": rows / elapsed if elapsed > 0 else None,
+        "bytes": bytes_count,
+        "mb_per_second": bytes_count / 1024 / 1024 / elapsed if bytes_count != None and elapsed > 0 else None
+    }
+
+def benchmark_decode(engine:InMemoryDatabaseEngine) -> dict:
+    """
+    Time decoding of all the rows of the table, without anything else.
+    """
+    decode = decode_vectors_binary if engine._source_vector_format == VectorFormat.BINARY else decode_vectors_json
+    dimensions = engine._vector_dimensions
+    rows = engine._rows
+    out = np.empty((_FETCH_BATCH_SIZE, dimensions), dtype=np.float32)
+    start = time.perf_counter()
+    for s in range(0, len(rows), _FETCH_BATCH_SIZE):
+        values = [r[1] for r in rows[s:s + _FETCH_BATCH_SIZE]]
+        decode(values, dimensions, out[:len(values)])
+    elapsed = time.perf_counter() - start
+    return _stage("decode", elapsed, len(rows), sum(len(r[1]) for r in rows))
+
+def benchmark_build(engine:InMemoryDatabaseEngine, options:BuildOptions) -> tuple:
+    """
+    Run a whole build against the in-memory table and return the build
+    phases, as recorded by the index, and the stages made from them.
+    """
+    index = KMeansIndex._create(options.index_type)
+    index._db = engine
+    index._options = options
+    index.id = engine._index_id
+    index.build()
+
+    phases = index.get_metrics()
+    stages = []
+    for name, phase_names in _STAGES.items():
+        selected = [p for p in phases if p["phase"] in phase_names]
+        if (not selected):
+            continue
+        bytes_count = sum(p["bytes_fetched"] for p in selected) if name == "load" else None
+        if (name == "save"):
+            bytes_count = engine.saved["centroids_bytes"] + engine.saved["items_bytes"]
+        stages.append(_stage(name, sum(p["elapsed_seconds"] for p in selected), max(p["rows"] or 0 for p in selected), bytes_count))
+    return phases, stages
+
+def run(args) -> dict:
+    _logger.info(f"Generating {args.rows} vectors with {args.dimensions} dimensions...")
+    start = time.perf_counter()
+    ids, vectors, _ = generate_clustered_vectors(args.rows, args.dimensions, args.clusters, args.spread, args.seed)
+    engine = InMemoryDatabaseEngine(ids, vectors, VectorFormat(args.format))
+    del vectors
+    _logger.info(f"Generated in {time.perf_counter() - start:.3f} sec.")
+
+    options = BuildOptions()
+    options.mode = BuildMode(args.mode)
+    options.clustering_metric = ClusteringMetric(args.clustering_metric)
+    options.assign_workers = args.assign_workers
+    options.save_workers = args.save_workers
+    options.load_partitions = args.load_partitions
+    options.train_sample_size = args.train_sample_size
+    options.warm_start = args.warm_start
+
+    runs = []
+    for r in range(args.repeat):
+        _logger.info(f"Run {r + 1} of {args.repeat}...")
+        decode = benchmark_decode(engine)
+        phases, stages = benchmark_build(engine, options)
+        runs.append({"stages": [decode] + stages, "phases": phases})
+
+    return create_report(args, runs)
+
+def create_report(args, runs:list) -> dict:
+    return {
+        "created_on": datetime.datetime.now().isoformat(),
+        "revision": _get_revision(),
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "sklearn": sklearn.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count()
+        },
+        "parameters": vars(args),
+        "runs": runs
+    }
+
+def write_report(report:dict, output:str = None):
+    j = json.dumps(report, indent=2, default=str)
+    if (output != None):
+        with open(output, "w") as f:
+            f.write(j)
+    else:
+        print(j)
+
+def main(argv:list = None):
+    parser = argparse.ArgumentParser(description="Benchmark index builds on synthetic data, without a database.")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of vectors to generate.")
+    parser.add_argument("--dimensions", type=int, default=1536, help="Dimensions of the vectors.")
+    parser.add_argument("--clusters", type=int, default=100, help="Number of centers the vectors are generated around.")
+    parser.add_argument("--spread", type=float, default=0.5, help="Distance of the vectors from their center.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--format", choices=[f.value for f in VectorFormat], default=VectorFormat.BINARY.value, help="Format the vectors are read in.")
+    parser.add_argument("--mode", choices=[m.value for m in BuildMode], default=BuildMode.FULL.value, help="Build mode.")
+    parser.add_argument("--clustering-metric", choices=[m.value for m in ClusteringMetric], default=ClusteringMetric.EUCLIDEAN.value, help="Metric used to train clusters.")
+    parser.add_argument("--assign-workers", type=int, default=None)
+    parser.add_argument("--save-workers", type=int, default=4)
+    parser.add_argument("--train-sample-size", type=int, default=None, help="Rows used to train centroids in sampled mode.")
+    parser.add_argument("--warm-start", action="store_true", help="Start each run after the first from the model saved by the previous one.")
+    parser.add_argument("--load-partitions", type=int, default=BuildOptions.load_partitions, help="Number of id ranges loaded in parallel.")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times the benchmark is run.")
+    parser.add_argument("--output", default=None, help="File to write the JSON report to. Default is standard output.")
+    parser.add_argument("--verbose", action="store_true", help="Log build progress.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr)
+    report = run(args)
+    for r, result in enumerate(report["runs"]):
+        for stage in result["stages"]:
+            print(f"Run {r + 1}, {stage['stage']}: {stage['elapsed_seconds']:.3f} sec, {int(stage['rows_per_second'] or 0)} rows/s", file=sys.stderr)
+
+    write_report(report, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import sys
+import time
+import logging
+import argparse
+import numpy as np
+from db.search import IvfSearchIndex
+from db.utils import BuildOptions
+from .synthetic import generate_clustered_vectors
+from .engine import InMemoryDatabaseEngine
+from .run import benchmark_build, create_report, write_report
+
+_logger = logging.getLogger("uvicorn")
+
+def _timed(name:str, search, queries_count:int) -> tuple:
+    start = time.perf_counter()
+    results = search()
+    elapsed = time.perf_counter() - start
+    return results, {
+        "method": name,
+        "elapsed_seconds": elapsed,
+        "queries_per_second": queries_count / elapsed if elapsed > 0 else None
+    }
+
+def _recall(results:list, truth:np.ndarray) -> float:
+    found = [len(np.intersect1d(ids, t)) / len(t) for (ids, _), t in zip(results, truth)]
+    return float(np.mean(found))
+
+def run(args) -> dict:
+    _logger.info(f"Generating {args.rows} vectors with {args.dimensions} dimensions...")
+    ids, vectors, _ = generate_clustered_vectors(args.rows, args.dimensions, args.clusters, args.spread, args.seed)
+    # Queries are generated around the same centers as the data, but are not part of it
+    _, queries, _ = generate_clustered_vectors(args.queries, args.dimensions, args.clusters, args.spread, args.seed + 1)
+    engine = InMemoryDatabaseEngine(ids, vectors)
+
+    _logger.info("Building index...")
+    options = BuildOptions()
+    options.scalar_quantization = args.scalar_quantization
+    benchmark_build(engine, options)
+    index = IvfSearchIndex.from_db(engine, True, None, quantizer=engine.saved["scalar_quantizer"])
+
+    _logger.info("Computing exact results...")
+    truth = ids[np.argsort(-(queries @ vectors.T), axis=1)[:, :args.k]]
+    del vectors
+
+    runs = []
+    for r in range(args.repeat):
+        _logger.info(f"Run {r + 1} of {args.repeat}...")
+        single, single_stats = _timed("single", lambda: [index.search(q, args.k, args.probes)[0] for q in queries], len(queries))
+        batch, batch_stats = _timed("batch", lambda: index.search(queries, args.k, args.probes), len(queries))
+        same = np.mean([np.array_equal(s[0], b[0]) for s, b in zip(single, batch)])
+        runs.append({
+            "searches": [single_stats, batch_stats],
+            "speedup": single_stats["elapsed_seconds"] / batch_stats["elapsed_seconds"],
+            "same_results": float(same),
+            "recall": _recall(batch, truth),
+            "memory_bytes": index.get_memory_usage()
+        })
+
+    return create_report(args, runs)
+
+def main(argv:list = None):
+    parser = argparse.ArgumentParser(description="Benchmark batched search against one search per query, without a database.")
+    parser.add_argument("--rows", type=int, default=100000, help="Number of vectors to generate.")
+    parser.add_argument("--dimensions", type=int, default=1536, help="Dimensions of the vectors.")
+    parser.add_argument("--clusters", type=int, default=100, help="Number of centers the vectors are generated around.")
+    parser.add_argument("--spread", type=float, default=0.5, help="Distance of the vectors from their center.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--queries", type=int, default=500, help="Number of queries in the batch.")
+    parser.add_argument("--k", type=int, default=10, help="Number of results for each query.")
+    parser.add_argument("--probes", type=int, default=8, help="Number of clusters to search in.")
+    parser.add_argument("--scalar-quantization", choices=["int8", "float16"], default=None, help="Keep quantized vectors in memory, re-ranking candidates by exact distance.")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of times the benchmark is run.")
+    parser.add_argument("--output", default=None, help="File to write the JSON report to. Default is standard output.")
+    parser.add_argument("--verbose", action="store_true", help="Log progress.")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stderr)
+    report = run(args)
+    for r, result in enumerate(report["runs"]):
+        for search in result["searches"]:
+            print(f"Run {r + 1}, {search['method']}: {search['elapsed_seconds']:.3f} sec, {int(search['queries_per_second'] or 0)} queries/s", file=sys.stderr)
+        print(f"Run {r + 1}, speedup: {result['speedup']:.1f}x, recall@{args.k}: {result['recall']:.3f}, memory: {int(result['memory_bytes'] / 1024 / 1024)} MB", file=sys.stderr)
+
+    write_report(report, args.output)
+
+if __name__ == "__main__":
+    main()
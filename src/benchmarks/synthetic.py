@@ -0,0 +1,42 @@
+import struct
+import numpy as np
+from db.utils import VECTOR_BINARY_MAGIC, VECTOR_BINARY_HEADER_SIZE
+
+def generate_clustered_vectors(count:int, dimensions:int, clusters:int = 100, spread:float = 0.1, seed:int = 0, chunk_size:int = 100000):
+    """
+    Generate count unit-length vectors scattered around clusters random 
+    centers, like embeddings of documents about a limited set of topics.
+    Return ids, vectors and the center each vector has been generated from.
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dimensions), dtype=np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    # Cluster sizes are skewed, as they usually are with real data
+    weights = rng.pareto(2.0, clusters) + 1
+    labels = rng.choice(clusters, count, p=weights / weights.sum()).astype(np.int32)
+
+    vectors = np.empty((count, dimensions), dtype=np.float32)
+    for s in range(0, count, chunk_size):
+        e = min(s + chunk_size, count)
+        chunk = rng.standard_normal((e - s, dimensions), dtype=np.float32)
+        chunk *= spread / np.sqrt(dimensions)
+        chunk += centers[labels[s:e]]
+        chunk /= np.linalg.norm(chunk, axis=1, keepdims=True)
+        vectors[s:e] = chunk
+
+    ids = np.arange(1, count + 1, dtype=np.int32)
+    return ids, vectors, labels
+
+def encode_vectors_binary(vectors:np.ndarray) -> list:
+    """
+    Encode vectors as the native vector type is sent by the database.
+    """
+    header = struct.pack("<BBH", VECTOR_BINARY_MAGIC, 1, vectors.shape[1]).ljust(VECTOR_BINARY_HEADER_SIZE, b"\0")
+    data = np.asarray(vectors, dtype='<f4')
+    return [header + row.tobytes() for row in data]
+
+def encode_vectors_json(vectors:np.ndarray) -> list:
+    """
+    Encode vectors as JSON arrays, as stored by classic vector columns.
+    """
+    return ["[" + ",".join(map(repr, row)) + "]" for row in np.asarray(vectors).tolist()]
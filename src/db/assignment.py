@@ -0,0 +1,106 @@
+import os
+import time
+import logging
+import numpy as np
+from enum import StrEnum
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from threadpoolctl import threadpool_limits
+
+_logger = logging.getLogger("uvicorn")
+
+# Upper bound for the size of the chunk x centroids distance matrix, in elements
+_MAX_DISTANCE_BLOCK = 16 * 1024 * 1024
+
+class AssignmentExecutor(StrEnum):
+    THREAD = 'thread'
+    PROCESS = 'process'
+
+def _limit_blas_threads():
+    threadpool_limits(limits=1, user_api="blas")
+
+def _get_distances(vectors:np.ndarray, centroids:np.ndarray, centroids_squared_norms:np.ndarray) -> np.ndarray:
+    """
+    Return ||c||^2 - 2 x.c for each vector and centroid. As ||x||^2 is the 
+    same for all centroids, argmin ||x - c||^2 = argmin (||c||^2 - 2 x.c)
+    """
+    distances = vectors @ centroids.T
+    distances *= -2
+    distances += centroids_squared_norms
+    return distances
+
+def get_nearest_centroids(vectors:np.ndarray, centroids:np.ndarray) -> np.ndarray:
+    """
+    Return the index of the nearest centroid for each vector, in a single 
+    matrix product, for blocks small enough not to need chunking.
+    """
+    return np.argmin(_get_distances(vectors, centroids, np.einsum("ij,ij->i", centroids, centroids)), axis=1).astype(np.int32)
+
+def _assign_chunk(vectors:np.ndarray, centroids:np.ndarray, centroids_squared_norms:np.ndarray):
+    """
+    Return the index of the nearest centroid for each vector, and the sum of
+    the squared distances to it.
+    """
+    start = time.perf_counter()
+    distances = _get_distances(vectors, centroids, centroids_squared_norms)
+    labels = np.argmin(distances, axis=1).astype(np.int32)
+    inertia = float(np.sum(np.take_along_axis(distances, labels[:, None], axis=1)) + np.einsum("ij,ij->", vectors, vectors))
+    return labels, inertia, time.perf_counter() - start
+
+def assign_clusters(vectors:np.ndarray, centroids:np.ndarray, workers:int = None, executor:AssignmentExecutor = AssignmentExecutor.THREAD, chunk_size:int = None, return_inertia:bool = False):
+    """
+    Assign each vector to its nearest centroid. Vectors are split in chunks
+    and each chunk is assigned with a single matrix product, running chunks
+    in parallel on a pool of threads or processes. If return_inertia is set, 
+    the sum of the squared distances of vectors to their centroid is returned
+    together with the labels.
+    """
+    vector_count = len(vectors)
+    workers = workers or os.cpu_count() or 1
+    if (chunk_size == None):
+        chunk_size = max(1, min(50000, _MAX_DISTANCE_BLOCK // max(len(centroids), 1)))
+
+    centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+    centroids_squared_norms = np.einsum("ij,ij->i", centroids, centroids)
+    labels = np.empty((vector_count), dtype=np.int32)
+    inertia = 0.0
+    chunks = [(s, min(s + chunk_size, vector_count)) for s in range(0, vector_count, chunk_size)]
+
+    _logger.info(f"Assigning {vector_count} vectors to {len(centroids)} clusters using {len(chunks)} chunks and {workers} {executor} workers...")
+    start = time.perf_counter()
+    if (workers == 1 or len(chunks) <= 1):
+        for s, e in chunks:
+            labels[s:e], chunk_inertia, elapsed = _assign_chunk(np.asarray(vectors[s:e], dtype=np.float32), centroids, centroids_squared_norms)
+            inertia += chunk_inertia
+            _logger.info(f"Assigned chunk [{s}:{e}] in {elapsed:.3f} sec ({int((e - s) / max(elapsed, 1e-9))} rows/s)")
+    else:
+        if (executor == AssignmentExecutor.PROCESS):
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=_limit_blas_threads)
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers)
+        # Each worker runs its own matrix product, so BLAS must not spawn threads too
+        with threadpool_limits(limits=1, user_api="blas"), pool:
+            futures = [(s, e, pool.submit(_assign_chunk, np.asarray(vectors[s:e], dtype=np.float32), centroids, centroids_squared_norms)) for s, e in chunks]
+            for s, e, f in futures:
+                labels[s:e], chunk_inertia, elapsed = f.result()
+                inertia += chunk_inertia
+                _logger.info(f"Assigned chunk [{s}:{e}] in {elapsed:.3f} sec ({int((e - s) / max(elapsed, 1e-9))} rows/s)")
+    elapsed = time.perf_counter() - start
+
+    _logger.info(f"Assigned {vector_count} vectors in {elapsed:.3f} sec ({int(vector_count / max(elapsed, 1e-9))} rows/s).")
+    if (return_inertia):
+        return labels, inertia
+    return labels
+
+def sum_cosine_distance(vectors:np.ndarray, normalized_centroids:np.ndarray, labels:np.ndarray, chunk_size:int = 50000) -> float:
+    """
+    Return the sum of the cosine distances between each vector and the 
+    centroid of the cluster it has been assigned to.
+    """
+    total = 0.0
+    for s in range(0, len(vectors), chunk_size):
+        chunk = np.asarray(vectors[s:s + chunk_size], dtype=np.float32)
+        norms = np.linalg.norm(chunk, axis=1)
+        norms[norms == 0] = 1
+        similarities = np.einsum("ij,ij->i", chunk, normalized_centroids[labels[s:s + chunk_size]]) / norms
+        total += float(np.sum(1 - similarities))
+    return total
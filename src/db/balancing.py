@@ -0,0 +1,54 @@
+import math
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import normalize
+
+def get_cluster_size_stats(labels:np.ndarray, clusters:int) -> dict:
+    sizes = np.bincount(labels, minlength=clusters)
+    return {
+        "max_size": int(sizes.max()) if len(sizes) else 0,
+        "mean_size": float(sizes.mean()) if len(sizes) else 0.0,
+        "p99_size": int(np.percentile(sizes, 99, method="inverted_cdf")) if len(sizes) else 0
+    }
+
+def assign_with_capacity(similarities:np.ndarray, capacity:int) -> np.ndarray:
+    """
+    Assign each row to its most similar column, with no more than capacity
+    rows per column. When a column is over capacity, it keeps its most
+    similar rows and is closed, and the others move to their next choice.
+    """
+    similarities = similarities.copy()
+    labels = np.full(len(similarities), -1, dtype=np.int32)
+    pending = np.arange(len(similarities))
+    available = np.full(similarities.shape[1], capacity, dtype=np.int64)
+    while (len(pending) > 0):
+        choices = np.argmax(similarities[pending], axis=1)
+        for column in np.unique(choices):
+            candidates = pending[choices == column]
+            if (len(candidates) > available[column]):
+                best = np.argsort(-similarities[candidates, column], kind="stable")[:available[column]]
+                candidates = candidates[best]
+            labels[candidates] = column
+            available[column] -= len(candidates)
+            if (available[column] == 0):
+                similarities[:, column] = -np.inf
+        pending = pending[labels[pending] == -1]
+    return labels
+
+def split_cluster(vectors:np.ndarray, mean_size:float, max_size:int, random_state:int = 0):
+    """
+    Split the vectors of an oversized cluster in clusters of about mean_size
+    vectors and no more than max_size, returning the label of each vector
+    in the new clusters and their normalized centroids.
+    """
+    parts = max(2, math.ceil(len(vectors) / mean_size))
+    vectors = normalize(np.asarray(vectors, dtype=np.float32))
+    kmeans = MiniBatchKMeans(init="k-means++", n_clusters=parts, n_init=1, random_state=random_state, compute_labels=False)
+    kmeans.fit(vectors)
+    centroids = normalize(kmeans.cluster_centers_).astype(np.float32)
+    labels = assign_with_capacity(vectors @ centroids.T, max(max_size, math.ceil(len(vectors) / parts)))
+    # Centroids are moved to the mean of the vectors they have been assigned
+    for p in range(parts):
+        if (np.any(labels == p)):
+            centroids[p] = normalize(vectors[labels == p].sum(axis=0, keepdims=True))[0]
+    return labels, centroids
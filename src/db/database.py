@@ -1,52 +1,61 @@
-import datetime
-import os
-import pyodbc
+import time
+import numpy as np
 import logging
 import json
-from .utils import Buffer, VectorSet, NpEncoder, DataSourceConfig
-import struct
-import logging
-from azure import identity
-from azure.core import credentials
+import threading
+from .utils import VectorSet, MemoryMappedVectorSet, DataSourceConfig, VectorFormat, decode_vectors_binary, decode_vectors_json, normalize_rows
+from concurrent.futures import ThreadPoolExecutor
+from .pool import get_connection_pool
+from .hierarchy import TOP_PROBES_EXPANSION, TOP_PROBES_MIN
 
 _logger = logging.getLogger("uvicorn")
 
+_FETCH_BATCH_SIZE = 50000
+_SAVE_ITEMS_BATCH_SIZE = 100000
+_SAVE_CENTROIDS_BATCH_SIZE = 1000
+
+# Columns of [$vector].[kmeans] describing the published version of an index,
+# saved with each version so that they can be restored when switching to it
+_VERSIONED_COLUMNS = {
+    "item_count": "int",
+    "watermark_id": "bigint",
+    "watermark_version": "binary(8)",
+    "changed_item_count": "int",
+    "baseline_distance": "float",
+    "recent_distance": "float",
+    "recent_item_count": "int",
+    "recommended_probes": "int",
+    "tuning_recall": "float",
+    "tuning_report": "nvarchar(max)",
+    "index_type": "varchar(50)",
+    "pq_subspaces": "int",
+    "top_clusters": "int",
+    "max_cluster_size": "int",
+    "mean_cluster_size": "float",
+    "p99_cluster_size": "int",
+    "training_item_count": "int",
+    "scalar_quantization": "varchar(50)",
+    "scalar_quantization_params": "nvarchar(max)"
+}
+
 class DatabaseEngineException(Exception):
     pass
 
 class DatabaseEngine:
     def __init__(self) -> None:        
         self._index_id = None
-        self._token:credentials.AccessToken = None
+        self._source_vector_format = VectorFormat.JSON
+        self._source_version_column_name = None
+        self.bytes_fetched = 0
+        # Set to scale vectors to unit length as soon as they are decoded
+        self.normalize_vectors = False
+        self._bytes_fetched_lock = threading.Lock()
+        # Version whose tables and function are being built
+        self._version:int = None
 
     def __get_mssql_connection(self):
-        _logger.debug('Connecting to MSSQL...')
-        
-        mssql_connection_string = os.environ["MSSQL"]    
-
-        if any(s in mssql_connection_string.lower() for s in ["uid"]):
-            _logger.debug('Using SQL Server authentication')
-            attrs_before = None
-        else:            
-            if (self._token != None and self._token.expires_on < datetime.datetime.now().timestamp()):
-                _logger.info('Token expired. Refresh is needed.')    
-                self._token = None
-
-            if (self._token == None):
-                _logger.info('Getting EntraID credentials...')    
-                mssql_connection_string = os.environ["MSSQL"]    
-                credential = identity.DefaultAzureCredential(exclude_interactive_browser_credential=False)   
-                self._token = credential.get_token("https://database.windows.net/.default")
-
-            token_bytes = self._token.token.encode("UTF-16-LE")    
-            token_struct = struct.pack(f'<I{len(token_bytes)}s', len(token_bytes), token_bytes)
-            SQL_COPT_SS_ACCESS_TOKEN = 1256  # This connection option is defined by microsoft in msodbcsql.h        
-            attrs_before = {SQL_COPT_SS_ACCESS_TOKEN: token_struct}
-
-        _logger.debug('Connecting...')    
-        conn = pyodbc.connect(mssql_connection_string, attrs_before=attrs_before)
-
-        return conn
+        # Connections are borrowed from the shared pool: closing them returns them to the pool
+        return get_connection_pool().acquire()
        
     def from_config(config:DataSourceConfig):
         db = DatabaseEngine()
@@ -59,42 +68,64 @@ class DatabaseEngine:
         db.validate_database_objects()
         return db
 
-    def from_id(id:int):
+    def from_id(id:int, created_only:bool = True):
         db = DatabaseEngine()
         conn = db.__get_mssql_connection()
 
-        cursor = conn.cursor()  
-        cursor.execute("""
-            select 
-                parsename(source_table_name, 2) as source_schema_name,
-                parsename(source_table_name, 1) as source_table_name,
-                id_column_name,
-                vector_column_name,
-                dimensions_count as vector_dimensions
-            from 
-                [$vector].[kmeans] 
-            where 
-                id = ?
-            and
-                status = 'CREATED';""", id)
-        row = cursor.fetchone()
+        try:
+            cursor = conn.cursor()  
+            cursor.execute("""
+                select 
+                    parsename(source_table_name, 2) as source_schema_name,
+                    parsename(source_table_name, 1) as source_table_name,
+                    id_column_name,
+                    vector_column_name,
+                    dimensions_count as vector_dimensions
+                from 
+                    [$vector].[kmeans] 
+                where 
+                    id = ?
+                and
+                    (status = 'CREATED' or ? = 0);""", id, created_only)
+            row = cursor.fetchone()
 
-        if (row == None):
-            raise DatabaseEngineException(f"Index #{id} not found.")
-
-        db._source_table_schema = str(row.source_schema_name)
-        db._source_table_name = str(row.source_table_name)
-        db._source_id_column_name = str(row.id_column_name)
-        db._source_vector_column_name = str(row.vector_column_name)
-        db._vector_dimensions = int(row.vector_dimensions)
-        cursor.close()
-        conn.close()
+            if (row == None):
+                raise DatabaseEngineException(f"Index #{id} not found.")
+
+            db._source_table_schema = str(row.source_schema_name)
+            db._source_table_name = str(row.source_table_name)
+            db._source_id_column_name = str(row.id_column_name)
+            db._source_vector_column_name = str(row.vector_column_name)
+            db._vector_dimensions = int(row.vector_dimensions)
+            cursor.close()
+        finally:
+            conn.close()
         
         db.initialize_internal_variables()
         db.validate_database_objects()
 
         return db
 
+    def get_config(self) -> DataSourceConfig:
+        config = DataSourceConfig()
+        config.source_table_schema = self._source_table_schema
+        config.source_table_name = self._source_table_name
+        config.source_id_column_name = self._source_id_column_name
+        config.source_vector_column_name = self._source_vector_column_name
+        config.vector_dimensions = self._vector_dimensions
+        return config
+
+    def list_index_ids(status:str = 'CREATED') -> list:
+        db = DatabaseEngine()
+        conn = db.__get_mssql_connection()
+        try:
+            if (conn.execute("select object_id('[$vector].[kmeans]')").fetchval() == None):
+                return []
+            rows = conn.execute("select id from [$vector].[kmeans] where status = ? order by id", status).fetchall()
+        finally:
+            conn.close()
+        return [int(row.id) for row in rows]
+
     def validate_config(self):
         c = {
             "table_schema": self._source_table_schema,
@@ -127,26 +158,39 @@ class DatabaseEngine:
         self._target_table_name = f'{self._source_table_name}${self._source_vector_column_name}'
         self._function_fqname=f'[$vector].[find_similar${self._target_table_name}]'
         self._clusters_centroids_table_fqname = f'[$vector].[{self._target_table_name}$clusters_centroids]'
-        self._clusters_centroids_tmp_table_fqname = f'[$tmp].[{self._target_table_name}$clusters_centroids]'
         self._clusters_table_fqname = f'[$vector].[{self._target_table_name}$clusters]'  
-        self._clusters_tmp_table_fqname = f'[$tmp].[{self._target_table_name}$clusters]'  
+        self._pq_codebooks_table_fqname = f'[$vector].[{self._target_table_name}$pq_codebooks]'
+        self._top_centroids_table_fqname = f'[$vector].[{self._target_table_name}$top_centroids]'
 
     def validate_database_objects(self):
         conn = self.__get_mssql_connection()
+
+        try:        
+            table_id = conn.execute("select object_id(?)", self._source_table_fqname).fetchval()
+            if (table_id == None):
+                raise DatabaseEngineException(f"Source table {self._source_table_fqname} not found.")
         
-        table_id = conn.execute("select object_id(?)", self._source_table_fqname).fetchval()
-        if (table_id == None):
-            raise DatabaseEngineException(f"Source table {self._source_table_fqname} not found.")
-        
-        column_id_id = conn.execute("select [column_id] from sys.columns where [object_id] = ? and [name] = ?", table_id, self._source_id_column_name).fetchval()
-        if (column_id_id == None):
-            raise DatabaseEngineException(f"Source table column {self._source_id_column_name} not found.")
+            column_id_id = conn.execute("select [column_id] from sys.columns where [object_id] = ? and [name] = ?", table_id, self._source_id_column_name).fetchval()
+            if (column_id_id == None):
+                raise DatabaseEngineException(f"Source table column {self._source_id_column_name} not found.")
 
-        column_vector_id = conn.execute("select [column_id] from sys.columns where [object_id] = ? and [name] = ?", table_id, self._source_vector_column_name).fetchval()
-        if (column_vector_id == None):
-            raise DatabaseEngineException(f"Source table column {self._source_vector_column_name} not found.")
+            column_vector = conn.execute("select [column_id], type_name([system_type_id]) as [type_name] from sys.columns where [object_id] = ? and [name] = ?", table_id, self._source_vector_column_name).fetchone()
+            if (column_vector == None):
+                raise DatabaseEngineException(f"Source table column {self._source_vector_column_name} not found.")
         
-        conn.close()
+            # Native vectors are read in their binary format, anything else is expected to be a JSON array
+            if (str(column_vector.type_name).lower() == "vector"):
+                self._source_vector_format = VectorFormat.BINARY
+            else:
+                self._source_vector_format = VectorFormat.JSON
+            _logger.info(f"Source vectors will be read using {self._source_vector_format} format.")
+
+            # If available, a rowversion column allows to detect updated rows too, and not only inserted ones
+            self._source_version_column_name = conn.execute("select [name] from sys.columns where [object_id] = ? and type_name([system_type_id]) = 'timestamp'", table_id).fetchval()
+            if (self._source_version_column_name != None):
+                _logger.info(f"Changes will be tracked using rowversion column {self._source_version_column_name}.")
+        finally:
+            conn.close()
 
     def initialize(self): 
         conn = self.__get_mssql_connection()
@@ -156,9 +200,6 @@ class DatabaseEngine:
                 if schema_id('$vector') is null begin
                     exec('create schema [$vector] authorization dbo')
                 end
-                if schema_id('$tmp') is null begin
-                    exec('create schema [$tmp] authorization dbo')
-                end           
                 if object_id('[$vector].[kmeans]') is null begin
                     create table [$vector].[kmeans]
                     (
@@ -174,12 +215,118 @@ class DatabaseEngine:
                         unique nonclustered ([source_table_name], [vector_column_name])
                     )
                 end             
+                if col_length('[$vector].[kmeans]', 'watermark_id') is null begin
+                    alter table [$vector].[kmeans] add
+                        [watermark_id] bigint null,
+                        [watermark_version] binary(8) null,
+                        [changed_item_count] int null,
+                        [baseline_distance] float null,
+                        [recent_distance] float null,
+                        [recent_item_count] int null
+                end
+                if col_length('[$vector].[kmeans]', 'recommended_probes') is null begin
+                    alter table [$vector].[kmeans] add
+                        [recommended_probes] int null,
+                        [tuning_recall] float null,
+                        [tuning_report] nvarchar(max) null
+                end
+                if col_length('[$vector].[kmeans]', 'index_type') is null begin
+                    alter table [$vector].[kmeans] add
+                        [index_type] varchar(50) null,
+                        [pq_subspaces] int null
+                end
+                if col_length('[$vector].[kmeans]', 'top_clusters') is null begin
+                    alter table [$vector].[kmeans] add
+                        [top_clusters] int null
+                end
+                if col_length('[$vector].[kmeans]', 'max_cluster_size') is null begin
+                    alter table [$vector].[kmeans] add
+                        [max_cluster_size] int null,
+                        [mean_cluster_size] float null,
+                        [p99_cluster_size] int null
+                end
+                if col_length('[$vector].[kmeans]', 'training_item_count') is null begin
+                    alter table [$vector].[kmeans] add
+                        [training_item_count] int null
+                end
+                if col_length('[$vector].[kmeans]', 'version') is null begin
+                    alter table [$vector].[kmeans] add
+                        [version] int null,
+                        [previous_version] int null
+                end
+                if col_length('[$vector].[kmeans]', 'scalar_quantization') is null begin
+                    alter table [$vector].[kmeans] add
+                        [scalar_quantization] varchar(50) null,
+                        [scalar_quantization_params] nvarchar(max) null
+                end
+                if object_id('[$vector].[kmeans_build_history]') is null begin
+                    create table [$vector].[kmeans_build_history]
+                    (
+                        [id] int identity not null,
+                        [build_id] uniqueidentifier not null,
+                        [index_id] int not null,
+                        [build_status] varchar(100) not null,
+                        [build_mode] varchar(100) not null,
+                        [phase] varchar(100) not null,
+                        [started_on] datetime2 not null,
+                        [elapsed_seconds] float not null,
+                        [row_count] bigint null,
+                        [rows_per_second] float null,
+                        [bytes_fetched] bigint null,
+                        [peak_rss_bytes] bigint null,
+                        [iterations] int null,
+                        [inertia] float null,
+                        primary key nonclustered ([id])
+                    )
+                    create clustered index ixc on [$vector].[kmeans_build_history] ([index_id], [started_on])
+                end
+                if object_id('[$vector].[kmeans_versions]') is null begin
+                    create table [$vector].[kmeans_versions]
+                    (
+                        [index_id] int not null,
+                        [version] int not null,
+                        [published_on] datetime2 not null,
+                        {"".join(f"[{name}] {type} null, " for name, type in _VERSIONED_COLUMNS.items())}
+                        primary key clustered ([index_id], [version])
+                    )
+                end
+                -- Models used to be saved one per index: they are only used to warm start builds, so they are dropped rather than migrated
+                if object_id('[$vector].[kmeans_models]') is not null and col_length('[$vector].[kmeans_models]', 'version') is null begin
+                    drop table [$vector].[kmeans_models]
+                end
+                if object_id('[$vector].[kmeans_models]') is null begin
+                    create table [$vector].[kmeans_models]
+                    (
+                        [index_id] int not null,
+                        [version] int not null,
+                        [format] varchar(50) not null,
+                        [model] varbinary(max) not null,
+                        [updated_on] datetime2 not null,
+                        primary key clustered ([index_id], [version])
+                    )
+                end
             """)
             cursor.close()
             conn.commit()
         finally:
             conn.close()
     
+    def get_index_id(self) -> int:
+        """
+        Return the id of the index of the source vector column, or None if
+        it has not been created yet.
+        """
+        conn = self.__get_mssql_connection()
+        try:
+            return conn.execute("""
+                select id from [$vector].[kmeans] where [source_table_name] = ? and [vector_column_name] = ?;
+                """,
+                self._source_table_fqname,
+                self._source_vector_column_name
+            ).fetchval()
+        finally:
+            conn.close()
+
     def create_index_metadata(self, force: bool) -> int:
         id = None
         conn = self.__get_mssql_connection()
@@ -221,8 +368,9 @@ class DatabaseEngine:
                         [$vector].[kmeans] 
                     set
                         [status] = 'INITIALIZING',
-                        [item_count] = null,                            
-                        [updated_on] = sysdatetime()
+                        -- A published version stays in use, and its metadata valid, until the new one replaces it
+                        [item_count] = case when [version] is null then null else [item_count] end,
+                        [updated_on] = case when [version] is null then sysdatetime() else [updated_on] end
                     where 
                         id = ?;
                     """,
@@ -236,199 +384,1216 @@ class DatabaseEngine:
         self._index_id = id
         return id
     
+    def restore_index_metadata(self, status:str, item_count:int):
+        """
+        Put back the status and the number of items the index had before a
+        build that didn't complete.
+        """
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()  
+            cursor.execute("""
+                update [$vector].[kmeans] set [status] = ?, [item_count] = ? where id = ?;""", 
+                status, 
+                item_count,
+                self._index_id
+                )
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
     def update_index_metadata(self, status:str):
         conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()  
+            cursor.execute("""
+                update 
+                    [$vector].[kmeans] 
+                set                
+                    [status] = ?                
+                where 
+                    id = ?;""", 
+                status, 
+                self._index_id, 
+                )
+            conn.commit()
 
-        cursor = conn.cursor()  
-        cursor.execute("""
-            update 
-                [$vector].[kmeans] 
-            set                
-                [status] = ?                
-            where 
-                id = ?;""", 
-            status, 
-            self._index_id, 
-            )
-        conn.commit()
-
-        cursor.close()
-        conn.close()
-
-    def finalize_index_metadata(self, vectors_count:int):
-        conn = self.__get_mssql_connection()
-
-        cursor = conn.cursor()  
-        cursor.execute("""
-            update 
-                [$vector].[kmeans] 
-            set
-                [item_count] = ?,
-                [dimensions_count] = ?,
-                [status] = 'CREATED',                
-                [updated_on] = sysdatetime()
-            where 
-                id = ?;""", 
-            vectors_count, 
-            self._vector_dimensions,
-            self._index_id, 
+            cursor.close()
+        finally:
+            conn.close()
+
+    def finalize_index_metadata(self, vectors_count:int, watermark:tuple = (None, None), baseline_distance:float = None, tuning = None, index_type:str = 'ivfflat', pq_subspaces:int = None, scalar_quantizer = None, top_clusters:int = None, size_stats:dict = None, training_count:int = None, model:tuple = None):
+        """
+        Finalize the metadata of a build and publish the version being built,
+        together with its trained model, given as a (format, content) tuple.
+        """
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()  
+            cursor.execute("""
+                update 
+                    [$vector].[kmeans] 
+                set
+                    [item_count] = ?,
+                    [dimensions_count] = ?,
+                    [status] = 'CREATED',                
+                    [updated_on] = sysdatetime(),
+                    [watermark_id] = ?,
+                    [watermark_version] = ?,
+                    [changed_item_count] = 0,
+                    [baseline_distance] = ?,
+                    [recent_distance] = null,
+                    [recent_item_count] = 0,
+                    [recommended_probes] = ?,
+                    [tuning_recall] = ?,
+                    [tuning_report] = ?,
+                    [index_type] = ?,
+                    [pq_subspaces] = ?,
+                    [scalar_quantization] = ?,
+                    [scalar_quantization_params] = ?,
+                    [top_clusters] = ?,
+                    [max_cluster_size] = ?,
+                    [mean_cluster_size] = ?,
+                    [p99_cluster_size] = ?,
+                    [training_item_count] = ?
+                where 
+                    id = ?;""", 
+                vectors_count, 
+                self._vector_dimensions,
+                watermark[0],
+                watermark[1],
+                baseline_distance,
+                tuning.probes if tuning != None else None,
+                tuning.recall if tuning != None else None,
+                json.dumps(tuning.report) if tuning != None else None,
+                str(index_type),
+                pq_subspaces,
+                str(scalar_quantizer.kind) if scalar_quantizer != None else None,
+                scalar_quantizer.to_json() if scalar_quantizer != None else None,
+                top_clusters,
+                size_stats["max_size"] if size_stats != None else None,
+                size_stats["mean_size"] if size_stats != None else None,
+                size_stats["p99_size"] if size_stats != None else None,
+                training_count,
+                self._index_id, 
+                )
+            if (self._version != None):
+                _logger.info(f"Publishing version {self._version} of index #{self._index_id}...")
+                cursor.execute(f"""
+                    set xact_abort on;
+                    declare @id int = ?, @version int = ?;
+                    declare @previous_version int = (select [version] from [$vector].[kmeans] with (updlock) where id = @id);
+                    {self._get_switch_version_statement(self._version)}
+                    update [$vector].[kmeans] set [version] = @version, [previous_version] = @previous_version where id = @id;
+                    {self._get_save_version_statement()}
+                    """,
+                    self._index_id,
+                    self._version
+                    )
+                if (model != None):
+                    cursor.execute("""
+                        delete from [$vector].[kmeans_models] where [index_id] = ? and [version] = ?;
+                        insert into [$vector].[kmeans_models] ([index_id], [version], [format], [model], [updated_on]) values (?, ?, ?, ?, sysdatetime());
+                        """,
+                        self._index_id, self._version,
+                        self._index_id, self._version, model[0], model[1]
+                        )
+            # Metadata, objects and model of the new version are published in the same transaction
+            conn.commit()
+
+            cursor.close()
+        finally:
+            conn.close()
+
+        if (self._version != None):
+            self._drop_unused_versions()
+            self._version = None
+
+    def _get_versioned_fqname(self, name:str, version:int) -> str:
+        return f'[$vector].[{self._target_table_name}${name}$v{version}]'
+
+    def _get_versioned_function_fqname(self, version:int) -> str:
+        return f'[$vector].[find_similar${self._target_table_name}$v{version}]'
+
+    def _get_versioned_objects(self, version:int) -> list:
+        """
+        Return the name used by searches and updates, the name in the given
+        version and the type of each object of an index.
+        """
+        return [
+            (self._clusters_centroids_table_fqname, self._get_versioned_fqname("clusters_centroids", version), "U"),
+            (self._clusters_table_fqname, self._get_versioned_fqname("clusters", version), "U"),
+            (self._top_centroids_table_fqname, self._get_versioned_fqname("top_centroids", version), "U"),
+            (self._pq_codebooks_table_fqname, self._get_versioned_fqname("pq_codebooks", version), "U"),
+            (self._function_fqname, self._get_versioned_function_fqname(version), "IF")
+        ]
+
+    def _get_switch_version_statement(self, version:int) -> str:
+        """
+        Return the statements that point the synonyms used by searches and
+        updates to the objects of the given version. Tables and function 
+        created before indexes were versioned are dropped.
+        """
+        statements = []
+        for name, versioned_name, type in self._get_versioned_objects(version):
+            statements.append(f"""
+                if object_id('{name}', '{type}') is not null drop {"function" if type == "IF" else "table"} {name};
+                if object_id('{name}', 'SN') is not null drop synonym {name};
+                if object_id('{versioned_name}', '{type}') is not null create synonym {name} for {versioned_name};""")
+        return "".join(statements)
+
+    def _get_save_version_statement(self) -> str:
+        """
+        Return the statements that save the metadata of the published version
+        of the index with id @id, so that they can be restored when switching
+        back to it.
+        """
+        columns = ", ".join(f"[{name}]" for name in _VERSIONED_COLUMNS)
+        return f"""
+                delete v from [$vector].[kmeans_versions] v inner join [$vector].[kmeans] k on v.[index_id] = k.[id] and v.[version] = k.[version] where k.[id] = @id;
+                insert into [$vector].[kmeans_versions] ([index_id], [version], [published_on], {columns})
+                select [id], [version], sysdatetime(), {columns} from [$vector].[kmeans] where [id] = @id and [version] is not null;"""
+
+    def begin_version(self) -> int:
+        """
+        Start building a new version of the index. Its tables and function 
+        are created with a version suffix, while searches keep using the
+        published version, and they are all published at once when metadata
+        are finalized.
+        """
+        conn = self.__get_mssql_connection()
+        try:
+            version = conn.execute("""
+                select isnull(max([version]), 0) + 1 from (
+                    select [version] from [$vector].[kmeans] where [id] = ?
+                    union all
+                    select [version] from [$vector].[kmeans_versions] where [index_id] = ?
+                ) v""", 
+                self._index_id, 
+                self._index_id
+                ).fetchval()
+        finally:
+            conn.close()
+
+        _logger.info(f"Building version {version} of index #{self._index_id}...")
+        self._version = int(version)
+        return self._version
+
+    def rollback_version(self) -> int:
+        """
+        Switch back to the previous version of the index, restoring its 
+        metadata. The current version becomes the previous one, so that it
+        can be switched back to as well.
+        """
+        metadata = self.get_index_metadata()
+        if (metadata.previous_version == None):
+            raise DatabaseEngineException(f"Index #{self._index_id} has no previous version.")
+
+        columns = ", ".join(f"[{name}] = v.[{name}]" for name in _VERSIONED_COLUMNS)
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                set xact_abort on;
+                declare @id int = ?, @version int = ?, @previous_version int = ?;
+                if not exists (select * from [$vector].[kmeans_versions] where [index_id] = @id and [version] = @previous_version) begin
+                    throw 50000, 'Previous version metadata not found.', 1;
+                end
+                {self._get_save_version_statement()}
+                {self._get_switch_version_statement(metadata.previous_version)}
+                update k set
+                    {columns},
+                    [version] = @previous_version,
+                    [previous_version] = @version,
+                    [status] = 'CREATED',
+                    [updated_on] = sysdatetime()
+                from
+                    [$vector].[kmeans] k
+                inner join
+                    [$vector].[kmeans_versions] v on v.[index_id] = k.[id] and v.[version] = @previous_version
+                where
+                    k.[id] = @id;
+                """,
+                self._index_id,
+                metadata.version,
+                metadata.previous_version
+                )
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
+        _logger.info(f"Index #{self._index_id} switched back from version {metadata.version} to version {metadata.previous_version}.")
+        return metadata.previous_version
+
+    def discard_version(self) -> bool:
+        """
+        Drop the objects of the version being built, or of the one left
+        behind by a build that didn't complete, and if a version has been 
+        published restore its metadata, with status CREATED. Return True if
+        the published version has been restored.
+        """
+        columns = ", ".join(f"[{name}] = v.[{name}]" for name in _VERSIONED_COLUMNS)
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()
+            row = cursor.execute("""
+                select 
+                    k.[version], k.[previous_version], 
+                    (select isnull(max([version]), 0) + 1 from [$vector].[kmeans_versions] where [index_id] = k.[id]) as [next_version]
+                from 
+                    [$vector].[kmeans] k 
+                where 
+                    k.[id] = ?""", 
+                self._index_id
+                ).fetchone()
+            version = self._version if self._version != None else max(row.next_version, (row.version or 0) + 1)
+            if (version not in (row.version, row.previous_version)):
+                _logger.info(f"Dropping unpublished version {version} of index #{self._index_id}...")
+                cursor.execute("".join(f"drop {'function' if type == 'IF' else 'table'} if exists {versioned_name};" for _, versioned_name, type in self._get_versioned_objects(version)))
+                cursor.execute("delete from [$vector].[kmeans_models] where [index_id] = ? and [version] = ?", self._index_id, version)
+            restored = 0
+            if (row.version != None):
+                restored = cursor.execute(f"""
+                    update k set
+                        {columns},
+                        [status] = 'CREATED'
+                    from
+                        [$vector].[kmeans] k
+                    inner join
+                        [$vector].[kmeans_versions] v on v.[index_id] = k.[id] and v.[version] = k.[version]
+                    where
+                        k.[id] = ?;
+                    """,
+                    self._index_id
+                    ).rowcount
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
+        self._version = None
+        if (restored > 0):
+            _logger.info(f"Index #{self._index_id} is back to published version {row.version}.")
+        return restored > 0
+
+    def _drop_unused_versions(self):
+        """
+        Drop the objects of the versions that are neither the published one
+        nor the previous one.
+        """
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()
+            versions = [r.version for r in cursor.execute("""
+                select v.[version] from [$vector].[kmeans_versions] v inner join [$vector].[kmeans] k on v.[index_id] = k.[id]
+                where k.[id] = ? and v.[version] not in (k.[version], isnull(k.[previous_version], k.[version]))""", 
+                self._index_id
+                ).fetchall()]
+            for version in versions:
+                _logger.info(f"Dropping version {version} of index #{self._index_id}...")
+                cursor.execute("".join(f"drop {'function' if type == 'IF' else 'table'} if exists {versioned_name};" for _, versioned_name, type in self._get_versioned_objects(version)))
+                cursor.execute("delete from [$vector].[kmeans_versions] where [index_id] = ? and [version] = ?", self._index_id, version)
+                cursor.execute("delete from [$vector].[kmeans_models] where [index_id] = ? and [version] = ?", self._index_id, version)
+                conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
+    def save_build_history(self, build_id:str, build_status:str, build_mode:str, phases:list):
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                insert into [$vector].[kmeans_build_history] 
+                    ([build_id], [index_id], [build_status], [build_mode], [phase], [started_on], [elapsed_seconds], [row_count], [rows_per_second], [bytes_fetched], [peak_rss_bytes], [iterations], [inertia])
+                values
+                    (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);""",
+                [(
+                    build_id, self._index_id, build_status, str(build_mode), 
+                    p["phase"], p["started_on"], p["elapsed_seconds"], p["rows"], p["rows_per_second"], 
+                    p["bytes_fetched"], p["peak_rss_bytes"], p["iterations"], p["inertia"]
+                ) for p in phases]
             )
-        conn.commit()
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
 
-        cursor.close()
-        conn.close()
+    def load_model(self):
+        """
+        Return the format and the content of the trained model of the 
+        published version of the index, or None if no model has been saved.
+        """
+        conn = self.__get_mssql_connection()
+        try:
+            row = conn.execute("""
+                select m.[format], m.[model] from [$vector].[kmeans_models] m 
+                inner join [$vector].[kmeans] k on m.[index_id] = k.[id] and m.[version] = k.[version] 
+                where k.[id] = ?""", 
+                self._index_id
+                ).fetchone()
+        finally:
+            conn.close()
+
+        if (row == None):
+            return None
+        return row.format, bytes(row.model)
+
+    def get_index_metadata(self):
+        conn = self.__get_mssql_connection()
+        try:
+            row = conn.execute("""
+                select 
+                    [status], [item_count], [updated_on], [watermark_id], [watermark_version], 
+                    [changed_item_count], [baseline_distance], [recent_distance], [recent_item_count], [recommended_probes], 
+                    [index_type], [pq_subspaces], [scalar_quantization], [scalar_quantization_params], [top_clusters],
+                    [version], [previous_version]
+                from 
+                    [$vector].[kmeans] 
+                where 
+                    id = ?;""", 
+                self._index_id
+                ).fetchone()
+        finally:
+            conn.close()
+
+        if (row == None):
+            raise DatabaseEngineException(f"Index #{self._index_id} not found.")
+        return row
+
+    def get_source_watermark(self) -> tuple:
+        """
+        Return the highest id and the lowest active rowversion: any row changed 
+        after this point will have a higher id or a greater or equal rowversion.
+        """
+        conn = self.__get_mssql_connection()
+        try:
+            row = conn.execute(f"select max({self._source_id_column_name}), min_active_rowversion() from {self._source_table_fqname}").fetchone()
+        finally:
+            conn.close()
+        return (int(row[0]) if row[0] != None else 0, bytes(row[1]))
+
+    def count_source_changes(self, from_watermark:tuple) -> int:
+        """
+        Return the number of rows inserted (or updated, if a rowversion column 
+        is available) after the given watermark.
+        """
+        conn = self.__get_mssql_connection()
+        try:
+            if (self._source_version_column_name != None and from_watermark[1] != None):
+                count = conn.execute(f"select count_big(*) from {self._source_table_fqname} where {self._source_version_column_name} >= ?", from_watermark[1]).fetchval()
+            else:
+                count = conn.execute(f"select count_big(*) from {self._source_table_fqname} where {self._source_id_column_name} > ?", from_watermark[0]).fetchval()
+        finally:
+            conn.close()
+        return int(count)
+
+    def get_clusters_size_stats(self):
+        conn = self.__get_mssql_connection()
+        try:
+            row = conn.execute(f"""
+                select top (1)
+                    count(*) over () as clusters_count, 
+                    max(items_count) over () as max_size, 
+                    avg(cast(items_count as float)) over () as mean_size,
+                    percentile_disc(0.99) within group (order by items_count) over () as p99_size
+                from 
+                    (select count(*) as items_count from {self._clusters_table_fqname} group by cluster_id) as c
+                """).fetchone()
+        finally:
+            conn.close()
+        return row
+
+    def finalize_index_update(self, watermark:tuple, changed_count:int, assigned_count:int, assigned_distance_sum:float):
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()  
+            cursor.execute(f"""
+                declare @assigned_count int = ?, @assigned_distance_sum float = ?;
+                update 
+                    [$vector].[kmeans] 
+                set
+                    [item_count] = (select count_big(*) from {self._clusters_table_fqname}),
+                    [status] = 'CREATED',                
+                    [watermark_id] = ?,
+                    [watermark_version] = ?,
+                    [changed_item_count] = isnull([changed_item_count], 0) + ?,
+                    [recent_distance] = case 
+                        when isnull([recent_item_count], 0) + @assigned_count = 0 then null
+                        else (isnull([recent_distance], 0) * isnull([recent_item_count], 0) + @assigned_distance_sum) / (isnull([recent_item_count], 0) + @assigned_count)
+                    end,
+                    [recent_item_count] = isnull([recent_item_count], 0) + @assigned_count
+                where 
+                    id = ?;
+                declare @id int = ?;
+                {self._get_save_version_statement()}""", 
+                assigned_count,
+                assigned_distance_sum,
+                watermark[0],
+                watermark[1],
+                changed_count,
+                self._index_id, 
+                self._index_id, 
+                )
+            conn.commit()
+
+            cursor.close()
+        finally:
+            conn.close()
   
-    def load_vectors_from_db(self):            
+    def get_source_row_count(self) -> int:
+        conn = self.__get_mssql_connection()
+        try:
+            count = conn.execute(f"select count_big(*) from {self._source_table_fqname}").fetchval()
+        finally:
+            conn.close()
+        return int(count)
+
+    def _get_vector_select(self, alias:str = None):
+        prefix = f"{alias}." if alias != None else ""
+        if (self._source_vector_format == VectorFormat.BINARY):
+            vector_expression = f"cast({prefix}{self._source_vector_column_name} as varbinary(8000))"
+            decode = decode_vectors_binary
+        else:
+            vector_expression = f"cast({prefix}{self._source_vector_column_name} as varchar(max))"
+            decode = decode_vectors_json
+
+        return f"{prefix}{self._source_id_column_name} as item_id, {vector_expression} as vector", decode
+
+    def _decode_rows(self, rows:list, out:tuple = None):
+        """
+        Decode a batch of (item_id, vector) rows into a newly allocated block,
+        or into the given (ids, vectors) arrays.
+        """
+        _, decode = self._get_vector_select()
+        n = len(rows)
+        start = time.perf_counter()
+        ids_out, vectors_out = out if out != None else (np.empty((n), dtype=np.int32), np.empty((n, self._vector_dimensions), dtype=np.float32))
+        ids_out[:] = np.fromiter((row[0] for row in rows), dtype=np.int32, count=n)
+        values = [row[1] for row in rows]
+        ids, vectors = ids_out, decode(values, self._vector_dimensions, vectors_out)
+        if (self.normalize_vectors):
+            normalize_rows(vectors)
+        # Partitions are decoded by concurrent threads
+        with self._bytes_fetched_lock:
+            self.bytes_fetched += n * 4 + sum(len(v) for v in values)
+        elapsed = time.perf_counter() - start
+        
+        rps = int(n / elapsed) if elapsed > 0 else n
+        _logger.debug(f"Decoded {n} rows at {rps} rows/s")
+        return ids, vectors, rps
+
+    def _fetch_batches(self, query:str, *params):
+        """
+        Execute the query and yield the fetched rows, one batch at a time.
+        """
+        conn = self.__get_mssql_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(query, *params)
+            while(True):
+                rows = cursor.fetchmany(_FETCH_BATCH_SIZE)
+                if (rows == []):
+                    break
+
+                yield rows
+
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+
+    def _iterate_query(self, query:str, *params):
+        """
+        Execute the query and yield (ids, vectors) numpy arrays, one pair for 
+        each fetched batch. Each batch is decoded into a newly allocated block.
+        """
+        for rows in self._fetch_batches(query, *params):
+            yield self._decode_rows(rows)
+
+    def iterate_vectors_from_db(self):
+        select, _ = self._get_vector_select()
         query = f"""
-            select {self._source_id_column_name} as item_id, cast({self._source_vector_column_name} as varchar(max)) as vector from {self._source_table_fqname} 
+            select {select} from {self._source_table_fqname} 
+        """
+        for ids, vectors, _ in self._iterate_query(query):
+            yield ids, vectors
+
+    def iterate_changed_vectors_from_db(self, from_watermark:tuple, to_watermark:tuple):
+        select, _ = self._get_vector_select()
+        if (self._source_version_column_name != None and from_watermark[1] != None):
+            query = f"""
+                select {select} from {self._source_table_fqname} where {self._source_version_column_name} >= ? and {self._source_version_column_name} < ?
+            """
+            params = (from_watermark[1], to_watermark[1])
+        else:
+            query = f"""
+                select {select} from {self._source_table_fqname} where {self._source_id_column_name} > ? and {self._source_id_column_name} <= ?
+            """
+            params = (from_watermark[0], to_watermark[0])
+
+        for ids, vectors, _ in self._iterate_query(query, *params):
+            yield ids, vectors
+
+    def load_clusters_centroids(self) -> np.ndarray:
+        conn = self.__get_mssql_connection()
+        try:
+            rows = conn.execute(f"select cluster_id, cast(centroid as varbinary(8000)) as centroid from {self._clusters_centroids_table_fqname} order by cluster_id").fetchall()
+        finally:
+            conn.close()
+        
+        centroids = np.empty((len(rows), self._vector_dimensions), dtype=np.float32)
+        decode_vectors_binary([row.centroid for row in rows], self._vector_dimensions, centroids)
+        return centroids
+
+    def load_clusters_items(self, with_vectors:bool = True, quantized:bool = False):
         """
-        buffer = Buffer()    
-        result = VectorSet(self._vector_dimensions)
+        Return cluster ids and item ids of all the items in the index, and 
+        their vectors if requested, as numpy arrays. Quantized vectors are 
+        read from the clusters table instead of the source table, and 
+        returned as they have been saved, as an array of bytes.
+        """
+        if (quantized):
+            query = f"select item_id, sq_vector, cluster_id from {self._clusters_table_fqname}"
+        elif (with_vectors):
+            select, _ = self._get_vector_select("v")
+            query = f"""
+                select {select}, c.cluster_id 
+                from {self._clusters_table_fqname} c inner join {self._source_table_fqname} v on v.{self._source_id_column_name} = c.item_id
+            """
+        else:
+            query = f"select item_id, cluster_id from {self._clusters_table_fqname}"
+
+        result = VectorSet(self._vector_dimensions if with_vectors and not quantized else 0)
+        clusters = []
+        codes = []
         conn = self.__get_mssql_connection()
         cursor = conn.cursor()
-        cursor.execute(query)
-        tr = 0
-        while(True):
-            buffer.clear()    
-            rows = cursor.fetchmany(50000)
-            if (rows == []):
-                break
-
-            for idx, row in enumerate(rows):
-                buffer.add(row.item_id, json.loads(row.vector))
-            
-            result.add(buffer)            
-            tr += (idx+1)
+        try:
+            cursor.execute(query)
+            while(True):
+                rows = cursor.fetchmany(_FETCH_BATCH_SIZE)
+                if (rows == []):
+                    break
+                if (quantized):
+                    result.add(np.fromiter((row[0] for row in rows), dtype=np.int32, count=len(rows)), np.empty((len(rows), 0), dtype=np.float32))
+                    codes.append(np.frombuffer(b"".join(row[1] for row in rows), dtype=np.uint8).reshape(len(rows), -1))
+                elif (with_vectors):
+                    ids, vectors, _ = self._decode_rows(rows)
+                    result.add(ids, vectors)
+                else:
+                    result.add(np.fromiter((row[0] for row in rows), dtype=np.int32, count=len(rows)), np.empty((len(rows), 0), dtype=np.float32))
+                clusters.append(np.fromiter((row[-1] for row in rows), dtype=np.int32, count=len(rows)))
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
 
-            mf = int(result.get_memory_usage() / 1024 / 1024)
-            _logger.info("Loaded {0} rows, total rows {1}, total memory footprint {2} MB".format(idx+1, tr, mf))        
+        result.trim()
+        labels = np.concatenate(clusters) if clusters else np.empty((0), dtype=np.int32)
+        if (quantized):
+            return labels, result.ids, np.concatenate(codes) if codes else np.empty((0, 0), dtype=np.uint8)
+        return labels, result.ids, result.vectors if with_vectors else None
 
-        cursor.close()
-        conn.commit()
-        conn.close()
+    def load_vectors_by_ids(self, ids:list):
+        select, _ = self._get_vector_select()
+        query = f"""
+            select {select} from {self._source_table_fqname} where {self._source_id_column_name} in (select cast([value] as int) from openjson(?))
+        """
+        result = VectorSet(self._vector_dimensions, len(ids))
+        for batch_ids, vectors, _ in self._iterate_query(query, json.dumps([int(i) for i in ids])):
+            result.add(batch_ids, vectors)
+        result.trim()
+        return result.ids, result.vectors
+
+    def get_source_rows(self, ids:list) -> dict:
+        """
+        Return the source rows with the given ids, without the vector column, 
+        as dictionaries keyed by id.
+        """
+        conn = self.__get_mssql_connection()
+        try:
+            columns = [r.name for r in conn.execute("select [name] from sys.columns where [object_id] = object_id(?) and [name] <> ? order by [column_id]", self._source_table_fqname, self._source_vector_column_name).fetchall()]
+            cursor = conn.execute(f"""
+                select {", ".join(f"[{c}]" for c in columns)} from {self._source_table_fqname} where {self._source_id_column_name} in (select cast([value] as int) from openjson(?))
+                """, 
+                json.dumps([int(i) for i in ids]))
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+
+        return {int(getattr(r, self._source_id_column_name)): dict(zip(columns, r)) for r in rows}
+
+    def delete_removed_clusters_items(self) -> int:
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                delete c from {self._clusters_table_fqname} c 
+                where not exists (select * from {self._source_table_fqname} v where v.{self._source_id_column_name} = c.item_id)
+                """)
+            deleted = cursor.rowcount
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+        return max(deleted, 0)
+
+    def upsert_clusters_items(self, ids:np.ndarray, labels:np.ndarray, codes:np.ndarray = None, sq_vectors:np.ndarray = None):
+        columns = self._get_items_columns(codes, sq_vectors)
+        declare, names, values = self._get_items_insert_select(columns)
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()
+            for batch in self._get_items_batches(ids, labels, columns):
+                cursor.execute(f"""
+                    {declare};
+                    select {values}
+                    into #items
+                    from generate_series(0, @count - 1) as s;
+                    delete c from {self._clusters_table_fqname} c where c.item_id in (select item_id from #items);
+                    insert into {self._clusters_table_fqname} ({names}) select {names} from #items;
+                    drop table #items;
+                    """,
+                    *batch)
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
+    def load_sample_vectors_from_db(self, sample_size:int, row_count:int):
+        select, _ = self._get_vector_select()
+        # TABLESAMPLE works on pages, so ask for some more rows than needed to have enough of them
+        percent = sample_size * 150.0 / max(row_count, 1)
+        query = f"select top (?) {select} from {self._source_table_fqname} tablesample (%.4f percent)"
+        result = self._load_sample(query % percent, sample_size) if percent < 100.0 else None
+        retries = 2
+        # Reading all pages would return the first rows of the table, so larger samples are taken reading the table instead
+        while (result != None and result.count < sample_size and retries > 0 and percent * 4 < 100.0):
+            percent *= 4
+            _logger.info(f"Sampling returned only {result.count} rows, sampling {percent:.4f} percent of pages...")
+            result = self._load_sample(query % percent, sample_size)
+            retries -= 1
+
+        if (result == None or result.count < sample_size):
+            if (result != None):
+                _logger.warning(f"Sampling returned only {result.count} rows, sampling {sample_size} rows reading the whole table instead...")
+            # Rows are kept at random and then shuffled, so that the sample is not taken from the first pages of the table
+            fraction = min(1.0, sample_size * 1.5 / max(row_count, 1))
+            result = self._load_sample(f"""
+                select top (?) {select} from {self._source_table_fqname} 
+                where abs(cast(checksum(newid()) as bigint)) % 1000000 < ? 
+                order by newid()""", 
+                sample_size, int(fraction * 1000000) + 1)
+
+        result.trim()
+        _logger.info(f"Loaded {result.count} sample vectors.")
+        return result.ids, result.vectors
+
+    def _load_sample(self, query:str, sample_size:int, *params) -> VectorSet:
+        result = VectorSet(self._vector_dimensions, sample_size)
+        for ids, vectors, _ in self._iterate_query(query, sample_size, *params):
+            result.add(ids, vectors)
+        return result
+
+    def get_id_ranges(self, partitions:int) -> list:
+        """
+        Split the ids of the source table in partitions ranges of the same 
+        width, and return (from_id, to_id, row_count) for the non-empty ones.
+        """
+        conn = self.__get_mssql_connection()
+        try:
+            min_id, max_id = conn.execute(f"select min({self._source_id_column_name}), max({self._source_id_column_name}) from {self._source_table_fqname}").fetchone()
+            if (min_id == None):
+                return []
+            width = (int(max_id) - int(min_id)) // partitions + 1
+            rows = conn.execute(f"""
+                select p, count_big(*) as row_count from 
+                    (select (cast({self._source_id_column_name} as bigint) - ?) / ? as p from {self._source_table_fqname}) as r 
+                group by p 
+                order by p
+                """, int(min_id), width).fetchall()
+        finally:
+            conn.close()
+        return [(int(min_id) + int(r.p) * width, int(min_id) + (int(r.p) + 1) * width - 1, int(r.row_count)) for r in rows]
+
+    def _load_partitions(self, result:VectorSet, ranges:list, progress = None):
+        """
+        Load each id range on its own connection and thread, decoding rows 
+        directly into a slice of result sized for the range. Rows beyond 
+        the expected count, inserted meanwhile, are added at the end.
+        """
+        select, _ = self._get_vector_select()
+        query = f"""
+            select {select} from {self._source_table_fqname} where {self._source_id_column_name} between ? and ?
+        """
+        starts = np.concatenate([[0], np.cumsum([r[2] for r in ranges])[:-1]]).astype(np.int64)
+        counts = [0] * len(ranges)
+        overflow = [[] for _ in ranges]
+        row_count = sum(r[2] for r in ranges)
+        loaded = 0
+        lock = threading.Lock()
+
+        def load(p:int):
+            nonlocal loaded
+            from_id, to_id, capacity = ranges[p]
+            start = time.perf_counter()
+            for rows in self._fetch_batches(query, from_id, to_id):
+                s = starts[p] + counts[p]
+                n = min(len(rows), capacity - counts[p])
+                decoded = []
+                if (n > 0):
+                    decoded.append(self._decode_rows(rows[:n], (result.ids[s:s + n], result.vectors[s:s + n])))
+                    counts[p] += n
+                if (n < len(rows)):
+                    decoded.append(self._decode_rows(rows[n:]))
+                    overflow[p].append(decoded[-1][:2])
+                # Rows overflowing the range are decoded separately, the slowest decode rate of the batch is reported
+                rps = min(d[2] for d in decoded)
+                with lock:
+                    loaded += len(rows)
+                    _logger.info(f"Loaded {len(rows)} rows of partition [{from_id}:{to_id}], total rows {loaded}, decoded at {rps} rows/s")
+                    if (progress != None):
+                        progress(loaded, row_count)
+            elapsed = time.perf_counter() - start
+            _logger.info(f"Loaded partition [{from_id}:{to_id}] ({counts[p]} rows) in {elapsed:.3f} sec ({int(counts[p] / max(elapsed, 1e-9))} rows/s)")
+
+        # Each worker holds a pooled connection until its range is loaded, one is left for the rest of the build
+        pool_size = get_connection_pool().max_size
+        workers = max(1, min(len(ranges), pool_size - 1))
+        if (workers < len(ranges)):
+            _logger.warning(f"Loading {len(ranges)} id ranges on {workers} connections, as the connection pool size (KMEANS_POOL_SIZE) is {pool_size}.")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for f in [pool.submit(load, p) for p in range(len(ranges))]:
+                f.result()
+
+        result.compact(starts, counts)
+        for batches in overflow:
+            for ids, vectors in batches:
+                result.add(ids, vectors)
+
+    def load_vectors_from_db(self, staging_path:str = None, progress = None, partitions:int = 1):            
+        select, _ = self._get_vector_select()
+        query = f"""
+            select {select} from {self._source_table_fqname} 
+        """
+        # Empty tables are read with a single query
+        ranges = (self.get_id_ranges(partitions) or None) if partitions > 1 else None
+        row_count = sum(r[2] for r in ranges) if ranges != None else self.get_source_row_count()
+        if (staging_path == None):
+            _logger.info(f"Pre-allocating memory for {row_count} vectors...")
+            result = VectorSet(self._vector_dimensions, row_count)
+        else:
+            _logger.info(f"Staging {row_count} vectors into {staging_path}...")
+            result = MemoryMappedVectorSet(staging_path, self._vector_dimensions, row_count)
+
+        if (ranges != None):
+            _logger.info(f"Loading {len(ranges)} id ranges in parallel...")
+            self._load_partitions(result, ranges, progress)
+        else:
+            tr = 0
+            for ids, vectors, rps in self._iterate_query(query):
+                n = len(ids)
+                result.add(ids, vectors)            
+                tr += n
+
+                mf = int(result.get_memory_usage() / 1024 / 1024)
+                _logger.info("Loaded {0} rows, total rows {1}, total memory footprint {2} MB, decoded at {3} rows/s".format(n, tr, mf, rps))        
+                if (progress != None):
+                    progress(tr, row_count)
+
+        result.trim()
+        mf = int(result.get_memory_usage() / 1024 / 1024)
+        pmf = int(result.get_memory_usage(peak=True) / 1024 / 1024)
+        _logger.info(f"Loaded {result.count} vectors, final memory footprint {mf} MB, peak memory footprint {pmf} MB")
         return result.ids, result.vectors
     
-    def save_clusters_centroids(self, centroids):                
-        conn = self.__get_mssql_connection()  
-        cursor = conn.cursor()  
-        params = [(i, json.dumps(centroids[i], cls=NpEncoder)) for i in range(0, len(centroids))]
-        cursor = conn.cursor()
-        
-        #cursor.fast_executemany = True        
-        _logger.info(f"Saving centroids to {self._clusters_centroids_table_fqname}...")
-        cursor.execute(f"""
-            if object_id('{self._clusters_centroids_table_fqname}') is null begin
-                create table {self._clusters_centroids_table_fqname}
+    def _bulk_insert(self, statement:str, batches:list, workers:int):
+        """
+        Execute the insert statement once per batch of parameters. Each worker 
+        uses its own connection, so that batches can be loaded in parallel.
+        """
+        def insert(params):
+            conn = self.__get_mssql_connection()
+            try:
+                conn.execute(statement, *params)
+                conn.commit()
+            finally:
+                conn.close()
+
+        if (workers <= 1 or len(batches) <= 1):
+            for params in batches:
+                insert(params)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(insert, batches))
+
+    def _get_centroids_batches(self, centroids, parents:np.ndarray = None) -> list:
+        # Centroids are sent as one JSON array per batch and shredded server-side with OPENJSON,
+        # parents as big-endian int32 values, like cluster assignments
+        parents = np.asarray(parents).astype('>i4') if parents is not None else np.empty((len(centroids)), dtype='>i4')
+        return [(json.dumps(centroids[i:i + _SAVE_CENTROIDS_BATCH_SIZE].tolist()), i, parents[i:i + _SAVE_CENTROIDS_BATCH_SIZE].tobytes()) for i in range(0, len(centroids), _SAVE_CENTROIDS_BATCH_SIZE)]
+
+    def save_top_clusters_centroids(self, top_centroids:np.ndarray = None, first_cluster_ids:np.ndarray = None, last_cluster_ids:np.ndarray = None):
+        """
+        Save the top layer of a two-level index: each top centroid with the
+        range of the ids of its children, or remove it if top_centroids is None.
+        """
+        table_fqname = self._get_versioned_fqname("top_centroids", self._version)
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()
+            if (top_centroids is None):
+                cursor.execute(f"drop table if exists {table_fqname}")
+                cursor.commit()
+                return
+
+            _logger.info(f"Saving {len(top_centroids)} top centroids to {table_fqname}...")
+            cursor.execute(f"""
+                drop table if exists {table_fqname} 
+                create table {table_fqname}
                 (
-                    cluster_id int not null primary key clustered,
+                    top_cluster_id int not null primary key clustered,
+                    first_cluster_id int not null,
+                    last_cluster_id int not null,
                     centroid vector({self._vector_dimensions}) not null
                 )
-            end   
-            drop table if exists {self._clusters_centroids_tmp_table_fqname} 
-            create table {self._clusters_centroids_tmp_table_fqname}
+                """)
+            cursor.execute(f"""
+                declare @centroids nvarchar(max) = ?, @first varbinary(max) = ?, @last varbinary(max) = ?;
+                insert into {table_fqname} (top_cluster_id, first_cluster_id, last_cluster_id, centroid) 
+                select 
+                    cast([key] as int), 
+                    cast(substring(@first, cast([key] as int) * 4 + 1, 4) as int),
+                    cast(substring(@last, cast([key] as int) * 4 + 1, 4) as int),
+                    cast([value] as vector({self._vector_dimensions})) 
+                from openjson(@centroids)
+                """,
+                json.dumps(top_centroids.tolist()),
+                np.asarray(first_cluster_ids).astype('>i4').tobytes(),
+                np.asarray(last_cluster_ids).astype('>i4').tobytes())
+            cursor.commit()
+            cursor.close()
+        finally:
+            conn.close()
+        _logger.info("Top centroids saved.")
+
+    def _get_probes_cte(self, top_clusters:int = None) -> str:
+        """
+        Return the CTE that selects the @p clusters to probe, with their 
+        similarity to the query. With a two-level index, only the children
+        of the top centroids nearest to the query are compared with it.
+        """
+        centroids_table_fqname = self._get_versioned_fqname("clusters_centroids", self._version)
+        top_centroids_table_fqname = self._get_versioned_fqname("top_centroids", self._version)
+        if (top_clusters == None):
+            return f"""
+            cteProbes as
             (
-                cluster_id int not null primary key clustered,
-                centroid vector({self._vector_dimensions}) not null
-            )
-            """)
-        cursor.commit()
-        cursor.executemany(f"""    
-            insert into {self._clusters_centroids_tmp_table_fqname} (cluster_id, centroid) values (?, cast(? as vector({self._vector_dimensions})))
-            """, 
-            params)
-        cursor.commit()
+                select top (@p)
+                    k.cluster_id,
+                    1 - vector_distance('cosine', k.[centroid], @v) as [score]
+                from 
+                    {centroids_table_fqname} k
+                order by
+                    vector_distance('cosine', k.[centroid], @v) 
+            )"""
+        return f"""
+            cteTop as
+            (
+                select top (least({top_clusters}, greatest({TOP_PROBES_MIN}, {TOP_PROBES_EXPANSION} * @p)))
+                    t.first_cluster_id, t.last_cluster_id
+                from 
+                    {top_centroids_table_fqname} t
+                order by
+                    vector_distance('cosine', t.[centroid], @v) 
+            ),
+            cteProbes as
+            (
+                select top (@p)
+                    k.cluster_id,
+                    1 - vector_distance('cosine', k.[centroid], @v) as [score]
+                from 
+                    cteTop t
+                inner join
+                    {centroids_table_fqname} k on k.cluster_id between t.first_cluster_id and t.last_cluster_id
+                order by
+                    vector_distance('cosine', k.[centroid], @v) 
+            )"""
+
+    def _get_items_columns(self, codes:np.ndarray = None, sq_vectors:np.ndarray = None) -> dict:
+        """
+        Return the optional fixed size binary columns saved with each item,
+        as (n, size) arrays of bytes, by column name.
+        """
+        columns = {"pq_code": codes, "sq_vector": sq_vectors}
+        return {name: values for name, values in columns.items() if values is not None}
+
+    def _get_items_batches(self, ids, labels, columns:dict = {}) -> list:
+        # Ids and labels are sent as columnar batches of big-endian int32 values, 
+        # which are unpacked server-side without creating any per-row Python object.
+        # Binary columns are sent the same way, as fixed size slices of a single binary value
+        ids = np.asarray(ids).astype('>i4')
+        labels = np.asarray(labels).astype('>i4')
+        return [
+            (ids[i:i + _SAVE_ITEMS_BATCH_SIZE].tobytes(), labels[i:i + _SAVE_ITEMS_BATCH_SIZE].tobytes(), len(ids[i:i + _SAVE_ITEMS_BATCH_SIZE])) + 
+            tuple(values[i:i + _SAVE_ITEMS_BATCH_SIZE].tobytes() for values in columns.values()) 
+            for i in range(0, len(ids), _SAVE_ITEMS_BATCH_SIZE)
+        ]
+
+    def _get_items_insert_select(self, columns:dict) -> tuple:
+        """
+        Return the declarations of the parameters of a batch of items, and
+        the list of columns and values that unpack them.
+        """
+        declare = "declare @ids varbinary(max) = ?, @labels varbinary(max) = ?, @count int = ?" + "".join(f", @{name} varbinary(max) = ?" for name in columns)
+        names = ", ".join(["item_id", "cluster_id"] + list(columns))
+        values = ", ".join(
+            ["cast(substring(@ids, s.[value] * 4 + 1, 4) as int) as item_id", "cast(substring(@labels, s.[value] * 4 + 1, 4) as int) as cluster_id"] + 
+            [f"substring(@{name}, s.[value] * {values.shape[1]} + 1, {values.shape[1]}) as {name}" for name, values in columns.items()]
+        )
+        return declare, names, values
+
+    def save_clusters_centroids(self, centroids, workers:int = 1, parents:np.ndarray = None):                
+        table_fqname = self._get_versioned_fqname("clusters_centroids", self._version)
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()
         
-        _logger.info("Switching to final centroids table...")
-        cursor.execute(f"""
-                       begin tran;
-                       drop table if exists {self._clusters_centroids_table_fqname};
-                       alter schema [$vector] transfer {self._clusters_centroids_tmp_table_fqname};
-                       commit tran;
-                       """)
-        cursor.commit()
-
-        cursor.close()        
-        conn.close()
+            _logger.info(f"Saving centroids to {table_fqname}...")
+            cursor.execute(f"""
+                drop table if exists {table_fqname} 
+                create table {table_fqname}
+                (
+                    cluster_id int not null primary key clustered,
+                    parent_id int null,
+                    centroid vector({self._vector_dimensions}) not null
+                )
+                """)
+            cursor.commit()
+
+            batches = self._get_centroids_batches(centroids, parents)
+            self._bulk_insert(f"""
+                declare @centroids nvarchar(max) = ?, @offset int = ?, @parents varbinary(max) = ?;
+                insert into {table_fqname} (cluster_id, parent_id, centroid) 
+                select 
+                    cast([key] as int) + @offset, 
+                    case when datalength(@parents) > 0 then cast(substring(@parents, cast([key] as int) * 4 + 1, 4) as int) end,
+                    cast([value] as vector({self._vector_dimensions})) 
+                from openjson(@centroids)
+                """,
+                batches,
+                workers)
+
+            cursor.close()
+        finally:
+            conn.close()
        
         _logger.info("Centroids saved.")
 
-    def save_clusters_items(self, ids, labels):
-        clustered_ids = dict(zip(ids, labels))
-        params = [(int(ids[i]), int(labels[i])) for i in range(0, len(clustered_ids))]
-
-        conn = self.__get_mssql_connection()       
-        cursor = conn.cursor()  
-        cursor.fast_executemany = True
-
-        _logger.info(f"Saving centroids elements into {self._clusters_table_fqname}...")        
-        cursor.execute(f"drop table if exists {self._clusters_table_fqname}")
-        cursor.execute(f"""
-            if object_id('{self._clusters_table_fqname}') is null begin
-                create table {self._clusters_table_fqname} (
-                    cluster_id int not null,
-                    item_id int not null        
-                )
-            end   
-            drop table if exists {self._clusters_tmp_table_fqname} 
-            create table {self._clusters_tmp_table_fqname}
-                (
-                    cluster_id int not null,
-                    item_id int not null    
-                )                        
-        """)        
-        cursor.executemany(f"insert into {self._clusters_tmp_table_fqname} (item_id, cluster_id) values (?, ?)", params)
-        cursor.commit()
-
-        _logger.info("Creating index...")
-        cursor.execute(f"create clustered index ixc on {self._clusters_tmp_table_fqname} (cluster_id, item_id)")
-        cursor.commit()
-        
-        _logger.info("Switching to final centroids elements table...")
-        cursor.execute(f"""
-                       drop table if exists {self._clusters_table_fqname};
-                       alter schema [$vector] transfer {self._clusters_tmp_table_fqname};
-                       """)
-        cursor.commit()
-
-        cursor.close()
-        conn.commit()        
+    def save_clusters_items(self, ids, labels, workers:int = 1, codes:np.ndarray = None, sq_vectors:np.ndarray = None):
+        columns = self._get_items_columns(codes, sq_vectors)
+        table_fqname = self._get_versioned_fqname("clusters", self._version)
+        conn = self.__get_mssql_connection()
+        try:
+            cursor = conn.cursor()  
+
+            _logger.info(f"Saving centroids elements into {table_fqname}...")        
+            cursor.execute(f"""
+                drop table if exists {table_fqname} 
+                create table {table_fqname}
+                    (
+                        cluster_id int not null,
+                        item_id int not null{"".join(f", {name} varbinary({values.shape[1]}) not null" for name, values in columns.items())}
+                    )                        
+            """)        
+            cursor.commit()
+
+            batches = self._get_items_batches(ids, labels, columns)
+            _logger.info(f"Sending {len(ids)} elements in {len(batches)} batches using {workers} workers...")
+            declare, names, values = self._get_items_insert_select(columns)
+            statement = f"""
+                {declare};
+                insert into {table_fqname} ({names})
+                select {values} from generate_series(0, @count - 1) as s
+                """
+            self._bulk_insert(statement, batches, workers)
+
+            _logger.info("Creating index...")
+            cursor.execute(f"create clustered index ixc on {table_fqname} (cluster_id, item_id)")
+            # Used by incremental updates to find existing items
+            cursor.execute(f"create nonclustered index ixi on {table_fqname} (item_id)")
+            cursor.commit()
+
+            cursor.close()
+            conn.commit()
+        finally:
+            conn.close()
         _logger.info("Centroids elements saved.")
 
-    def create_similarity_function(self):
+    def save_pq_codebooks(self, codebooks:np.ndarray):
+        """
+        Save product quantization codebooks, with shape (subspaces, codes, 
+        subspace dimensions), as one row per codebook centroid value, keyed 
+        by its dimension in the full vector, so that lookup tables can be 
+        computed server-side by joining them with the query vector.
+        """
+        subspaces, codes, subspace_dimensions = codebooks.shape
+        table_fqname = self._get_versioned_fqname("pq_codebooks", self._version)
         conn = self.__get_mssql_connection()
-        cursor = conn.cursor()  
-        
-        _logger.info(f"Creating function {self._function_fqname}...")
-        cursor = conn.cursor()
-        cursor.execute(f"""
-        create or alter function {self._function_fqname} (@v vector({self._vector_dimensions}), @k int, @p int, @d float)
-        returns table
-        as return
-        with cteProbes as
-        (
-            select top (@p)
-                k.cluster_id
-            from 
-                {self._clusters_centroids_table_fqname} k
+        try:
+            cursor = conn.cursor()
+            _logger.info(f"Saving codebooks to {table_fqname}...")
+            cursor.execute(f"""
+                drop table if exists {table_fqname} 
+                create table {table_fqname}
+                (
+                    [subspace] int not null,
+                    [code] int not null,
+                    [dimension] int not null,
+                    [value] float not null
+                )
+                """)
+            cursor.commit()
+
+            # One JSON array per subspace, holding its codes x subspace dimensions values
+            batches = [(json.dumps(codebooks[j].ravel().tolist()), j, subspace_dimensions) for j in range(subspaces)]
+            self._bulk_insert(f"""
+                declare @values nvarchar(max) = ?, @subspace int = ?, @subspace_dimensions int = ?;
+                insert into {table_fqname} ([subspace], [code], [dimension], [value]) 
+                select @subspace, cast([key] as int) / @subspace_dimensions, @subspace * @subspace_dimensions + cast([key] as int) % @subspace_dimensions, cast([value] as float) from openjson(@values)
+                """,
+                batches,
+                1)
+
+            cursor.execute(f"create clustered index ixc on {table_fqname} ([dimension], [subspace], [code])")
+            cursor.commit()
+            cursor.close()
+        finally:
+            conn.close()
+        _logger.info("Codebooks saved.")
+
+    def load_pq_codebooks(self, subspaces:int) -> np.ndarray:
+        conn = self.__get_mssql_connection()
+        try:
+            rows = conn.execute(f"select [subspace], [code], [dimension], [value] from {self._pq_codebooks_table_fqname}").fetchall()
+        finally:
+            conn.close()
+
+        subspace_dimensions = self._vector_dimensions // subspaces
+        codes = max(r.code for r in rows) + 1 if rows else 0
+        codebooks = np.zeros((subspaces, codes, subspace_dimensions), dtype=np.float32)
+        for r in rows:
+            codebooks[r.subspace, r.code, r.dimension - r.subspace * subspace_dimensions] = r.value
+        return codebooks
+
+    def create_pq_similarity_function(self, subspaces:int, top_clusters:int = None):
+        """
+        Create the search function of an IVF-PQ index. Candidates in the 
+        probed clusters are ranked by asymmetric distance: the query is 
+        compared to the encoded vectors through per-subspace lookup tables,
+        computed once per query from the codebooks. If @r is greater than 0, 
+        the best @r candidates are then re-ranked using their exact distance.
+        """
+        function_fqname = self._get_versioned_function_fqname(self._version)
+        conn = self.__get_mssql_connection()
+        try:
+            _logger.info(f"Creating function {function_fqname}...")
+            cursor = conn.cursor()
+            cursor.execute(f"""
+            create or alter function {function_fqname} (@v vector({self._vector_dimensions}), @k int, @p int, @d float, @r int)
+            returns table
+            as return
+            with cteQuery as
+            (
+                select 
+                    cast(q.[key] as int) as [dimension], 
+                    cast(q.[value] as float) / n.[norm] as [value]
+                from 
+                    openjson(cast(@v as nvarchar(max))) q
+                cross join
+                    (select sqrt(sum(square(cast([value] as float)))) as [norm] from openjson(cast(@v as nvarchar(max)))) n
+            ),
+            cteLookup as
+            (
+                select 
+                    b.[subspace], b.[code], sum(b.[value] * q.[value]) as [score]
+                from 
+                    {self._get_versioned_fqname("pq_codebooks", self._version)} b
+                inner join
+                    cteQuery q on q.[dimension] = b.[dimension]
+                group by
+                    b.[subspace], b.[code]
+            ),
+            {self._get_probes_cte(top_clusters)},
+            cteCandidates as
+            (
+                select top (case when @r > 0 then @r else @k end)
+                    c.item_id,
+                    1 - (k.[score] + sum(l.[score])) as [approximate_distance]
+                from
+                    cteProbes k
+                inner join
+                    {self._get_versioned_fqname("clusters", self._version)} c on k.cluster_id = c.cluster_id
+                cross apply
+                    generate_series(0, {subspaces - 1}) s
+                inner join
+                    cteLookup l on l.[subspace] = s.[value] and l.[code] = cast(substring(c.pq_code, s.[value] + 1, 1) as int)
+                group by
+                    c.item_id, k.[score]
+                order by
+                    [approximate_distance]
+            )
+            select top(@k)
+                v.*,
+                [$approximate_distance] = k.[approximate_distance],
+                [$distance] = d.[distance]
+            from
+                cteCandidates k
+            inner join
+                {self._source_table_fqname} v on v.{self._source_id_column_name} = k.item_id
+            cross apply
+                (select case when @r > 0 then vector_distance('cosine', v.{self._source_vector_column_name}, @v) else k.[approximate_distance] end as [distance]) d
+            where
+                d.[distance] <= @d
             order by
-                vector_distance('cosine', k.[centroid], @v) 
-        )
-        select top(@k)
-            v.*,
-            [$distance] = vector_distance('cosine', v.{self._source_vector_column_name}, @v) 
-        from
-            cteProbes k
-        inner join
-            {self._clusters_table_fqname} c on k.cluster_id = c.cluster_id
-        inner join
-            {self._source_table_fqname} v on v.id = c.item_id
-        where
-            vector_distance('cosine', v.{self._source_vector_column_name}, @v) <= @d
-        order by
-            [$distance]
-        """)
-        cursor.close()
-        conn.commit()
+                [$distance]
+            """)
+            cursor.close()
+            conn.commit()
+        finally:
+            conn.close()
         _logger.info(f"Function created.")
 
-    
\ No newline at end of file
+    def create_similarity_function(self, top_clusters:int = None):
+        function_fqname = self._get_versioned_function_fqname(self._version)
+        conn = self.__get_mssql_connection()
+        try:
+            _logger.info(f"Creating function {function_fqname}...")
+            cursor = conn.cursor()
+            cursor.execute(f"""
+            create or alter function {function_fqname} (@v vector({self._vector_dimensions}), @k int, @p int, @d float)
+            returns table
+            as return
+            with {self._get_probes_cte(top_clusters)}
+            select top(@k)
+                v.*,
+                [$distance] = vector_distance('cosine', v.{self._source_vector_column_name}, @v) 
+            from
+                cteProbes k
+            inner join
+                {self._get_versioned_fqname("clusters", self._version)} c on k.cluster_id = c.cluster_id
+            inner join
+                {self._source_table_fqname} v on v.{self._source_id_column_name} = c.item_id
+            where
+                vector_distance('cosine', v.{self._source_vector_column_name}, @v) <= @d
+            order by
+                [$distance]
+            """)
+            cursor.close()
+            conn.commit()
+        finally:
+            conn.close()
+        _logger.info(f"Function created.")
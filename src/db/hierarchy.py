@@ -0,0 +1,55 @@
+import math
+import time
+import logging
+import numpy as np
+from sklearn.cluster import KMeans
+from sklearn.preprocessing import normalize
+
+_logger = logging.getLogger("uvicorn")
+
+# Below this number of clusters scanning all the centroids is cheap enough
+HIERARCHY_MIN_CLUSTERS = 1024
+
+# Top centroids descended into: twice the number of probed clusters, and at
+# least 4. The nearest centroids are often children of different top ones,
+# so descending into fewer of them loses recall quickly
+TOP_PROBES_EXPANSION = 2
+TOP_PROBES_MIN = 4
+
+class CentroidsHierarchy:
+    """
+    Two-level coarse quantizer: fine centroids are clustered again into a
+    small top layer, and renumbered so that the children of each top
+    centroid have contiguous cluster ids, from first_cluster_ids to
+    last_cluster_ids. mapping gives the new cluster id of each old one.
+    """
+    def __init__(self, top_centroids:np.ndarray, parents:np.ndarray, mapping:np.ndarray) -> None:
+        self.top_centroids = top_centroids
+        self.parents = parents
+        self.mapping = mapping
+        counts = np.bincount(parents, minlength=len(top_centroids))
+        self.last_cluster_ids = np.cumsum(counts) - 1
+        self.first_cluster_ids = self.last_cluster_ids - counts + 1
+
+def get_default_top_clusters(clusters:int) -> int:
+    if (clusters < HIERARCHY_MIN_CLUSTERS):
+        return 0
+    return int(round(math.sqrt(clusters)))
+
+def build_hierarchy(centroids:np.ndarray, top_clusters:int, random_state:int = 0) -> CentroidsHierarchy:
+    """
+    Cluster the given normalized centroids into top_clusters top centroids,
+    assigning each centroid to the top one with the highest cosine similarity,
+    as the similarity function does when descending the tree.
+    """
+    start = time.perf_counter()
+    kmeans = KMeans(n_clusters=top_clusters, n_init=1, random_state=random_state)
+    kmeans.fit(centroids)
+    top_centroids = normalize(kmeans.cluster_centers_).astype(np.float32)
+    parents = np.argmax(centroids @ top_centroids.T, axis=1)
+
+    order = np.argsort(parents, kind="stable")
+    mapping = np.empty(len(centroids), dtype=np.int32)
+    mapping[order] = np.arange(len(centroids), dtype=np.int32)
+    _logger.info(f"Clustered {len(centroids)} centroids into {top_clusters} top centroids in {time.perf_counter() - start:.3f} sec.")
+    return CentroidsHierarchy(top_centroids, parents[order].astype(np.int32), mapping)
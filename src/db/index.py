@@ -1,11 +1,49 @@
+import threading
+
+class IndexCancelledException(Exception):
+    pass
+
 class BaseIndex:
     def __init__(self) -> None:
         self.id:int = None
+        self._cancel_event = threading.Event()
+        self._progress_callback = None
+        self._progress:dict = {"phase": None, "processed": None, "total": None}
  
     def build(self):
         pass
 
+    def cancel(self):
+        self._cancel_event.set()
+
+    def recover(self, method:str, cancelled:bool, started:bool = True):
+        """
+        Called when running method on the index didn't complete: it failed, 
+        it has been cancelled, its process died before it could clean up 
+        after itself, or it has been cancelled before being started.
+        """
+        pass
+
+    def get_metrics(self) -> list:
+        return []
+
+    def set_progress_callback(self, callback):
+        self._progress_callback = callback
+
+    def _report_progress(self, phase:str = None, processed:int = None, total:int = None):
+        if (phase != None):
+            self._progress = {"phase": phase, "processed": None, "total": None}
+        if (processed != None):
+            self._progress["processed"] = processed
+        if (total != None):
+            self._progress["total"] = total
+        if (self._progress_callback != None):
+            self._progress_callback(dict(self._progress))
+
+    def _check_cancelled(self):
+        if (self._cancel_event.is_set()):
+            raise IndexCancelledException(f"Operation on index #{self.id} has been cancelled.")
+
 class NoIndex(BaseIndex):
     def __init__(self) -> None:
         super().__init__()
-    
\ No newline at end of file
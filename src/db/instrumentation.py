@@ -0,0 +1,111 @@
+import sys
+import time
+import datetime
+import resource
+
+def get_peak_rss() -> int:
+    """
+    Return the peak resident set size of the current process, in bytes.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class PhaseMetrics:
+    def __init__(self, name:str, bytes_fetched:int) -> None:
+        self.name = name
+        self.started_on = datetime.datetime.now()
+        self.elapsed:float = None
+        self.rows:int = None
+        self.bytes_fetched:int = 0
+        self.peak_rss:int = None
+        self.iterations:int = None
+        self.inertia:float = None
+        self._start = time.perf_counter()
+        self._start_bytes_fetched = bytes_fetched
+
+    def stop(self, bytes_fetched:int):
+        self.elapsed = time.perf_counter() - self._start
+        self.bytes_fetched = bytes_fetched - self._start_bytes_fetched
+        self.peak_rss = get_peak_rss()
+
+    def get_rows_per_second(self) -> float:
+        if (self.rows == None or not self.elapsed):
+            return None
+        return self.rows / self.elapsed
+
+    def to_dict(self) -> dict:
+        return {
+            "phase": self.name,
+            "started_on": self.started_on.isoformat(),
+            "elapsed_seconds": self.elapsed,
+            "rows": self.rows,
+            "rows_per_second": self.get_rows_per_second(),
+            "bytes_fetched": self.bytes_fetched,
+            "peak_rss_bytes": self.peak_rss,
+            "iterations": self.iterations,
+            "inertia": self.inertia
+        }
+
+class BuildMetrics:
+    """
+    Collect wall time, rows, bytes fetched from the database and peak memory
+    of each phase of a build. A phase lasts until the next one starts, and
+    a TOTAL phase covers the whole build.
+    """
+    def __init__(self, bytes_counter) -> None:
+        self._bytes_counter = bytes_counter
+        self.phases:list = []
+        self.current:PhaseMetrics = None
+        self.total = PhaseMetrics("TOTAL", bytes_counter())
+
+    def start_phase(self, name:str):
+        self.stop_phase()
+        self.current = PhaseMetrics(name, self._bytes_counter())
+        self.phases.append(self.current)
+
+    def stop_phase(self):
+        if (self.current != None):
+            self.current.stop(self._bytes_counter())
+            self.current = None
+
+    def record(self, rows:int = None, iterations:int = None, inertia:float = None):
+        if (self.current == None):
+            return
+        if (rows != None):
+            self.current.rows = rows
+        if (iterations != None):
+            self.current.iterations = iterations
+        if (inertia != None):
+            self.current.inertia = inertia
+
+    def stop(self, rows:int = None):
+        self.stop_phase()
+        self.total.rows = rows
+        self.total.stop(self._bytes_counter())
+
+    def to_list(self) -> list:
+        return [p.to_dict() for p in self.phases + [self.total] if p.elapsed != None]
+
+def _escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels:dict) -> str:
+    if (not labels):
+        return ""
+    return "{" + ",".join(f'{k}="{_escape_label_value(v)}"' for k, v in labels.items()) + "}"
+
+def render_metrics(families:list) -> str:
+    """
+    Render metric families, as (name, type, help, [(labels, value)]) tuples,
+    in the Prometheus text exposition format.
+    """
+    lines = []
+    for name, kind, help, samples in families:
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            if (value == None):
+                continue
+            lines.append(f"{name}{_format_labels(labels)} {value if isinstance(value, int) else repr(float(value))}")
+    return "\n".join(lines) + "\n"
@@ -1,10 +1,21 @@
+import os
 import math
+import uuid
 import logging
 import numpy as np
-from .index import BaseIndex
+from .index import BaseIndex, IndexCancelledException
 from .database import DatabaseEngine, DatabaseEngineException
-from .utils import DataSourceConfig
-from sklearn.cluster import MiniBatchKMeans
+from .assignment import assign_clusters, sum_cosine_distance, AssignmentExecutor
+from .tuning import tune, TuningResult
+from .instrumentation import BuildMetrics
+from .pq import ProductQuantizer, get_default_subspaces_count
+from .sq import ScalarQuantizer
+from .balancing import get_cluster_size_stats, split_cluster
+from .hierarchy import CentroidsHierarchy, build_hierarchy, get_default_top_clusters
+from .model import ModelArtifact, MODEL_FORMAT
+from .spherical import SphericalKMeans
+from .utils import DataSourceConfig, BuildOptions, BuildMode, ClusteringMetric, IndexType, MemoryMappedVectorSet, UpdateResult, StalenessThresholds, prefetch
+from sklearn.cluster import MiniBatchKMeans, kmeans_plusplus
 from sklearn.preprocessing import normalize
 
 _logger = logging.getLogger("uvicorn")
@@ -18,27 +29,77 @@ class KMeansIndexIdMap:
         self.model = model
         self.vectors_count:int = vector_count
         self.dimensions_count:int = dimensions_count
+        self.mean_distance:float = None
+        # Available only when all the vectors have been loaded
+        self.vectors:np.ndarray = None
 
 class KMeansIndex(BaseIndex):
     def __init__(self) -> None:
         super().__init__()
         self.index = None
         self._db:DatabaseEngine = None
+        self._options:BuildOptions = BuildOptions()
+        self._watermark:tuple = (None, None)
+        self._tuning:TuningResult = None
+        self._metrics:BuildMetrics = None
+        self._index_type:IndexType = IndexType.IVFFLAT
+        self._scalar_quantizer:ScalarQuantizer = None
+        self._hierarchy:CentroidsHierarchy = None
+        self._training_count:int = None
+        self._warm_started:bool = False
+        # Status and number of items before the build has been initialized
+        self._previous_state:tuple = None
    
-    def from_config(config:DataSourceConfig):
-        index = KMeansIndex()
+    def _create(index_type:IndexType = None):
+        return KMeansPQIndex() if index_type == IndexType.IVFPQ else KMeansIndex()
+
+    def from_config(config:DataSourceConfig, options:BuildOptions = None):
+        options = options or BuildOptions()
+        index = KMeansIndex._create(options.index_type)
         index._db = DatabaseEngine.from_config(config)
+        index._options = options
         return index
 
-    def from_id(id:int):
-        index = KMeansIndex()
-        index._db = DatabaseEngine.from_id(id)
+    def from_id(id:int, options:BuildOptions = None, index_type:IndexType = None):
+        options = options or BuildOptions()
+        # A failed build can be resumed, so the index doesn't need to be in CREATED state
+        db = DatabaseEngine.from_id(id, created_only=not options.resume)
+        db._index_id = id
+        db.initialize()
+        if (index_type == None):
+            # Existing indexes keep their type, unless a different one is requested when rebuilding
+            stored_type = db.get_index_metadata().index_type
+            index_type = IndexType(stored_type) if stored_type != None else IndexType.IVFFLAT
+        # Options travel with the index to the worker process, which creates it again from them
+        options.index_type = index_type
+        index = KMeansIndex._create(index_type)
+        index._db = db
+        index._options = options
+        index.id = id
         return index
+
+    def _get_staging_path(self) -> str:
+        if (self._options.staging_path == None):
+            return None
+        return os.path.join(self._options.staging_path, f"index-{self.id}")
     
+    def get_existing_id(self) -> int:
+        """
+        Return the id of the index of the same source vector column, if it 
+        has already been created.
+        """
+        self._db.initialize()
+        return self._db.get_index_id()
+
     def initialize_build(self, force: bool)->int:
         id = None
         try:
             self._db.initialize();
+            existing_id = self._db.get_index_id()
+            if (existing_id != None):
+                self._db._index_id = existing_id
+                metadata = self._db.get_index_metadata()
+                self._previous_state = (metadata.status, metadata.item_count)
             id = self._db.create_index_metadata(force)
             self.id = id
             _logger.info(f"Index has id {id}.")
@@ -46,60 +107,705 @@ class KMeansIndex(BaseIndex):
             raise Exception(f"Error initializing index: {str(e)}")
         return id
 
+    def _set_status(self, status:str):
+        # Status changes mark the boundaries between phases, where an operation can be safely cancelled
+        self._check_cancelled()
+        self._db.update_index_metadata(status)
+        self._report_progress(status)
+        if (self._metrics != None):
+            self._metrics.start_phase(status)
+
+    def _record_metrics(self, rows:int = None, iterations:int = None, inertia:float = None):
+        if (self._metrics != None):
+            self._metrics.record(rows, iterations, inertia)
+
+    def get_metrics(self) -> list:
+        return self._metrics.to_list() if self._metrics != None else []
+
+    def attach(self, id:int):
+        """
+        Attach to an index that has already been initialized.
+        """
+        self.id = id
+        self._db._index_id = id
+
+    def get_config(self) -> DataSourceConfig:
+        return self._db.get_config()
+
+    def get_options(self) -> BuildOptions:
+        return self._options
+
+    def estimate_memory_usage(self) -> int:
+        """
+        Estimate the memory needed to build the index, in bytes.
+        """
+        vector_bytes = self._db._vector_dimensions * 4
+        if (self._options.mode == BuildMode.SAMPLED):
+            row_count = self._db.get_source_row_count()
+            sample_size = self._get_train_sample_size(self._get_clusters_count(row_count), row_count)
+            return max(self._options.tune_sample_size, sample_size) * vector_bytes
+        if (self._options.mode == BuildMode.STREAMING or self._options.staging_path != None):
+            return max(self._options.tune_sample_size, 100000) * vector_bytes
+        return self._db.get_source_row_count() * vector_bytes
+
+    def _get_clusters_count(self, vector_count:int) -> int:
+        if (vector_count > 1000000):
+            return int(math.sqrt(vector_count))
+        else:
+            return int(vector_count / 1000) * 2
+
+    def _get_train_sample_size(self, clusters:int, vector_count:int) -> int:
+        return min(vector_count, self._options.train_sample_size or 256 * clusters)
+
+    def _tune_clusters_count(self, sample:np.ndarray, vector_count:int) -> int:
+        """
+        Pick the number of clusters, and the number of probes to recommend, 
+        by measuring recall on the given sample of vectors.
+        """
+        clusters = self._get_clusters_count(vector_count)
+        if (self._options.tune == False):
+            return clusters
+
+        _logger.info(f"Tuning number of clusters and probes...")
+        self._set_status("TUNING")
+        candidates = sorted(set([max(1, int(clusters / 2)), max(1, clusters), max(1, clusters * 2)]))
+        self._tuning = tune(sample, vector_count, candidates, target_recall=self._options.tune_target_recall)
+        self._record_metrics(rows=len(sample))
+        return self._tuning.clusters
+
+    def _get_warm_start_centroids(self, clusters:int) -> np.ndarray:
+        """
+        Return initial centroids taken from the model of the published
+        version, or None if training has to start from k-means++ seeds.
+        """
+        if (self._options.warm_start == False):
+            return None
+        saved = self._db.load_model()
+        if (saved == None):
+            _logger.info("No saved model to warm start from.")
+            return None
+        format, data = saved
+        if (format != MODEL_FORMAT):
+            _logger.info(f"Saved model format {format} is not supported, not warm starting.")
+            return None
+        model = ModelArtifact.from_bytes(data)
+        if (not model.is_compatible(self._db._source_table_fqname, self._db._source_vector_column_name, self._db._vector_dimensions, self._options.clustering_metric)):
+            _logger.info("Saved model has been trained on different data, not warm starting.")
+            return None
+        _logger.info(f"Warm starting {clusters} clusters from the {len(model.centroids)} of the model trained on {model.fingerprint.get('item_count')} rows on {model.fingerprint.get('trained_on')}...")
+        self._warm_started = True
+        return model.get_initial_centroids(clusters)
+
+    def _create_kmeans(self, clusters:int) -> MiniBatchKMeans:
+        init = self._get_warm_start_centroids(clusters)
+        if (self._options.clustering_metric == ClusteringMetric.COSINE):
+            return self._create_spherical_kmeans(clusters, init if init is not None else "k-means++")
+        if (init is not None):
+            return MiniBatchKMeans(init=init, n_clusters=clusters, n_init=1, random_state=0, compute_labels=False)
+        return MiniBatchKMeans(init="k-means++", n_clusters=clusters, n_init=10, random_state=0, compute_labels=False)
+
+    def _create_spherical_kmeans(self, clusters:int, init) -> SphericalKMeans:
+        return SphericalKMeans(clusters, init, random_state=0, workers=self._options.assign_workers, executor=AssignmentExecutor(self._options.assign_executor))
+
+    def _get_model_artifact(self, labels:np.ndarray, centroids:np.ndarray) -> ModelArtifact:
+        """
+        Capture the trained model state, before clusters are balanced and
+        renumbered, so that it can be used to warm start the next build.
+        """
+        model = self.index.model
+        if (model != None):
+            centroids = model.cluster_centers_
+        fingerprint = ModelArtifact.get_fingerprint(self._db._source_table_fqname, self._db._source_vector_column_name, self._db._vector_dimensions, self.index.vectors_count, self._watermark[0])
+        config = {
+            "index_type": self._index_type,
+            "mode": self._options.mode,
+            "clustering_metric": self._options.clustering_metric,
+            "clusters": len(centroids),
+            "training_item_count": self._training_count,
+            "iterations": getattr(model, "n_steps_", None),
+            "warm_started": self._warm_started
+        }
+        return ModelArtifact(centroids, np.bincount(labels, minlength=len(centroids)), config, fingerprint)
+
+    def _assign_clusters(self, vectors:np.ndarray, centroids:np.ndarray):
+        """
+        Return the labels of the nearest centroid and the inertia.
+        """
+        return assign_clusters(vectors, centroids, self._options.assign_workers, AssignmentExecutor(self._options.assign_executor), return_inertia=True)
+
+    def _cluster_in_memory(self):
+        staging = None
+        staging_path = self._get_staging_path()
+        if (self._options.resume and staging_path != None):
+            staging = MemoryMappedVectorSet.open(staging_path, self._db._vector_dimensions)
+
+        if (staging != None):
+            _logger.info(f"Resuming from staged data ({staging.status}) in {staging.path}...")
+            if ("watermark" in staging.properties):
+                watermark_id, watermark_version = staging.properties["watermark"]
+                self._watermark = (watermark_id, bytes.fromhex(watermark_version))
+        else:
+            _logger.info("Loading data...")
+            self._set_status("LOADING_DATA")
+            ids, vectors = self._db.load_vectors_from_db(staging_path, lambda processed, total: self._report_progress(processed=processed, total=total), self._options.load_partitions)
+            self._record_metrics(rows=len(ids))
+            if (staging_path != None):
+                staging = MemoryMappedVectorSet.open(staging_path, self._db._vector_dimensions)
+                staging.set_property("watermark", [self._watermark[0], self._watermark[1].hex()])
+            _logger.info("Done loading data...")
+        
+        if (staging != None):
+            ids = staging.ids
+            vectors = staging.vectors
+
+        if (staging != None and staging.status == "CLUSTERED"):
+            centroids, labels = staging.load_clustering()
+            self.index = KMeansIndexIdMap(ids, None, staging.count, staging.vector_dimensions)
+            self.index.vectors = vectors
+            self.index.mean_distance = sum_cosine_distance(vectors, centroids, labels) / max(staging.count, 1)
+            return labels, centroids, staging
+
+        nvp = np.asarray(vectors)
+        vector_count:int = np.shape(nvp)[0]
+        dimensions_count:int = np.shape(nvp)[1]
+        sample_size = min(vector_count, self._options.tune_sample_size)
+        sample = nvp[np.sort(np.random.default_rng(0).choice(vector_count, sample_size, replace=False))] if self._options.tune else None
+        clusters = self._tune_clusters_count(sample, vector_count)
+        del sample
+
+        _logger.info("Creating kmeans model...")
+        self._set_status("KMEANS_CLUSTERING")
+        _logger.info(f"Determining {clusters} clusters...")        
+        kmeans = self._create_kmeans(clusters)
+        kmeans.fit(nvp)
+        self._training_count = vector_count
+        self._record_metrics(rows=vector_count, iterations=kmeans.n_steps_)
+        self.index = KMeansIndexIdMap(ids, kmeans, vector_count, dimensions_count)
+        self.index.vectors = nvp
+        _logger.info(f"Done creating kmeans model ({type(kmeans)}).") 
+
+        self._set_status("ASSIGNING_CLUSTERS")
+        labels, inertia = self._assign_clusters(nvp, kmeans.cluster_centers_)
+        self._record_metrics(rows=vector_count, inertia=inertia)
+        centroids = normalize(kmeans.cluster_centers_)
+        self.index.mean_distance = sum_cosine_distance(nvp, centroids, labels) / max(vector_count, 1)
+        if (staging != None):
+            staging.save_clustering(centroids, labels)
+        
+        return labels, centroids, staging
+
+    def _cluster_streaming(self):
+        vector_count = self._db.get_source_row_count()
+        dimensions_count = self._db._vector_dimensions
+        if (self._options.tune):
+            _, sample = self._db.load_sample_vectors_from_db(min(vector_count, self._options.tune_sample_size), vector_count)
+            clusters = self._tune_clusters_count(sample, vector_count)
+            del sample
+        else:
+            clusters = self._get_clusters_count(vector_count)
+
+        seeds = self._get_warm_start_centroids(clusters)
+        if (seeds is None):
+            _logger.info(f"Seeding {clusters} clusters from a sample...")
+            self._set_status("SEEDING_CLUSTERS")
+            _, sample = self._db.load_sample_vectors_from_db(min(vector_count, max(clusters * 10, 10000)), vector_count)
+            seeds, _ = kmeans_plusplus(sample, n_clusters=clusters, random_state=0)
+            self._record_metrics(rows=len(sample))
+            del sample
+
+        _logger.info(f"Streaming vectors into kmeans model...")
+        self._set_status("KMEANS_CLUSTERING")
+        if (self._options.clustering_metric == ClusteringMetric.COSINE):
+            kmeans = self._create_spherical_kmeans(clusters, seeds)
+        else:
+            kmeans = MiniBatchKMeans(init=seeds, n_clusters=clusters, n_init=1, random_state=0)
+        tr = 0
+        for _, vectors in prefetch(self._db.iterate_vectors_from_db()):
+            self._check_cancelled()
+            kmeans.partial_fit(vectors)
+            tr += len(vectors)
+            self._report_progress(processed=tr, total=vector_count)
+            _logger.info(f"Trained on {tr} rows...")
+        self._training_count = tr
+        self._record_metrics(rows=tr, iterations=getattr(kmeans, "n_steps_", 0))
+
+        _logger.info(f"Done creating kmeans model ({type(kmeans)}).") 
+        return self._assign_streaming(kmeans, vector_count)
+
+    def _cluster_sampled(self):
+        """
+        Train centroids on a sample of the source table, whose size doesn't
+        depend on the table size, and then stream the whole table to assign
+        each vector to its cluster.
+        """
+        vector_count = self._db.get_source_row_count()
+        if (self._options.tune):
+            _, sample = self._db.load_sample_vectors_from_db(min(vector_count, self._options.tune_sample_size), vector_count)
+            clusters = self._tune_clusters_count(sample, vector_count)
+            del sample
+        else:
+            clusters = self._get_clusters_count(vector_count)
+
+        sample_size = self._get_train_sample_size(clusters, vector_count)
+        _logger.info(f"Sampling {sample_size} of {vector_count} rows to train {clusters} clusters...")
+        self._set_status("SAMPLING_DATA")
+        _, sample = self._db.load_sample_vectors_from_db(sample_size, vector_count)
+        self._record_metrics(rows=len(sample))
+
+        self._set_status("KMEANS_CLUSTERING")
+        clusters = max(1, min(clusters, len(sample)))
+        kmeans = self._create_kmeans(clusters)
+        kmeans.fit(sample)
+        self._training_count = len(sample)
+        self._record_metrics(rows=len(sample), iterations=kmeans.n_steps_)
+        _logger.info(f"Trained {clusters} clusters on {len(sample)} rows ({100.0 * len(sample) / max(vector_count, 1):.2f}% of the table).")
+        del sample
+
+        return self._assign_streaming(kmeans, vector_count)
+
+    def _assign_streaming(self, kmeans:MiniBatchKMeans, vector_count:int):
+        _logger.info(f"Streaming vectors to assign clusters...")
+        self._set_status("ASSIGNING_CLUSTERS")
+        centroids = normalize(kmeans.cluster_centers_)
+        ids_batches = []
+        labels_batches = []
+        distance_sum = 0.0
+        inertia = 0.0
+        for ids, vectors in prefetch(self._db.iterate_vectors_from_db()):
+            self._check_cancelled()
+            labels, batch_inertia = self._assign_clusters(vectors, kmeans.cluster_centers_)
+            inertia += batch_inertia
+            distance_sum += sum_cosine_distance(vectors, centroids, labels)
+            ids_batches.append(ids)
+            labels_batches.append(labels)
+            self._report_progress(processed=sum(len(b) for b in ids_batches), total=vector_count)
+        ids = np.concatenate(ids_batches) if ids_batches else np.empty((0), dtype=np.int32)
+        labels = np.concatenate(labels_batches) if labels_batches else np.empty((0), dtype=np.int32)
+        _logger.info(f"Assigned {len(ids)} rows to clusters.")
+        self._record_metrics(rows=len(ids), inertia=inertia)
+
+        self.index = KMeansIndexIdMap(ids, kmeans, len(ids), self._db._vector_dimensions)
+        self.index.mean_distance = distance_sum / max(len(ids), 1)
+        return labels, centroids, None
+
     def build(self):
         if (self.id == None):
             raise Exception("Index has not been initialized.")
         
+        self._metrics = BuildMetrics(lambda: self._db.bytes_fetched)
+        build_status = "ERROR_DURING_CREATION"
         try:
             self.index = None
             
-            _logger.info(f"Starting creating IVFFLAT index...")
+            _logger.info(f"Starting creating {self._index_type.upper()} index ({self._options.mode} mode, {self._options.clustering_metric} clustering)...")
+            self._db.normalize_vectors = (self._options.clustering_metric == ClusteringMetric.COSINE)
 
-            _logger.info("Loading data...")
-            self._db.update_index_metadata("LOADING_DATA")
-            ids, vectors = self._db.load_vectors_from_db()
-            _logger.info("Done loading data...")
-            
-            _logger.info("Creating kmeans model...")
-            self._db.update_index_metadata("KMEANS_CLUSTERING")
-            nvp = np.asarray(vectors)
-            vector_count:int = np.shape(nvp)[0]
-            dimensions_count:int = np.shape(nvp)[1]
-            if (vector_count > 1000000):
-                clusters = int(math.sqrt(vector_count))
+            # Captured before reading data, so that changes happening during the build are picked up by the next update
+            self._watermark = self._db.get_source_watermark()
+            # Searches keep using the published version until the new one is finalized
+            self._db.begin_version()
+
+            if (self._options.mode == BuildMode.STREAMING):
+                labels, nc, staging = self._cluster_streaming()
+            elif (self._options.mode == BuildMode.SAMPLED):
+                labels, nc, staging = self._cluster_sampled()
             else:
-                clusters = int(vector_count / 1000) * 2
-            _logger.info(f"Determining {clusters} clusters...")        
-            kmeans = MiniBatchKMeans(init="k-means++", n_clusters=clusters, n_init=10, random_state=0)             
-            kmeans.fit(nvp)
-            self.index = KMeansIndexIdMap(ids, kmeans, vector_count, dimensions_count)
-            
-            _logger.info(f"Done creating kmeans model ({type(kmeans)}).") 
+                labels, nc, staging = self._cluster_in_memory()
+            ids = self.index.ids
+            model = self._get_model_artifact(labels, nc)
+            labels, nc = self._balance_clusters(ids, labels, nc)
+            labels, nc = self._build_hierarchy(labels, nc)
+            size_stats = get_cluster_size_stats(labels, len(nc))
+            _logger.info(f"Cluster sizes: max {size_stats['max_size']}, mean {size_stats['mean_size']:.1f}, p99 {size_stats['p99_size']}.")
             
+            codes = self._encode_items(ids, labels, nc)
+            sq_vectors = self._quantize_items(ids)
+
             _logger.info(f"Saving centroids index #{self.id}...")
-            self._db.update_index_metadata("SAVING_CENTROIDS")
-            centroids = self.index.model.cluster_centers_
-            nc = normalize(centroids)
-            self._db.save_clusters_centroids(nc)        
+            self._set_status("SAVING_CENTROIDS")
+            self._db.save_clusters_centroids(nc, self._options.save_workers, self._hierarchy.parents if self._hierarchy != None else None)        
+            if (self._hierarchy != None):
+                self._db.save_top_clusters_centroids(self._hierarchy.top_centroids, self._hierarchy.first_cluster_ids, self._hierarchy.last_cluster_ids)
+            else:
+                self._db.save_top_clusters_centroids(None)
+            self._record_metrics(rows=len(nc))
             _logger.info(f"Done saving centroids index #{self.id}...")
 
             _logger.info(f"Saving centroids elements ({len(ids)}) index #{self.id}...")        
-            self._db.update_index_metadata("SAVING_CENTROIDS_ELEMENTS")
-            ids = self.index.ids
-            labels = self.index.model.labels_
-            self._db.save_clusters_items(ids, labels)
+            self._set_status("SAVING_CENTROIDS_ELEMENTS")
+            self._db.save_clusters_items(ids, labels, self._options.save_workers, codes, sq_vectors)
+            self._record_metrics(rows=len(ids))
             _logger.info(f"Done saving centroids elements index #{self.id}...")
 
             _logger.info(f"Creating similarity function...")
-            self._db.update_index_metadata("CREATING_SIMILARITY_FUNCTION")
-            self._db.create_similarity_function()
+            self._set_status("CREATING_SIMILARITY_FUNCTION")
+            self._create_similarity_function()
             _logger.info(f"Done creating similarity function.")
             
             _logger.info(f"Finalizing index #{self.id} metadata...")
-            self._db.finalize_index_metadata(self.index.vectors_count)
+            self._db.finalize_index_metadata(self.index.vectors_count, self._watermark, self.index.mean_distance, self._tuning, self._index_type, self._get_pq_subspaces(), self._scalar_quantizer, self._get_top_clusters(), size_stats, self._training_count, (MODEL_FORMAT, model.to_bytes()))
             _logger.info(f"Done finalizing metadata.")
 
-            _logger.info(f"IVFFLAT Index #{self.id} created.")
+            if (staging != None):
+                _logger.info(f"Removing staged data from {staging.path}...")
+                staging.remove()
+
+            _logger.info(f"{self._index_type.upper()} Index #{self.id} created.")
+            build_status = "CREATED"
+        except IndexCancelledException as e:
+            build_status = "CANCELLED"
+            self._discard_build("CANCELLED")
+            raise e
         except Exception as e:  
-            self._db.update_index_metadata("ERROR_DURING_CREATION")
-            raise e    
\ No newline at end of file
+            self._discard_build("ERROR_DURING_CREATION")
+            raise e
+        finally:
+            self._save_metrics(build_status)
+
+    def _load_vectors_at(self, ids:np.ndarray, positions:np.ndarray):
+        """
+        Return the vectors of the items at the given positions, and the 
+        positions that have been found, streaming them again from the 
+        database if vectors are not in memory.
+        """
+        if (self.index.vectors is not None):
+            return positions, np.asarray(self.index.vectors[positions], dtype=np.float32)
+
+        wanted = ids[positions]
+        order = np.argsort(wanted)
+        sorted_ids = wanted[order]
+        found_positions = []
+        found_vectors = []
+        for batch_ids, batch_vectors in prefetch(self._db.iterate_vectors_from_db()):
+            self._check_cancelled()
+            found = np.searchsorted(sorted_ids, batch_ids).clip(0, max(len(sorted_ids) - 1, 0))
+            known = sorted_ids[found] == batch_ids
+            found_positions.append(positions[order[found[known]]])
+            found_vectors.append(batch_vectors[known])
+        if (not found_positions):
+            return positions[:0], np.empty((0, self._db._vector_dimensions), dtype=np.float32)
+        return np.concatenate(found_positions), np.concatenate(found_vectors)
+
+    def _balance_clusters(self, ids:np.ndarray, labels:np.ndarray, centroids:np.ndarray):
+        """
+        Split the clusters larger than max_cluster_size_ratio times the mean
+        size, so that the number of rows read by each probe is bounded. 
+        Split clusters keep their id for one of the parts, and the others 
+        are added at the end.
+        """
+        ratio = self._options.max_cluster_size_ratio
+        if (ratio == None or len(centroids) == 0):
+            return labels, centroids
+
+        sizes = np.bincount(labels, minlength=len(centroids))
+        mean_size = len(labels) / len(centroids)
+        max_size = max(1, math.ceil(ratio * mean_size))
+        oversized = np.flatnonzero(sizes > max_size)
+        if (len(oversized) == 0):
+            _logger.info(f"No cluster is larger than {max_size} items.")
+            return labels, centroids
+
+        _logger.info(f"Splitting {len(oversized)} clusters larger than {max_size} items...")
+        self._set_status("BALANCING_CLUSTERS")
+        positions, vectors = self._load_vectors_at(ids, np.flatnonzero(np.isin(labels, oversized)))
+        labels = np.array(labels, dtype=np.int32)
+        centroids = np.array(centroids, dtype=np.float32)
+        distance_before = sum_cosine_distance(vectors, centroids, labels[positions])
+        new_centroids = [centroids]
+        next_id = len(centroids)
+        for c in oversized:
+            members = labels[positions] == c
+            part_labels, part_centroids = split_cluster(vectors[members], mean_size, max_size)
+            # The first part keeps the id of the cluster
+            part_ids = np.concatenate([[c], np.arange(next_id, next_id + len(part_centroids) - 1)]).astype(np.int32)
+            labels[positions[members]] = part_ids[part_labels]
+            new_centroids[0][c] = part_centroids[0]
+            new_centroids.append(part_centroids[1:])
+            next_id += len(part_centroids) - 1
+        centroids = np.concatenate(new_centroids)
+        distance_after = sum_cosine_distance(vectors, centroids, labels[positions])
+        self.index.mean_distance += (distance_after - distance_before) / max(len(labels), 1)
+        self._record_metrics(rows=len(positions))
+        _logger.info(f"Split {len(oversized)} clusters into {len(centroids) - len(sizes) + len(oversized)} clusters.")
+        return labels, centroids
+
+    def _build_hierarchy(self, labels:np.ndarray, centroids:np.ndarray):
+        """
+        Cluster the centroids into a top layer, if there are enough of them,
+        so that the similarity function doesn't compare queries with all of 
+        them. Clusters are renumbered, so the new labels and centroids are 
+        returned.
+        """
+        top_clusters = self._options.top_clusters if self._options.top_clusters != None else get_default_top_clusters(len(centroids))
+        if (top_clusters <= 0 or top_clusters >= len(centroids)):
+            return labels, centroids
+
+        _logger.info(f"Clustering {len(centroids)} centroids into {top_clusters} top centroids...")
+        self._set_status("CLUSTERING_CENTROIDS")
+        self._hierarchy = build_hierarchy(centroids, top_clusters)
+        self._record_metrics(rows=len(centroids))
+        order = np.argsort(self._hierarchy.mapping)
+        return self._hierarchy.mapping[labels], centroids[order]
+
+    def _get_top_clusters(self) -> int:
+        return len(self._hierarchy.top_centroids) if self._hierarchy != None else None
+
+    def _get_training_sample(self, sample_size:int):
+        """
+        Return a sample of the vectors and their positions in the index, if 
+        vectors are in memory, otherwise a sample read from the database.
+        """
+        vector_count = self.index.vectors_count
+        sample_size = min(vector_count, sample_size)
+        if (self.index.vectors is not None):
+            positions = np.sort(np.random.default_rng(0).choice(vector_count, sample_size, replace=False))
+            return np.asarray(self.index.vectors[positions]), positions
+        _, sample = self._db.load_sample_vectors_from_db(sample_size, vector_count)
+        return sample, None
+
+    def _encode_all(self, ids:np.ndarray, code_size:int, encode) -> np.ndarray:
+        """
+        Encode the vectors of all the items with encode(vectors, positions), 
+        in chunks if vectors are in memory, otherwise streaming them again 
+        from the database and matching them to their position by id.
+        """
+        vector_count = len(ids)
+        vectors = self.index.vectors
+        # Items deleted from the source table since clustering keep empty codes
+        codes = np.zeros((vector_count, code_size), dtype=np.uint8)
+        chunk_size = 50000
+        if (vectors is not None):
+            for s in range(0, vector_count, chunk_size):
+                self._check_cancelled()
+                positions = np.arange(s, min(s + chunk_size, vector_count))
+                codes[positions] = encode(vectors[s:s + chunk_size], positions)
+                self._report_progress(processed=positions[-1] + 1, total=vector_count)
+        else:
+            order = np.argsort(ids)
+            sorted_ids = ids[order]
+            encoded = 0
+            for batch_ids, batch_vectors in prefetch(self._db.iterate_vectors_from_db()):
+                self._check_cancelled()
+                found = np.searchsorted(sorted_ids, batch_ids).clip(0, max(vector_count - 1, 0))
+                known = sorted_ids[found] == batch_ids
+                positions = order[found[known]]
+                codes[positions] = encode(batch_vectors[known], positions)
+                encoded += len(positions)
+                self._report_progress(processed=encoded, total=vector_count)
+        self._record_metrics(rows=vector_count)
+        return codes
+
+    def _encode_items(self, ids:np.ndarray, labels:np.ndarray, centroids:np.ndarray) -> np.ndarray:
+        """
+        Return the codes to be saved with each item, if the index type needs any.
+        """
+        return None
+
+    def _quantize_items(self, ids:np.ndarray) -> np.ndarray:
+        """
+        Return the scalar quantized copy of the normalized vectors of all the 
+        items, if enabled, used by the search API to rank candidates.
+        """
+        if (self._options.scalar_quantization == None):
+            return None
+
+        _logger.info(f"Quantizing {len(ids)} vectors to {self._options.scalar_quantization}...")
+        self._set_status("QUANTIZING_VECTORS")
+        self._scalar_quantizer = ScalarQuantizer(self._options.scalar_quantization)
+        if (self._scalar_quantizer.requires_training()):
+            sample, _ = self._get_training_sample(self._options.sq_train_size)
+            self._scalar_quantizer.train(normalize(sample))
+            del sample
+        code_size = self._scalar_quantizer.get_code_size(self._db._vector_dimensions)
+        return self._encode_all(ids, code_size, lambda vectors, _: self._scalar_quantizer.encode(normalize(np.asarray(vectors, dtype=np.float32))))
+
+    def _encode_vectors(self, vectors:np.ndarray, labels:np.ndarray, centroids:np.ndarray) -> np.ndarray:
+        return None
+
+    def _get_pq_subspaces(self) -> int:
+        return None
+
+    def _create_similarity_function(self):
+        self._db.create_similarity_function(self._get_top_clusters())
+
+    def _save_metrics(self, build_status:str):
+        self._metrics.stop(self.index.vectors_count if self.index != None else None)
+        for phase in self._metrics.to_list():
+            _logger.info(f"Phase {phase['phase']} took {phase['elapsed_seconds']:.3f} sec, rows: {phase['rows']}, bytes fetched: {phase['bytes_fetched']}, peak RSS: {int(phase['peak_rss_bytes'] / 1024 / 1024)} MB")
+        try:
+            self._db.save_build_history(str(uuid.uuid4()), build_status, self._options.mode, self._metrics.to_list())
+        except Exception as e:
+            # Losing the history of a build is not a reason to fail it
+            _logger.warning(f"Unable to save build history of index #{self.id}: {e}")
+
+    def _discard_build(self, status:str):
+        # Searches keep using the published version, if any, so the index stays usable
+        if (self._db.discard_version() == False):
+            self._db.update_index_metadata(status)
+
+    def recover(self, method:str, cancelled:bool, started:bool = True):
+        if (method != "build"):
+            self._db.update_index_metadata("CREATED")
+        elif (self._db.discard_version()):
+            return
+        elif (self._previous_state != None and (started == False or self._previous_state[0] == "CREATED")):
+            # Nothing has been done yet, or the index that was there before is still usable
+            self._db.restore_index_metadata(*self._previous_state)
+        else:
+            self._db.update_index_metadata("CANCELLED" if cancelled else "ERROR_DURING_CREATION")
+
+    def update(self) -> UpdateResult:
+        """
+        Incrementally maintain the index: vectors inserted or updated since the
+        last build or update are assigned to the existing centroids, and 
+        deleted rows are removed from the clusters.
+        """
+        self._db.initialize()
+        metadata = self._db.get_index_metadata()
+        if (metadata.status != "CREATED"):
+            return UpdateResult.INDEX_NOT_READY
+        if (metadata.watermark_id == None):
+            _logger.info(f"Index #{self.id} has no watermark and must be rebuilt.")
+            return UpdateResult.INDEX_IS_STALE
+
+        from_watermark = (int(metadata.watermark_id), bytes(metadata.watermark_version) if metadata.watermark_version != None else None)
+        to_watermark = self._db.get_source_watermark()
+
+        _logger.info(f"Updating index #{self.id}...")
+        self._set_status("UPDATING")
+        try:
+            centroids = self._db.load_clusters_centroids()
+            if (metadata.scalar_quantization != None):
+                self._scalar_quantizer = ScalarQuantizer.from_json(metadata.scalar_quantization, metadata.scalar_quantization_params)
+
+            deleted_count = self._db.delete_removed_clusters_items()
+            _logger.info(f"Removed {deleted_count} deleted items.")
+
+            assigned_count = 0
+            distance_sum = 0.0
+            for ids, vectors in prefetch(self._db.iterate_changed_vectors_from_db(from_watermark, to_watermark)):
+                self._check_cancelled()
+                # Centroids are normalized, so vectors must be normalized too to find the nearest one
+                labels, _ = self._assign_clusters(normalize(vectors), centroids)
+                distance_sum += sum_cosine_distance(vectors, centroids, labels)
+                sq_vectors = self._scalar_quantizer.encode(normalize(vectors)) if self._scalar_quantizer != None else None
+                self._db.upsert_clusters_items(ids, labels, self._encode_vectors(vectors, labels, centroids), sq_vectors)
+                assigned_count += len(ids)
+                _logger.info(f"Assigned {assigned_count} changed items...")
+                self._report_progress(processed=assigned_count)
+
+            self._db.finalize_index_update(to_watermark, assigned_count + deleted_count, assigned_count, distance_sum)
+        except Exception as e:
+            # Each batch is committed atomically and the watermark is moved only at the end, so the update can be retried
+            self._db.update_index_metadata("CREATED")
+            raise e
+
+        if (assigned_count + deleted_count == 0):
+            _logger.info(f"No changes found for index #{self.id}.")
+            return UpdateResult.NO_CHANGES
+
+        if (assigned_count > 0 and metadata.baseline_distance):
+            drift = (distance_sum / assigned_count) / metadata.baseline_distance
+            _logger.info(f"Mean distance to centroid of changed items is {drift:.2f}x the one at build time.")
+        _logger.info(f"Index #{self.id} updated: {assigned_count} items assigned, {deleted_count} items removed.")
+        return UpdateResult.DONE
+
+    def rollback(self) -> int:
+        """
+        Switch the index back to the version published before the current
+        one, and return its number.
+        """
+        self._db.initialize()
+        return self._db.rollback_version()
+
+    def get_staleness(self) -> dict:
+        """
+        Return indicators of how much the index deviates from the data it has 
+        been built on: fraction of rows changed since the build, size of the 
+        largest cluster compared to the mean one (and the size of the largest
+        and the 99th percentile cluster), and mean distance to centroid 
+        of vectors added afterwards compared to the one at build time.
+        """
+        self._db.initialize()
+        metadata = self._db.get_index_metadata()
+        item_count = max(int(metadata.item_count or 0), 1)
+
+        pending_count = 0
+        if (metadata.watermark_id != None):
+            watermark = (int(metadata.watermark_id), bytes(metadata.watermark_version) if metadata.watermark_version != None else None)
+            pending_count = self._db.count_source_changes(watermark)
+        changed_fraction = (int(metadata.changed_item_count or 0) + pending_count) / item_count
+
+        sizes = self._db.get_clusters_size_stats()
+        # Sizes are not returned when the index has no items
+        imbalance = float(sizes.max_size) / float(sizes.mean_size) if sizes != None and sizes.mean_size else None
+
+        distance_ratio = None
+        if (metadata.recent_distance != None and metadata.baseline_distance):
+            distance_ratio = float(metadata.recent_distance) / float(metadata.baseline_distance)
+
+        return {
+            "index_id": self.id,
+            "updated_on": metadata.updated_on,
+            "changed_fraction": changed_fraction,
+            "pending_item_count": pending_count,
+            "imbalance": imbalance,
+            "max_cluster_size": int(sizes.max_size) if sizes != None else None,
+            "p99_cluster_size": int(sizes.p99_size) if sizes != None else None,
+            "distance_ratio": distance_ratio
+        }
+
+    def is_stale(staleness:dict, thresholds:StalenessThresholds) -> bool:
+        return (
+            staleness["changed_fraction"] > thresholds.changed_fraction or
+            (staleness["imbalance"] != None and staleness["imbalance"] > thresholds.imbalance) or
+            (staleness["distance_ratio"] != None and staleness["distance_ratio"] > thresholds.distance_ratio)
+        )
+
+class KMeansPQIndex(KMeansIndex):
+    """
+    IVF-PQ index: on top of clustering, the residual of each vector from its
+    centroid is product quantized, and the resulting codes are stored with 
+    the cluster items, so that candidates can be ranked without reading the 
+    source vectors.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self._index_type = IndexType.IVFPQ
+        self._pq:ProductQuantizer = None
+        self._pq_subspaces:int = None
+
+    def _get_pq_subspaces(self) -> int:
+        return self._pq_subspaces
+
+    def _get_residuals(self, vectors:np.ndarray, labels:np.ndarray, centroids:np.ndarray) -> np.ndarray:
+        # Centroids are normalized, and the search function compares normalized queries, so vectors are normalized too
+        return normalize(np.asarray(vectors, dtype=np.float32)) - centroids[labels]
+
+    def _encode_items(self, ids:np.ndarray, labels:np.ndarray, centroids:np.ndarray) -> np.ndarray:
+        self._pq_subspaces = self._options.pq_subspaces or get_default_subspaces_count(self._db._vector_dimensions)
+
+        _logger.info(f"Training product quantizer with {self._pq_subspaces} subspaces...")
+        self._set_status("TRAINING_PQ")
+        sample, positions = self._get_training_sample(self._options.pq_train_size)
+        sample_labels = labels[positions] if positions is not None else np.argmax(normalize(sample) @ centroids.T, axis=1)
+        self._pq = ProductQuantizer(self._pq_subspaces).train(self._get_residuals(sample, sample_labels, centroids))
+        self._record_metrics(rows=len(sample))
+        del sample
+
+        _logger.info(f"Encoding {len(ids)} vectors...")
+        self._set_status("ENCODING_PQ")
+        codes = self._encode_all(ids, self._pq_subspaces, lambda vectors, positions: self._encode_vectors(vectors, labels[positions], centroids))
+
+        self._db.save_pq_codebooks(self._pq.codebooks)
+        return codes
+
+    def _encode_vectors(self, vectors:np.ndarray, labels:np.ndarray, centroids:np.ndarray) -> np.ndarray:
+        if (self._pq == None):
+            metadata = self._db.get_index_metadata()
+            self._pq_subspaces = metadata.pq_subspaces
+            self._pq = ProductQuantizer(self._pq_subspaces, self._db.load_pq_codebooks(self._pq_subspaces))
+        return self._pq.encode(self._get_residuals(vectors, labels, centroids))
+
+    def _create_similarity_function(self):
+        self._db.create_pq_similarity_function(self._pq_subspaces, self._get_top_clusters())
@@ -0,0 +1,78 @@
+import io
+import json
+import datetime
+import numpy as np
+
+MODEL_FORMAT = 'npz-v1'
+
+class ModelArtifact:
+    """
+    Trained k-means model state: the centroids as trained, before they are
+    normalized, balanced or renumbered, the number of vectors assigned to
+    each of them, the build configuration and a fingerprint of the data
+    the model has been trained on. Saved as a compressed npz archive.
+    """
+    def __init__(self, centroids:np.ndarray, counts:np.ndarray, config:dict = None, fingerprint:dict = None) -> None:
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.config = config or {}
+        self.fingerprint = fingerprint or {}
+
+    def from_bytes(data:bytes):
+        with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+            return ModelArtifact(
+                archive["centroids"],
+                archive["counts"],
+                json.loads(str(archive["config"])),
+                json.loads(str(archive["fingerprint"]))
+            )
+
+    def to_bytes(self) -> bytes:
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer,
+            centroids=self.centroids,
+            counts=self.counts,
+            config=np.array(json.dumps(self.config, default=str)),
+            fingerprint=np.array(json.dumps(self.fingerprint, default=str))
+        )
+        return buffer.getvalue()
+
+    def get_fingerprint(source_table:str, vector_column:str, vector_dimensions:int, item_count:int, watermark_id:int = None) -> dict:
+        return {
+            "source_table": source_table,
+            "vector_column": vector_column,
+            "dimensions": vector_dimensions,
+            "item_count": item_count,
+            "watermark_id": watermark_id,
+            "trained_on": datetime.datetime.now().isoformat()
+        }
+
+    def is_compatible(self, source_table:str, vector_column:str, vector_dimensions:int, clustering_metric:str) -> bool:
+        """
+        Return True if the model has been trained on the same column, with the
+        same clustering metric: euclidean centroids are not unit vectors, and
+        spherical ones are not means, so they can't seed the other kind.
+        """
+        return (
+            str(self.config.get("clustering_metric")) == str(clustering_metric) and
+            self.fingerprint.get("source_table") == source_table and
+            self.fingerprint.get("vector_column") == vector_column and
+            self.centroids.ndim == 2 and self.centroids.shape[1] == vector_dimensions
+        )
+
+    def get_initial_centroids(self, clusters:int, random_state:int = 0) -> np.ndarray:
+        """
+        Return clusters centroids to start training from. When fewer clusters
+        are needed, the most populated ones are kept; when more are needed,
+        the most populated ones are split, adding a slightly perturbed copy
+        of their centroid that training moves apart.
+        """
+        order = np.argsort(-self.counts, kind="stable")
+        if (clusters <= len(self.centroids)):
+            return self.centroids[np.sort(order[:clusters])].copy()
+
+        rng = np.random.default_rng(random_state)
+        extra = self.centroids[np.resize(order, clusters - len(self.centroids))]
+        scale = 1e-3 * np.linalg.norm(extra, axis=1, keepdims=True) / np.sqrt(self.centroids.shape[1])
+        extra = extra + rng.standard_normal(extra.shape).astype(np.float32) * scale
+        return np.concatenate([self.centroids, extra.astype(np.float32)])
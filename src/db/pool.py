@@ -0,0 +1,171 @@
+import os
+import time
+import struct
+import logging
+import threading
+import pyodbc
+from azure import identity
+from azure.core import credentials
+
+_logger = logging.getLogger("uvicorn")
+
+SQL_COPT_SS_ACCESS_TOKEN = 1256  # This connection option is defined by microsoft in msodbcsql.h
+
+class ConnectionPoolException(Exception):
+    pass
+
+class PooledConnection:
+    """
+    Wraps a pyodbc connection so that closing it returns it to the pool.
+    """
+    def __init__(self, pool, conn:pyodbc.Connection, expires_on:float) -> None:
+        self._pool = pool
+        self._conn = conn
+        self.expires_on = expires_on
+        self.last_used_on = time.time()
+        self.closed = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if (self.closed == False):
+            self.closed = True
+            self._pool.release(self)
+
+class ConnectionPool:
+    def __init__(self, max_size:int = 10, idle_check_seconds:int = 30, token_refresh_margin_seconds:int = 300, acquire_timeout_seconds:int = 60) -> None:
+        self.max_size = max_size
+        self.idle_check_seconds = idle_check_seconds
+        self.token_refresh_margin_seconds = token_refresh_margin_seconds
+        self.acquire_timeout_seconds = acquire_timeout_seconds
+        self._idle:list = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._credential = None
+        self._token:credentials.AccessToken = None
+        self.hits = 0
+        self.misses = 0
+        self.discarded = 0
+        self.token_refreshes = 0
+
+    def _use_sql_authentication(self, connection_string:str) -> bool:
+        return any(s in connection_string.lower() for s in ["uid"])
+
+    def _get_token(self) -> credentials.AccessToken:
+        with self._lock:
+            # Refresh the token shortly before it expires, so that it is never used when already expired
+            if (self._token != None and self._token.expires_on - self.token_refresh_margin_seconds < time.time()):
+                _logger.info('Token is about to expire. Refreshing...')
+                self._token = None
+
+            if (self._token == None):
+                if (self._credential == None):
+                    _logger.info('Getting EntraID credentials...')
+                    self._credential = identity.DefaultAzureCredential(exclude_interactive_browser_credential=False)
+                self._token = self._credential.get_token("https://database.windows.net/.default")
+                self.token_refreshes += 1
+
+            return self._token
+
+    def _connect(self) -> PooledConnection:
+        _logger.debug('Connecting to MSSQL...')
+
+        mssql_connection_string = os.environ["MSSQL"]
+
+        if self._use_sql_authentication(mssql_connection_string):
+            _logger.debug('Using SQL Server authentication')
+            attrs_before = None
+            expires_on = float("inf")
+        else:
+            token = self._get_token()
+            token_bytes = token.token.encode("UTF-16-LE")
+            token_struct = struct.pack(f'<I{len(token_bytes)}s', len(token_bytes), token_bytes)
+            attrs_before = {SQL_COPT_SS_ACCESS_TOKEN: token_struct}
+            expires_on = token.expires_on
+
+        _logger.debug('Connecting...')
+        conn = pyodbc.connect(mssql_connection_string, attrs_before=attrs_before)
+
+        return PooledConnection(self, conn, expires_on)
+
+    def _is_healthy(self, conn:PooledConnection) -> bool:
+        if (conn.expires_on - self.token_refresh_margin_seconds < time.time()):
+            return False
+        if (time.time() - conn.last_used_on < self.idle_check_seconds):
+            return True
+        try:
+            conn._conn.execute("select 1").fetchval()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def _discard(self, conn:PooledConnection):
+        self.discarded += 1
+        try:
+            conn._conn.close()
+        except pyodbc.Error:
+            pass
+
+    def acquire(self) -> PooledConnection:
+        if (self._slots.acquire(timeout=self.acquire_timeout_seconds) == False):
+            raise ConnectionPoolException(f"No connection available after {self.acquire_timeout_seconds} seconds.")
+
+        try:
+            while(True):
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if (conn == None):
+                    break
+                if (self._is_healthy(conn)):
+                    with self._lock:
+                        self.hits += 1
+                    conn.closed = False
+                    return conn
+                self._discard(conn)
+
+            with self._lock:
+                self.misses += 1
+            return self._connect()
+        except:
+            self._slots.release()
+            raise
+
+    def release(self, conn:PooledConnection):
+        try:
+            # Make sure nothing left pending by the caller leaks to the next user
+            conn._conn.rollback()
+            conn.last_used_on = time.time()
+            with self._lock:
+                self._idle.append(conn)
+        except pyodbc.Error:
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.max_size,
+                "idle": len(self._idle),
+                "hits": self.hits,
+                "misses": self.misses,
+                "discarded": self.discarded,
+                "token_refreshes": self.token_refreshes
+            }
+
+_pool:ConnectionPool = None
+_pool_lock = threading.Lock()
+
+def get_connection_pool() -> ConnectionPool:
+    global _pool
+    with _pool_lock:
+        if (_pool == None):
+            _pool = ConnectionPool(max_size=int(os.environ.get("KMEANS_POOL_SIZE", 10)))
+        return _pool
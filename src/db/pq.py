@@ -0,0 +1,65 @@
+import time
+import logging
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from .assignment import get_nearest_centroids
+
+_logger = logging.getLogger("uvicorn")
+
+# Codes are stored as one byte per subspace
+PQ_CODEBOOK_SIZE = 256
+
+def get_default_subspaces_count(vector_dimensions:int) -> int:
+    """
+    Return the divisor of vector_dimensions closest to one subspace every 
+    16 dimensions (for example 96 one byte codes for 1536 dimensions).
+    """
+    target = max(1, vector_dimensions // 16)
+    divisors = [m for m in range(1, vector_dimensions + 1) if vector_dimensions % m == 0]
+    return min(divisors, key=lambda m: (abs(m - target), m))
+
+class ProductQuantizer:
+    """
+    Split vectors in subspaces of consecutive dimensions and quantize each
+    subspace independently with its own codebook of up to 256 centroids, so
+    that each vector is encoded as one byte per subspace.
+    """
+    def __init__(self, subspaces:int, codebooks:np.ndarray = None) -> None:
+        self.subspaces = subspaces
+        self.codebooks = codebooks
+
+    def _get_subspace(self, vectors:np.ndarray, j:int) -> np.ndarray:
+        size = vectors.shape[1] // self.subspaces
+        return vectors[:, j * size:(j + 1) * size]
+
+    def train(self, vectors:np.ndarray, random_state:int = 0):
+        if (vectors.shape[1] % self.subspaces != 0):
+            raise ValueError(f"Vector dimensions ({vectors.shape[1]}) must be a multiple of the number of subspaces ({self.subspaces}).")
+        start = time.perf_counter()
+        codebook_size = min(PQ_CODEBOOK_SIZE, len(vectors))
+        self.codebooks = np.empty((self.subspaces, codebook_size, vectors.shape[1] // self.subspaces), dtype=np.float32)
+        for j in range(self.subspaces):
+            kmeans = MiniBatchKMeans(init="k-means++", n_clusters=codebook_size, n_init=1, random_state=random_state, compute_labels=False)
+            kmeans.fit(np.ascontiguousarray(self._get_subspace(vectors, j)))
+            self.codebooks[j] = kmeans.cluster_centers_
+        _logger.info(f"Trained {self.subspaces} codebooks of {codebook_size} centroids on {len(vectors)} vectors in {time.perf_counter() - start:.3f} sec.")
+        return self
+
+    def encode(self, vectors:np.ndarray, chunk_size:int = 50000) -> np.ndarray:
+        codes = np.empty((len(vectors), self.subspaces), dtype=np.uint8)
+        for s in range(0, len(vectors), chunk_size):
+            chunk = np.asarray(vectors[s:s + chunk_size], dtype=np.float32)
+            for j in range(self.subspaces):
+                codes[s:s + chunk_size, j] = get_nearest_centroids(np.ascontiguousarray(self._get_subspace(chunk, j)), self.codebooks[j])
+        return codes
+
+    def decode(self, codes:np.ndarray) -> np.ndarray:
+        return np.concatenate([self.codebooks[j][codes[:, j]] for j in range(self.subspaces)], axis=1)
+
+    def get_lookup_tables(self, queries:np.ndarray) -> np.ndarray:
+        """
+        Return, for each query, subspace and code, the dot product of the 
+        query with the codebook centroid: the dot product of a query with an 
+        encoded vector is the sum of the entries selected by its codes.
+        """
+        return np.stack([self._get_subspace(queries, j) @ self.codebooks[j].T for j in range(self.subspaces)], axis=1)
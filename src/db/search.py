@@ -0,0 +1,265 @@
+import os
+import time
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from .database import DatabaseEngine, DatabaseEngineException
+from .sq import ScalarQuantizer
+from .utils import normalize_rows
+
+_logger = logging.getLogger("uvicorn")
+
+class IvfSearchIndex:
+    """
+    In-memory inverted file of an index: normalized centroids and, sorted by
+    cluster, the ids (and optionally the normalized vectors) of all items,
+    so that the items of a cluster are a contiguous range of the arrays.
+    If the index has been built with scalar quantization, the quantized 
+    vectors are kept instead, and used to find candidates that are then 
+    re-ranked using their exact distance.
+    """
+    def __init__(self, db:DatabaseEngine, centroids:np.ndarray, offsets:np.ndarray, ids:np.ndarray, vectors:np.ndarray, version:tuple, recommended_probes:int = None, quantizer:ScalarQuantizer = None) -> None:
+        self.db = db
+        self.centroids = centroids
+        self.offsets = offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.version = version
+        self.recommended_probes = recommended_probes
+        self.quantizer = quantizer
+        self.loaded_on = time.time()
+        self.checked_on = self.loaded_on
+
+    def from_db(db:DatabaseEngine, with_vectors:bool, version:tuple, recommended_probes:int = None, quantizer:ScalarQuantizer = None):
+        start = time.perf_counter()
+        quantizer = quantizer if with_vectors else None
+        centroids = normalize_rows(db.load_clusters_centroids())
+        labels, ids, vectors = db.load_clusters_items(with_vectors, quantized=quantizer != None)
+
+        order = np.argsort(labels, kind="stable")
+        ids = ids[order]
+        if (quantizer != None):
+            # Quantized vectors have been normalized before being quantized
+            vectors = vectors[order]
+        elif (vectors is not None):
+            vectors = normalize_rows(vectors[order])
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=len(centroids)), out=offsets[1:])
+
+        index = IvfSearchIndex(db, centroids, offsets, ids, vectors, version, recommended_probes, quantizer)
+        _logger.info(f"Loaded {len(ids)} items in {len(centroids)} clusters{' with vectors' if vectors is not None else ''}{f' ({quantizer.kind})' if quantizer != None else ''} in {time.perf_counter() - start:.3f} sec ({int(index.get_memory_usage() / 1024 / 1024)} MB).")
+        return index
+
+    def get_memory_usage(self) -> int:
+        return self.centroids.nbytes + self.offsets.nbytes + self.ids.nbytes + (self.vectors.nbytes if self.vectors is not None else 0)
+
+    def _prepare_queries(self, queries:np.ndarray) -> np.ndarray:
+        queries = np.array(queries, dtype=np.float32, ndmin=2)
+        if (queries.shape[1] != self.centroids.shape[1]):
+            raise ValueError(f"Query vectors must have {self.centroids.shape[1]} dimensions.")
+        return normalize_rows(queries)
+
+    def probe(self, queries:np.ndarray, probes:int) -> np.ndarray:
+        """
+        Return, for each query, the probes clusters with the closest centroids,
+        computing all the similarities with a single matrix product.
+        """
+        probes = max(1, min(probes, len(self.centroids)))
+        scores = queries @ self.centroids.T
+        if (probes == len(self.centroids)):
+            return np.tile(np.arange(probes), (len(queries), 1))
+        return np.argpartition(-scores, probes - 1, axis=1)[:, :probes]
+
+    def _get_clusters(self, clusters:np.ndarray) -> dict:
+        """
+        Return the ids and normalized vectors of the items of each of the 
+        given clusters. Cached vectors are returned as views, otherwise the
+        vectors of all the clusters are read from the source table at once.
+        """
+        if (self.vectors is not None):
+            return {c: (self.ids[self.offsets[c]:self.offsets[c + 1]], self.vectors[self.offsets[c]:self.offsets[c + 1]]) for c in clusters}
+
+        positions = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in clusters])
+        ids, vectors = self.db.load_vectors_by_ids(self.ids[positions])
+        vectors = normalize_rows(vectors)
+        # Items deleted from the source table since the last update are not returned
+        order = np.argsort(ids, kind="stable")
+        ids, vectors = ids[order], vectors[order]
+        result = {}
+        for c in clusters:
+            wanted = self.ids[self.offsets[c]:self.offsets[c + 1]]
+            found = np.searchsorted(ids, wanted).clip(0, max(len(ids) - 1, 0))
+            found = found[ids[found] == wanted] if len(ids) > 0 else found[:0]
+            result[c] = (ids[found], vectors[found])
+        return result
+
+    def _rerank(self, queries:np.ndarray, candidate_ids:np.ndarray, k:int, max_distance:float = None):
+        """
+        Return the k nearest candidates of each query by exact distance, 
+        reading the vectors of all the candidates from the source table at once.
+        """
+        ids, vectors = self.db.load_vectors_by_ids(np.unique(candidate_ids[candidate_ids >= 0]))
+        vectors = normalize_rows(vectors)
+        order = np.argsort(ids, kind="stable")
+        ids, vectors = ids[order], vectors[order]
+
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        best_distances = np.full((len(queries), k), np.inf, dtype=np.float32)
+        if (len(ids) == 0):
+            return best_ids, best_distances
+        for i, (query, candidates) in enumerate(zip(queries, candidate_ids)):
+            found = np.searchsorted(ids, candidates).clip(0, len(ids) - 1)
+            known = (candidates >= 0) & (ids[found] == candidates)
+            distances = 1 - vectors[found[known]] @ query
+            if (max_distance != None):
+                distances[distances > max_distance] = np.inf
+            top = np.argsort(distances, kind="stable")[:k]
+            best_ids[i, :len(top)] = candidates[known][top]
+            best_distances[i, :len(top)] = distances[top]
+        return best_ids, best_distances
+
+    def search(self, queries:np.ndarray, k:int, probes:int, max_distance:float = None, rerank:int = None) -> list:
+        """
+        Return, for each query, the ids of the k nearest items found in the
+        probed clusters and their cosine distance, nearest first.
+
+        Queries are grouped by probed cluster, so that each cluster is read 
+        once and compared with all the queries probing it with a single 
+        matrix product, keeping a running top k for each query.
+
+        With quantized vectors, the best rerank candidates (4 * k by default)
+        are kept instead, and then re-ranked by exact distance. If rerank is
+        0, the approximate distances are returned.
+        """
+        queries = self._prepare_queries(queries)
+        probed = self.probe(queries, probes)
+        quantized = self.quantizer != None and self.vectors is not None
+        rerank = (rerank if rerank != None else 4 * k) if quantized else 0
+        candidates_count = max(k, rerank)
+        best_ids = np.full((len(queries), candidates_count), -1, dtype=np.int64)
+        best_distances = np.full((len(queries), candidates_count), np.inf, dtype=np.float32)
+
+        query_positions = np.repeat(np.arange(len(queries)), probed.shape[1])
+        probed_clusters = probed.ravel()
+        order = np.argsort(probed_clusters, kind="stable")
+        clusters, starts = np.unique(probed_clusters[order], return_index=True)
+        groups = np.split(query_positions[order], starts[1:])
+
+        blocks = self._get_clusters(clusters)
+        for c, group in zip(clusters, groups):
+            ids, vectors = blocks[c]
+            if (len(ids) == 0):
+                continue
+            distances = 1 - (self.quantizer.score(queries[group], vectors) if quantized else queries[group] @ vectors.T)
+            # Approximate distances are not filtered, as they could be above max_distance when the exact ones are not
+            if (max_distance != None and rerank == 0):
+                distances[distances > max_distance] = np.inf
+            if (distances.shape[1] > candidates_count):
+                top = np.argpartition(distances, candidates_count - 1, axis=1)[:, :candidates_count]
+                distances = np.take_along_axis(distances, top, axis=1)
+                candidates = ids[top]
+            else:
+                candidates = np.broadcast_to(ids, distances.shape)
+            merged_distances = np.concatenate([best_distances[group], distances], axis=1)
+            merged_ids = np.concatenate([best_ids[group], candidates], axis=1)
+            top = np.argpartition(merged_distances, candidates_count - 1, axis=1)[:, :candidates_count]
+            best_distances[group] = np.take_along_axis(merged_distances, top, axis=1)
+            best_ids[group] = np.take_along_axis(merged_ids, top, axis=1)
+
+        if (rerank > 0):
+            best_ids, best_distances = self._rerank(queries, best_ids, k, max_distance)
+        elif (candidates_count > k):
+            top = np.argpartition(best_distances, k - 1, axis=1)[:, :k]
+            best_ids, best_distances = np.take_along_axis(best_ids, top, axis=1), np.take_along_axis(best_distances, top, axis=1)
+
+        results = []
+        for ids, distances in zip(best_ids, best_distances):
+            found = np.isfinite(distances)
+            ids, distances = ids[found], distances[found]
+            order = np.argsort(distances, kind="stable")
+            results.append((ids[order], distances[order]))
+        return results
+
+class SearchIndexCache:
+    """
+    Keep the in-memory inverted files of the most recently searched indexes,
+    evicting the least recently used ones when the memory budget is exceeded.
+    Cached indexes are checked against the index metadata at most every
+    check_seconds, and reloaded if the index has been rebuilt or updated.
+    """
+    def __init__(self, memory_budget:int = 1024 * 1024 * 1024, cache_vectors:bool = True, check_seconds:int = 30) -> None:
+        self.memory_budget = memory_budget
+        self.cache_vectors = cache_vectors
+        self.check_seconds = check_seconds
+        self._entries:OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def from_environment():
+        memory_budget = int(os.environ.get("KMEANS_SEARCH_CACHE_MB", 1024)) * 1024 * 1024
+        cache_vectors = os.environ.get("KMEANS_SEARCH_CACHE_VECTORS", "true").lower() in ["true", "1", "yes"]
+        check_seconds = int(os.environ.get("KMEANS_SEARCH_CACHE_CHECK_SECONDS", 30))
+        return SearchIndexCache(memory_budget, cache_vectors, check_seconds)
+
+    def _get_version(self, metadata) -> tuple:
+        return (metadata.updated_on, metadata.watermark_id, bytes(metadata.watermark_version) if metadata.watermark_version != None else None)
+
+    def get(self, index_id:int) -> IvfSearchIndex:
+        with self._lock:
+            index = self._entries.get(index_id)
+            if (index != None):
+                self._entries.move_to_end(index_id)
+                if (time.time() - index.checked_on < self.check_seconds):
+                    self.hits += 1
+                    return index
+
+        db = DatabaseEngine.from_id(index_id, created_only=False)
+        metadata = db.get_index_metadata()
+        version = self._get_version(metadata)
+        # While the index is being rebuilt, the cached one is still usable
+        if (index != None and (index.version == version or metadata.status != "CREATED")):
+            index.checked_on = time.time()
+            with self._lock:
+                self.hits += 1
+            return index
+        # and so is the published version, that is replaced only when the new one is complete
+        if (metadata.status != "CREATED" and metadata.version == None):
+            raise DatabaseEngineException(f"Index #{index_id} is not ready ({metadata.status}).")
+
+        _logger.info(f"Loading index #{index_id} for search...")
+        quantizer = ScalarQuantizer.from_json(metadata.scalar_quantization, metadata.scalar_quantization_params) if metadata.scalar_quantization != None else None
+        index = IvfSearchIndex.from_db(db, self.cache_vectors, version, metadata.recommended_probes, quantizer)
+        with self._lock:
+            self.misses += 1
+            self._entries[index_id] = index
+            self._entries.move_to_end(index_id)
+            self._evict()
+        return index
+
+    def _evict(self):
+        used = sum(i.get_memory_usage() for i in self._entries.values())
+        # The most recently used index is kept even if it doesn't fit alone
+        while (used > self.memory_budget and len(self._entries) > 1):
+            index_id, index = self._entries.popitem(last=False)
+            used -= index.get_memory_usage()
+            self.evictions += 1
+            _logger.info(f"Evicted index #{index_id} from search cache.")
+
+    def invalidate(self, index_id:int):
+        with self._lock:
+            if (self._entries.pop(index_id, None) != None):
+                _logger.info(f"Invalidated index #{index_id} in search cache.")
+
+    def get_status(self) -> dict:
+        with self._lock:
+            return {
+                "indexes": [{"index_id": id, "items": len(i.ids), "clusters": len(i.centroids), "scalar_quantization": i.quantizer.kind if i.quantizer != None else None, "memory_mb": int(i.get_memory_usage() / 1024 / 1024)} for id, i in self._entries.items()],
+                "memory_budget_mb": int(self.memory_budget / 1024 / 1024),
+                "cache_vectors": self.cache_vectors,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
@@ -0,0 +1,83 @@
+import time
+import logging
+import numpy as np
+from scipy import sparse
+from sklearn.cluster import kmeans_plusplus
+from .assignment import assign_clusters, AssignmentExecutor
+from .utils import normalize_rows
+
+_logger = logging.getLogger("uvicorn")
+
+def _sum_by_label(vectors:np.ndarray, labels:np.ndarray, clusters:int) -> np.ndarray:
+    one_hot = sparse.csr_matrix((np.ones(len(labels), dtype=np.float32), (labels, np.arange(len(labels)))), shape=(clusters, len(labels)))
+    return np.asarray(one_hot @ vectors, dtype=np.float32)
+
+class SphericalKMeans:
+    """
+    K-means on the unit sphere, for vectors normalized to unit length: each
+    vector goes to the centroid with the highest dot product, that is the
+    highest cosine similarity, and each centroid is the normalized sum of
+    its vectors. Exposes the subset of the MiniBatchKMeans interface used
+    by builds: fit, partial_fit, cluster_centers_ and n_steps_.
+    """
+    def __init__(self, n_clusters:int, init = "k-means++", max_iter:int = 30, tol:float = 1e-3, random_state:int = 0, workers:int = None, executor:AssignmentExecutor = AssignmentExecutor.THREAD) -> None:
+        self.n_clusters = n_clusters
+        self.init = init
+        self.max_iter = max_iter
+        self.tol = tol
+        self.random_state = random_state
+        self.workers = workers
+        self.executor = executor
+        self.cluster_centers_:np.ndarray = None
+        self.n_steps_:int = 0
+        self._sums:np.ndarray = None
+
+    def _init_centroids(self, vectors:np.ndarray) -> np.ndarray:
+        if (isinstance(self.init, str)):
+            # Seeds are picked from a sample, as k-means++ makes a pass over its input for each of them
+            rng = np.random.default_rng(self.random_state)
+            sample_size = min(len(vectors), max(self.n_clusters * 10, 10000))
+            sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+            centroids, _ = kmeans_plusplus(sample, n_clusters=self.n_clusters, random_state=self.random_state)
+        else:
+            centroids = np.array(self.init, dtype=np.float32)
+        return normalize_rows(centroids.astype(np.float32))
+
+    def _assign(self, vectors:np.ndarray) -> np.ndarray:
+        # With unit centroids ||c||^2 is the same for all of them, so the nearest centroid is the one with the highest dot product
+        return assign_clusters(vectors, self.cluster_centers_, self.workers, self.executor)
+
+    def fit(self, vectors:np.ndarray):
+        start = time.perf_counter()
+        self.cluster_centers_ = self._init_centroids(vectors)
+        labels = None
+        for i in range(self.max_iter):
+            new_labels = self._assign(vectors)
+            changed = len(new_labels) if labels is None else int(np.count_nonzero(new_labels != labels))
+            labels = new_labels
+            sums = _sum_by_label(vectors, labels, self.n_clusters)
+            # Empty clusters keep their centroid
+            empty = ~np.any(sums, axis=1)
+            sums[empty] = self.cluster_centers_[empty]
+            self.cluster_centers_ = normalize_rows(sums)
+            self.n_steps_ = i + 1
+            _logger.info(f"Spherical k-means iteration {i + 1}: {changed} vectors changed cluster.")
+            if (changed <= self.tol * len(vectors)):
+                break
+        _logger.info(f"Spherical k-means converged in {self.n_steps_} iterations and {time.perf_counter() - start:.3f} sec.")
+        return self
+
+    def partial_fit(self, vectors:np.ndarray):
+        """
+        Update centroids with a batch of vectors: the sums of the vectors
+        assigned to each centroid are accumulated over batches, so that each
+        centroid is the normalized mean of all the vectors seen so far.
+        """
+        if (self.cluster_centers_ is None):
+            self.cluster_centers_ = self._init_centroids(vectors)
+            self._sums = self.cluster_centers_.copy()
+        labels = self._assign(vectors)
+        self._sums += _sum_by_label(vectors, labels, self.n_clusters)
+        self.cluster_centers_ = normalize_rows(self._sums.copy())
+        self.n_steps_ += 1
+        return self
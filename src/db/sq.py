@@ -0,0 +1,68 @@
+import json
+import numpy as np
+from enum import StrEnum
+
+class ScalarQuantization(StrEnum):
+    INT8 = 'int8'
+    FLOAT16 = 'float16'
+
+class ScalarQuantizer:
+    """
+    Compress vectors to one byte per dimension (int8, mapping the range of
+    values of each dimension to 256 steps) or two bytes per dimension
+    (float16). Encoded vectors are stored as unsigned bytes, so that they
+    can be saved as they are into a varbinary column.
+    """
+    def __init__(self, kind:ScalarQuantization, minimums:np.ndarray = None, scales:np.ndarray = None) -> None:
+        self.kind = ScalarQuantization(kind)
+        self.minimums = minimums
+        self.scales = scales
+
+    def from_json(kind:str, params:str):
+        quantizer = ScalarQuantizer(kind)
+        if (params != None):
+            params = json.loads(params)
+            quantizer.minimums = np.array(params["minimums"], dtype=np.float32)
+            quantizer.scales = np.array(params["scales"], dtype=np.float32)
+        return quantizer
+
+    def to_json(self) -> str:
+        if (self.minimums is None):
+            return None
+        return json.dumps({"minimums": self.minimums.tolist(), "scales": self.scales.tolist()})
+
+    def get_code_size(self, vector_dimensions:int) -> int:
+        return vector_dimensions * (1 if self.kind == ScalarQuantization.INT8 else 2)
+
+    def requires_training(self) -> bool:
+        # float16 is a plain cast, only int8 needs the range of each dimension
+        return self.kind == ScalarQuantization.INT8
+
+    def train(self, vectors:np.ndarray):
+        if (self.kind == ScalarQuantization.INT8):
+            self.minimums = np.min(vectors, axis=0).astype(np.float32)
+            self.scales = ((np.max(vectors, axis=0) - self.minimums) / 255).astype(np.float32)
+            self.scales[self.scales == 0] = 1
+        return self
+
+    def encode(self, vectors:np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if (self.kind == ScalarQuantization.FLOAT16):
+            return np.ascontiguousarray(vectors.astype(np.float16)).view(np.uint8)
+        # Values out of the trained range, as those of vectors added after the build, are clipped
+        return np.clip(np.rint((vectors - self.minimums) / self.scales), 0, 255).astype(np.uint8)
+
+    def decode(self, codes:np.ndarray) -> np.ndarray:
+        if (self.kind == ScalarQuantization.FLOAT16):
+            return np.ascontiguousarray(codes).view(np.float16).astype(np.float32)
+        return codes.astype(np.float32) * self.scales + self.minimums
+
+    def score(self, queries:np.ndarray, codes:np.ndarray) -> np.ndarray:
+        """
+        Return the dot products between queries and encoded vectors. For int8,
+        q.(m + s * c) = q.m + (q * s).c, so scales and offsets are applied
+        to the queries only.
+        """
+        if (self.kind == ScalarQuantization.FLOAT16):
+            return queries @ self.decode(codes).T
+        return (queries * self.scales) @ codes.T.astype(np.float32) + (queries @ self.minimums)[:, None]
@@ -0,0 +1,98 @@
+import time
+import logging
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.preprocessing import normalize
+from .assignment import assign_clusters
+
+_logger = logging.getLogger("uvicorn")
+
+class TuningResult:
+    def __init__(self, clusters:int, probes:int, recall:float, report:list) -> None:
+        self.clusters = clusters
+        self.probes = probes
+        self.recall = recall
+        self.report = report
+
+def exact_top_k(queries:np.ndarray, vectors:np.ndarray, k:int, chunk_size:int = 100000) -> np.ndarray:
+    """
+    Return the positions of the k vectors most similar to each query, using
+    cosine similarity, scanning vectors in chunks.
+    """
+    queries = normalize(queries)
+    best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    best_ids = np.zeros((len(queries), k), dtype=np.int64)
+    for s in range(0, len(vectors), chunk_size):
+        chunk = normalize(np.asarray(vectors[s:s + chunk_size], dtype=np.float32))
+        chunk_scores = queries @ chunk.T
+        chunk_top = np.argpartition(-chunk_scores, min(k, len(chunk)) - 1, axis=1)[:, :k]
+        scores = np.concatenate([best_scores, np.take_along_axis(chunk_scores, chunk_top, axis=1)], axis=1)
+        ids = np.concatenate([best_ids, chunk_top + s], axis=1)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+    return best_ids
+
+def tune(vectors:np.ndarray, vector_count:int, candidate_clusters:list, probes:list = [1, 2, 4, 8, 16, 32, 64], k:int = 10, queries_count:int = 200, target_recall:float = 0.9, random_state:int = 0) -> TuningResult:
+    """
+    Sweep the candidate cluster counts and probes, measuring recall@k against
+    exact search and the expected number of rows scanned per query.
+
+    vectors can be a sample of the vector_count vectors in the table: each
+    candidate is trained on the sample with its actual number of clusters,
+    so that recall is measured for the probes that will be used on the full
+    table, and the rows scanned on the sample are scaled to the full table.
+    """
+    rng = np.random.default_rng(random_state)
+    queries_count = min(queries_count, max(len(vectors) // 10, 1))
+    positions = rng.permutation(len(vectors))
+    queries = np.asarray(vectors[positions[:queries_count]], dtype=np.float32)
+    base = np.asarray(vectors[np.sort(positions[queries_count:])], dtype=np.float32)
+    scale = max(vector_count, 1) / len(base)
+
+    _logger.info(f"Tuning on {len(base)} vectors and {len(queries)} held out queries...")
+    truth = exact_top_k(queries, base, k)
+    normalized_queries = normalize(queries)
+
+    report = []
+    for clusters in candidate_clusters:
+        sample_clusters = max(1, min(clusters, len(base)))
+        if (sample_clusters < clusters):
+            _logger.info(f"Sample too small to evaluate {clusters} clusters, evaluating {sample_clusters} clusters instead.")
+        start = time.perf_counter()
+        kmeans = MiniBatchKMeans(init="k-means++", n_clusters=sample_clusters, n_init=1, random_state=random_state, compute_labels=False)
+        kmeans.fit(base)
+        labels = assign_clusters(base, kmeans.cluster_centers_, workers=1)
+        sizes = np.bincount(labels, minlength=sample_clusters)
+        # Probes are ranked like the similarity function does, by cosine distance to normalized centroids
+        ranking = np.argsort(-(normalized_queries @ normalize(kmeans.cluster_centers_).T), axis=1)
+        truth_labels = labels[truth]
+        elapsed = time.perf_counter() - start
+
+        for p in probes:
+            if (p > sample_clusters):
+                break
+            probed = ranking[:, :p]
+            found = (truth_labels[:, :, None] == probed[:, None, :]).any(axis=2)
+            recall = float(found.mean())
+            scanned_rows = float(sizes[probed].sum(axis=1).mean()) * scale
+            scanned_fraction = scanned_rows / max(vector_count, 1)
+            report.append({
+                "clusters": int(clusters),
+                "probes": int(p),
+                "recall": recall,
+                "scanned_rows": int(scanned_rows),
+                "scanned_fraction": scanned_fraction
+            })
+            _logger.info(f"Clusters: {clusters}, probes: {p}, recall@{k}: {recall:.3f}, expected scanned rows: {int(scanned_rows)}")
+        _logger.info(f"Evaluated {clusters} clusters in {elapsed:.3f} sec.")
+
+    good = [r for r in report if r["recall"] >= target_recall]
+    if (good):
+        best = min(good, key=lambda r: (r["scanned_rows"], r["probes"]))
+    else:
+        _logger.info(f"No configuration reached a recall of {target_recall}, using the one with the best recall.")
+        best = max(report, key=lambda r: (r["recall"], -r["scanned_rows"]))
+
+    _logger.info(f"Recommended configuration: {best['clusters']} clusters, {best['probes']} probes (recall@{k}: {best['recall']:.3f}).")
+    return TuningResult(best["clusters"], best["probes"], best["recall"], report)
@@ -1,6 +1,10 @@
+import os
 import json
+import queue
+import threading
 import numpy as np
 from enum import StrEnum, Enum
+from .sq import ScalarQuantization
 
 class DataSourceConfig:
     source_table_schema:str
@@ -8,7 +12,84 @@ class DataSourceConfig:
     source_id_column_name:str
     source_vector_column_name:str
     vector_dimensions:int
+
+class BuildMode(StrEnum):
+    FULL = 'full'
+    STREAMING = 'streaming'
+    SAMPLED = 'sampled'
+
+class ClusteringMetric(StrEnum):
+    EUCLIDEAN = 'euclidean'
+    COSINE = 'cosine'
+
+class IndexType(StrEnum):
+    IVFFLAT = 'ivfflat'
+    IVFPQ = 'ivfpq'
+
+class BuildOptions:
+    mode:BuildMode = BuildMode.FULL
+    # Cosine normalizes vectors while loading them and runs spherical k-means
+    clustering_metric:ClusteringMetric = ClusteringMetric.EUCLIDEAN
+    # Type of new indexes, existing ones keep theirs when rebuilt
+    index_type:IndexType = IndexType.IVFFLAT
+    pq_subspaces:int = None
+    pq_train_size:int = 100000
+    scalar_quantization:ScalarQuantization = None
+    sq_train_size:int = 100000
+    # Rows used to train centroids in sampled mode, 256 per cluster when not set
+    train_sample_size:int = None
+    # Number of id ranges loaded in parallel, each on its own connection, one per core by default
+    load_partitions:int = os.cpu_count() or 1
+    # Clusters larger than this multiple of the mean size are split
+    max_cluster_size_ratio:float = None
+    # Number of top centroids of a two-level index: 0 disables it, when not set it depends on the number of clusters
+    top_clusters:int = None
+    # Start training from the centroids of the model saved by the previous build
+    warm_start:bool = False
+    staging_path:str = None
+    resume:bool = False
+    assign_workers:int = None
+    assign_executor:str = 'thread'
+    save_workers:int = 4
+    tune:bool = False
+    tune_target_recall:float = 0.9
+    tune_sample_size:int = 100000
+
+    def from_environment():
+        options = BuildOptions()
+        options.mode = BuildMode(os.environ.get("KMEANS_BUILD_MODE", BuildMode.FULL))
+        options.clustering_metric = ClusteringMetric(os.environ.get("KMEANS_CLUSTERING_METRIC", ClusteringMetric.EUCLIDEAN))
+        options.index_type = IndexType(os.environ.get("KMEANS_INDEX_TYPE", IndexType.IVFFLAT))
+        options.pq_subspaces = int(os.environ["KMEANS_PQ_SUBSPACES"]) if "KMEANS_PQ_SUBSPACES" in os.environ else None
+        options.pq_train_size = int(os.environ.get("KMEANS_PQ_TRAIN_SIZE", 100000))
+        options.train_sample_size = int(os.environ["KMEANS_TRAIN_SAMPLE_SIZE"]) if "KMEANS_TRAIN_SAMPLE_SIZE" in os.environ else None
+        options.load_partitions = int(os.environ.get("KMEANS_LOAD_PARTITIONS", os.cpu_count() or 1))
+        options.max_cluster_size_ratio = float(os.environ["KMEANS_MAX_CLUSTER_SIZE_RATIO"]) if "KMEANS_MAX_CLUSTER_SIZE_RATIO" in os.environ else None
+        options.top_clusters = int(os.environ["KMEANS_TOP_CLUSTERS"]) if "KMEANS_TOP_CLUSTERS" in os.environ else None
+        options.scalar_quantization = ScalarQuantization(os.environ["KMEANS_SCALAR_QUANTIZATION"]) if "KMEANS_SCALAR_QUANTIZATION" in os.environ else None
+        options.sq_train_size = int(os.environ.get("KMEANS_SQ_TRAIN_SIZE", 100000))
+        options.warm_start = os.environ.get("KMEANS_WARM_START", "false").lower() == "true"
+        options.staging_path = os.environ.get("KMEANS_STAGING_PATH", None)
+        options.assign_workers = int(os.environ["KMEANS_ASSIGN_WORKERS"]) if "KMEANS_ASSIGN_WORKERS" in os.environ else None
+        options.assign_executor = os.environ.get("KMEANS_ASSIGN_EXECUTOR", 'thread')
+        options.save_workers = int(os.environ.get("KMEANS_SAVE_WORKERS", 4))
+        options.tune = os.environ.get("KMEANS_TUNE", "false").lower() == "true"
+        options.tune_target_recall = float(os.environ.get("KMEANS_TUNE_TARGET_RECALL", 0.9))
+        options.tune_sample_size = int(os.environ.get("KMEANS_TUNE_SAMPLE_SIZE", 100000))
+        return options
     
+class StalenessThresholds:
+    changed_fraction:float = 0.2
+    imbalance:float = 10.0
+    distance_ratio:float = 1.5
+
+    def from_environment():
+        thresholds = StalenessThresholds()
+        thresholds.changed_fraction = float(os.environ.get("KMEANS_STALE_CHANGED_FRACTION", 0.2))
+        thresholds.imbalance = float(os.environ.get("KMEANS_STALE_IMBALANCE", 10.0))
+        thresholds.distance_ratio = float(os.environ.get("KMEANS_STALE_DISTANCE_RATIO", 1.5))
+        return thresholds
+
 class IndexStatus(StrEnum):
     INITIALIZING = 'initializing'
     NOT_READY = 'not ready'
@@ -47,28 +128,253 @@ class NpEncoder(json.JSONEncoder):
             return obj.tolist()
         return super(NpEncoder, self).default(obj)
 
-class Buffer:
-    def __init__(self):
-        self.ids = []
-        self.vectors = []
-             
-    def add(self, id, vector):
-        self.ids.append(id)
-        self.vectors.append(vector)
+# Native vector binary format: 8 bytes header (magic 0xA9, version, 
+# dimensions count, base type, reserved) followed by little-endian float32 values
+VECTOR_BINARY_MAGIC = 0xA9
+VECTOR_BINARY_HEADER_SIZE = 8
+
+class VectorFormat(StrEnum):
+    BINARY = 'binary'
+    JSON = 'json'
 
-    def clear(self):
-        self.ids.clear()
-        self.vectors.clear()
+def normalize_rows(vectors:np.ndarray) -> np.ndarray:
+    """
+    Scale each row to unit length in place, leaving rows of zeros as they are.
+    """
+    norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+    norms[norms == 0] = 1
+    vectors /= norms[:, None]
+    return vectors
+
+def decode_vectors_binary(values:list, vector_dimensions:int, out:np.ndarray) -> np.ndarray:
+    row_size = VECTOR_BINARY_HEADER_SIZE + vector_dimensions * 4
+    data = b"".join(values)
+    if (len(data) != len(values) * row_size):
+        raise ValueError(f"Binary vectors do not have the expected {vector_dimensions} dimensions.")
+    if (np.any(np.frombuffer(data, dtype=np.uint8)[::row_size] != VECTOR_BINARY_MAGIC)):
+        raise ValueError("Unexpected vector binary format.")
+    rows = np.frombuffer(data, dtype='<f4').reshape(len(values), row_size // 4)
+    out[:] = rows[:, VECTOR_BINARY_HEADER_SIZE // 4:]
+    return out
+
+def decode_vectors_json(values:list, vector_dimensions:int, out:np.ndarray) -> np.ndarray:
+    text = ",".join(values).replace("[", "").replace("]", "")
+    flat = np.fromstring(text, dtype=np.float32, sep=",")
+    if (flat.size != len(values) * vector_dimensions):
+        raise ValueError(f"JSON vectors do not have the expected {vector_dimensions} dimensions.")
+    out[:] = flat.reshape(len(values), vector_dimensions)
+    return out
+
+def prefetch(iterable, depth:int = 2):
+    """
+    Iterate over iterable in a background thread, keeping at most depth 
+    items ready, so that producing the next item overlaps with consuming 
+    the current one.
+    """
+    items = queue.Queue(maxsize=depth)
+    done = object()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if (stop.is_set()):
+                    break
+                items.put(item)
+            items.put(done)
+        except BaseException as e:
+            items.put(e)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while(True):
+            item = items.get()
+            if (item is done):
+                break
+            if (isinstance(item, BaseException)):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # Unblock the producer if it is waiting on a full queue
+        while (producer.is_alive()):
+            try:
+                items.get(timeout=0.1)
+            except queue.Empty:
+                pass
 
 class VectorSet:
-    def __init__(self, vector_dimensions:int):
-        self.ids = np.empty((0), dtype=np.int32)
-        self.vectors = np.empty((0, vector_dimensions), dtype=np.float32)      
+    _GROWTH_FACTOR = 1.5
+
+    def __init__(self, vector_dimensions:int, capacity:int = 0):
+        self.count = 0
+        self.vector_dimensions = vector_dimensions
+        self._allocate(capacity)
+        self._peak_memory_usage = self.get_memory_usage()
+
+    def _allocate(self, capacity:int):
+        self.ids = np.empty((capacity), dtype=np.int32)
+        self.vectors = np.empty((capacity, self.vector_dimensions), dtype=np.float32)      
              
-    def add(self, buffer:Buffer):
-        self.ids = np.append(self.ids, np.asarray(buffer.ids), 0)
-        self.vectors = np.append(self.vectors, np.asarray(buffer.vectors, dtype=np.float32), 0)          
+    def add(self, ids:np.ndarray, vectors:np.ndarray):
+        n = len(ids)
+        if (self.count + n > len(self.ids)):
+            self._grow(self.count + n)
+        self.ids[self.count:self.count + n] = ids
+        self.vectors[self.count:self.count + n] = vectors
+        self.count += n
+
+    def _grow(self, required_capacity:int):
+        capacity = max(required_capacity, int(len(self.ids) * self._GROWTH_FACTOR))
+        ids = np.empty((capacity), dtype=np.int32)
+        vectors = np.empty((capacity, self.vector_dimensions), dtype=np.float32)
+        ids[:self.count] = self.ids[:self.count]
+        vectors[:self.count] = self.vectors[:self.count]
+        # Old and new buffers are both alive while copying
+        self._peak_memory_usage = max(self._peak_memory_usage, self.get_memory_usage() + ids.nbytes + vectors.nbytes)
+        self.ids = ids
+        self.vectors = vectors
 
-    def get_memory_usage(self):
+    def compact(self, starts:np.ndarray, counts:list):
+        """
+        Move slices filled independently, in ascending order of start, next
+        to each other at the beginning of the set.
+        """
+        position = 0
+        for start, count in zip(starts, counts):
+            if (start != position):
+                self.ids[position:position + count] = self.ids[start:start + count]
+                self.vectors[position:position + count] = self.vectors[start:start + count]
+            position += count
+        self.count = position
+
+    def trim(self):
+        if (len(self.ids) != self.count):
+            self.ids.resize((self.count), refcheck=False)
+            self.vectors.resize((self.count, self.vector_dimensions), refcheck=False)
+
+    def get_memory_usage(self, peak:bool = False):
+        if (peak):
+            return max(self._peak_memory_usage, self.get_memory_usage())
         return self.ids.nbytes + self.vectors.nbytes
     
+class MemoryMappedVectorSet(VectorSet):
+    """
+    VectorSet backed by files in a local staging folder. Ids and vectors are 
+    kept in two raw files (so that they can grow independently) described by 
+    a small JSON header. Clustering results are staged in the same folder so 
+    that a failed build can be resumed without reloading data.
+    """
+    _HEADER_VERSION = 1
+
+    def __init__(self, path:str, vector_dimensions:int, capacity:int = 0):
+        self.path = path
+        self.status = "LOADING"
+        self.properties = {}
+        os.makedirs(path, exist_ok=True)
+        super().__init__(vector_dimensions, capacity)
+
+    def _file(self, name:str) -> str:
+        return os.path.join(self.path, name)
+
+    def _allocate(self, capacity:int):
+        # Results of a previous build must not be resumed over the vectors being loaded
+        self._remove_files(["header.json", "labels.bin", "centroids.npy"])
+        # np.memmap cannot map empty files
+        capacity = max(capacity, 1)
+        self.ids = np.memmap(self._file("ids.bin"), dtype=np.int32, mode="w+", shape=(capacity))
+        self.vectors = np.memmap(self._file("vectors.bin"), dtype=np.float32, mode="w+", shape=(capacity, self.vector_dimensions))
+        self._write_header()
+
+    def _remap(self, capacity:int):
+        self.ids = np.memmap(self._file("ids.bin"), dtype=np.int32, mode="r+", shape=(capacity))
+        self.vectors = np.memmap(self._file("vectors.bin"), dtype=np.float32, mode="r+", shape=(capacity, self.vector_dimensions))
+
+    def _grow(self, required_capacity:int):
+        # Files are extended in place by mapping them with a larger shape, no copy is needed
+        self.ids.flush()
+        self.vectors.flush()
+        self._remap(max(required_capacity, int(len(self.ids) * self._GROWTH_FACTOR)))
+
+    def trim(self):
+        if (len(self.ids) != self.count):
+            capacity = max(self.count, 1)
+            self.ids.flush()
+            self.vectors.flush()
+            self.ids = self.vectors = None
+            os.truncate(self._file("ids.bin"), capacity * 4)
+            os.truncate(self._file("vectors.bin"), capacity * self.vector_dimensions * 4)
+            self._remap(capacity)
+            self.ids = self.ids[:self.count]
+            self.vectors = self.vectors[:self.count]
+        self.status = "LOADED"
+        self._write_header()
+
+    def _write_header(self):
+        self.ids.flush()
+        self.vectors.flush()
+        header = {
+            "version": self._HEADER_VERSION,
+            "status": self.status,
+            "count": self.count,
+            "dimensions": self.vector_dimensions,
+            "properties": self.properties
+        }
+        with open(self._file("header.json"), "w") as f:
+            json.dump(header, f)
+
+    def save_clustering(self, centroids:np.ndarray, labels:np.ndarray):
+        np.save(self._file("centroids.npy"), centroids)
+        labels_map = np.memmap(self._file("labels.bin"), dtype=np.int32, mode="w+", shape=(max(self.count, 1)))
+        labels_map[:self.count] = labels
+        labels_map.flush()
+        self.status = "CLUSTERED"
+        self._write_header()
+
+    def set_property(self, name:str, value):
+        self.properties[name] = value
+        self._write_header()
+
+    def load_clustering(self):
+        centroids = np.load(self._file("centroids.npy"))
+        labels = np.memmap(self._file("labels.bin"), dtype=np.int32, mode="r")[:self.count]
+        return centroids, labels
+
+    def open(path:str, vector_dimensions:int):
+        """
+        Open an existing staging folder. Returns None if there is nothing 
+        usable to resume from.
+        """
+        try:
+            with open(os.path.join(path, "header.json")) as f:
+                header = json.load(f)
+        except FileNotFoundError:
+            return None
+
+        if (header["version"] != MemoryMappedVectorSet._HEADER_VERSION or header["dimensions"] != vector_dimensions):
+            return None
+        if (header["status"] not in ["LOADED", "CLUSTERED"]):
+            return None
+
+        result = MemoryMappedVectorSet.__new__(MemoryMappedVectorSet)
+        result.path = path
+        result.count = int(header["count"])
+        result.status = header["status"]
+        result.properties = header.get("properties", {})
+        result.vector_dimensions = vector_dimensions
+        result._remap(max(result.count, 1))
+        result.ids = result.ids[:result.count]
+        result.vectors = result.vectors[:result.count]
+        result._peak_memory_usage = result.get_memory_usage()
+        return result
+
+    def _remove_files(self, names:list):
+        for name in names:
+            if os.path.exists(self._file(name)):
+                os.remove(self._file(name))
+
+    def remove(self):
+        self.ids = self.vectors = None
+        self._remove_files(["header.json", "ids.bin", "vectors.bin", "labels.bin", "centroids.npy"])
+        os.rmdir(self.path)
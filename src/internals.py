@@ -1,6 +1,19 @@
-from db.index import NoIndex
+import os
+import uuid
+import time
+import queue
+import logging
+import datetime
+import threading
+import multiprocessing
+from enum import Enum, StrEnum
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from db.index import BaseIndex, IndexCancelledException
 from pydantic import BaseModel, Field
 
+_logger = logging.getLogger("uvicorn")
+
 class TableInfo(BaseModel):
     table_schema: str = Field(alias="schema")
     table_name: str = Field(alias="name")
@@ -17,26 +30,346 @@ class IndexRequest(BaseModel):
     column: ColumnInfo
     vector: VectorInfo
 
-class State:
-    def __init__(self) -> None:
-        self.index = NoIndex()
-        self.current_status = "idle"
-        self.last_status = "idle"
+class SearchRequest(BaseModel):
+    vector: list[float]
+    k: int = Field(default=10, gt=0)
+    probes: int = Field(default=None, gt=0)
+    max_distance: float = None
+    rerank: int = Field(default=None, ge=0)
+    include_rows: bool = True
+
+class BatchSearchRequest(BaseModel):
+    vectors: list[list[float]]
+    k: int = Field(default=10, gt=0)
+    probes: int = Field(default=None, gt=0)
+    max_distance: float = None
+    rerank: int = Field(default=None, ge=0)
+    include_rows: bool = True
+
+class JobStatus(StrEnum):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+class Job:
+    def __init__(self, kind:str, index:BaseIndex, method:str, estimated_memory:int) -> None:
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.index = index
+        self.method = method
+        self.estimated_memory = estimated_memory
+        self.status = JobStatus.QUEUED
+        self.result = None
+        self.error = None
+        self.progress = None
+        self.metrics = []
+        self.pid = None
+        self.exit_code = None
+        self.submitted_on = datetime.datetime.now()
+        self.started_on = None
+        self.finished_on = None
+        self.cancel_requested_on = None
+        self._cancel_event = None
+        self._process = None
 
-    def set_status(self, status:str):   
-        self.last_status = self.current_status
-        self.current_status = status
+    def is_active(self) -> bool:
+        return self.status in [JobStatus.QUEUED, JobStatus.RUNNING]
 
-    def get_status(self)->str:
+    def get_status(self) -> dict:
         return {
-            "status": {
-                "current": self.current_status,
-                "last": self.last_status
-            },
-            "index_id": self.index.id
-        }  
-
-    def clear(self):
-        self.last_status = self.current_status
-        self.current_status = "idle"
-        self.index = NoIndex()
\ No newline at end of file
+            "id": self.id,
+            "kind": self.kind,
+            "index_id": self.index.id,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "progress": self.progress,
+            "metrics": self.metrics,
+            "pid": self.pid,
+            "exit_code": self.exit_code,
+            "estimated_memory_mb": int(self.estimated_memory / 1024 / 1024),
+            "submitted_on": self.submitted_on,
+            "started_on": self.started_on,
+            "finished_on": self.finished_on
+        }
+
+def _get_default_memory_budget() -> int:
+    try:
+        return int(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 0.8)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def _run_worker(index_class, config, options, index_id:int, method:str, messages, cancel_event):
+    """
+    Entry point of the worker process: recreate the index from its 
+    configuration, run the requested method and send progress and outcome 
+    back to the API process.
+    """
+    logging.basicConfig(level=logging.INFO, format=f"%(levelname)s:     [worker {os.getpid()}] %(message)s")
+    index = None
+    try:
+        index = index_class.from_config(config, options)
+        index.attach(index_id)
+        index._cancel_event = cancel_event
+        index.set_progress_callback(lambda progress: messages.put(("progress", progress)))
+        result = getattr(index, method)()
+        if isinstance(result, Enum):
+            result = result.name
+        outcome = ("completed", result)
+    except IndexCancelledException:
+        outcome = ("cancelled", None)
+    except BaseException as e:
+        outcome = ("failed", str(e))
+    if (index != None):
+        messages.put(("metrics", index.get_metrics()))
+    messages.put(outcome)
+
+class JobQueue:
+    """
+    Runs index jobs on a bounded pool of workers. Each job runs in its own
+    process, so that clustering doesn't compete with the API for the GIL, 
+    and a crash only takes down the job. Jobs are started in submission 
+    order, as long as the concurrency limit is not reached and their 
+    estimated memory fits in the memory budget. A job is always started if 
+    nothing else is running, even if it doesn't fit the budget.
+    """
+    _MAX_FINISHED_JOBS = 100
+
+    def __init__(self, max_concurrency:int = 2, memory_budget:int = None, cancel_grace_seconds:int = 60) -> None:
+        self.max_concurrency = max_concurrency
+        self.memory_budget = memory_budget
+        self.cancel_grace_seconds = cancel_grace_seconds
+        self._jobs:dict = {}
+        self._reserved:set = set()
+        self._lock = threading.Lock()
+        self._finished_counts:dict = {}
+        self.on_job_finished = None
+        self._last_metrics:dict = {}
+        # Threads only supervise the worker processes
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency)
+        # Forking a process that holds open connections and BLAS thread pools is not safe
+        self._context = multiprocessing.get_context("spawn")
+
+    def from_environment():
+        max_concurrency = int(os.environ.get("KMEANS_MAX_CONCURRENT_JOBS", 2))
+        memory_budget = int(os.environ["KMEANS_MEMORY_BUDGET_MB"]) * 1024 * 1024 if "KMEANS_MEMORY_BUDGET_MB" in os.environ else _get_default_memory_budget()
+        cancel_grace_seconds = int(os.environ.get("KMEANS_CANCEL_GRACE_SECONDS", 60))
+        return JobQueue(max_concurrency, memory_budget, cancel_grace_seconds)
+
+    def get_active_job(self, index_id:int) -> Job:
+        with self._lock:
+            return next((j for j in self._jobs.values() if j.index.id == index_id and j.is_active()), None)
+
+    def _is_busy(self, index_id:int) -> bool:
+        return any(j.index.id == index_id and j.is_active() for j in self._jobs.values())
+
+    @contextmanager
+    def reserve(self, index_id:int):
+        """
+        Reserve the index for a job being prepared, failing if it has an 
+        active job or is already reserved, so that its metadata can be reset
+        before submitting the job without racing with other submissions. 
+        The reservation ends when the job is submitted with reserved=True, 
+        or when leaving the block. Indexes not created yet (index_id None) 
+        are not reserved.
+        """
+        if (index_id != None):
+            with self._lock:
+                if (index_id in self._reserved or self._is_busy(index_id)):
+                    raise Exception(f"An index (#{index_id}) is already being built.")
+                self._reserved.add(index_id)
+        try:
+            yield
+        finally:
+            if (index_id != None):
+                with self._lock:
+                    self._reserved.discard(index_id)
+
+    def submit(self, kind:str, index:BaseIndex, method:str, estimated_memory:int, reserved:bool = False) -> Job:
+        """
+        Queue a job. reserved must be set when the caller holds the 
+        reservation of the index, which passes to the job.
+        """
+        with self._lock:
+            if (self._is_busy(index.id) or (reserved == False and index.id in self._reserved)):
+                raise Exception(f"An index (#{index.id}) is already being built.")
+            self._reserved.discard(index.id)
+            job = Job(kind, index, method, estimated_memory)
+            self._jobs[job.id] = job
+            self._remove_finished_jobs()
+            _logger.info(f"Job {job.id} ({kind} index #{index.id}) queued, estimated memory {int(estimated_memory / 1024 / 1024)} MB.")
+        self._dispatch()
+        return job
+
+    def _remove_finished_jobs(self):
+        finished = [j for j in self._jobs.values() if j.is_active() == False]
+        for j in finished[:max(0, len(finished) - self._MAX_FINISHED_JOBS)]:
+            del self._jobs[j.id]
+
+    def _dispatch(self):
+        with self._lock:
+            running = [j for j in self._jobs.values() if j.status == JobStatus.RUNNING]
+            used_memory = sum(j.estimated_memory for j in running)
+            for job in [j for j in self._jobs.values() if j.status == JobStatus.QUEUED]:
+                if (len(running) >= self.max_concurrency):
+                    break
+                if (self.memory_budget != None and len(running) > 0 and used_memory + job.estimated_memory > self.memory_budget):
+                    # Keep submission order: don't let smaller jobs overtake the first one waiting for memory
+                    break
+                job.status = JobStatus.RUNNING
+                job.started_on = datetime.datetime.now()
+                job._cancel_event = self._context.Event()
+                running.append(job)
+                used_memory += job.estimated_memory
+                self._pool.submit(self._run, job)
+
+    def _handle_message(self, job:Job, message) -> bool:
+        kind, payload = message
+        if (kind == "progress"):
+            payload["updated_on"] = datetime.datetime.now()
+            job.progress = payload
+            return False
+        if (kind == "metrics"):
+            job.metrics = payload
+            return False
+        if (kind == "completed"):
+            job.result = payload
+            job.status = JobStatus.COMPLETED
+        elif (kind == "cancelled"):
+            job.status = JobStatus.CANCELLED
+        else:
+            _logger.error(f"Error during {job.kind} of index #{job.index.id}: {payload}")
+            job.error = payload
+            job.status = JobStatus.FAILED
+        return True
+
+    def _run(self, job:Job):
+        messages = self._context.Queue()
+        process = self._context.Process(
+            target=_run_worker, 
+            args=(type(job.index), job.index.get_config(), job.index.get_options(), job.index.id, job.method, messages, job._cancel_event),
+            # Workers may start their own processes (process assignment executor), which daemonic processes can't do
+            daemon=False
+        )
+        job._process = process
+        try:
+            process.start()
+            job.pid = process.pid
+            _logger.info(f"Job {job.id} ({job.kind} index #{job.index.id}) started in process {process.pid}.")
+
+            done = False
+            while (done == False):
+                try:
+                    done = self._handle_message(job, messages.get(timeout=1))
+                    continue
+                except queue.Empty:
+                    pass
+                if (process.is_alive() == False):
+                    # The worker may have sent its outcome right before exiting
+                    try:
+                        while (done == False):
+                            done = self._handle_message(job, messages.get(timeout=1))
+                    except queue.Empty:
+                        pass
+                    break
+                if (job.cancel_requested_on != None and time.time() - job.cancel_requested_on > self.cancel_grace_seconds):
+                    _logger.warning(f"Job {job.id} didn't stop within {self.cancel_grace_seconds} seconds. Terminating process {process.pid}...")
+                    process.terminate()
+                    process.join()
+
+            process.join()
+            job.exit_code = process.exitcode
+            if (done == False):
+                if (job.cancel_requested_on != None):
+                    job.status = JobStatus.CANCELLED
+                else:
+                    job.error = f"Worker process exited unexpectedly with code {process.exitcode}."
+                    _logger.error(f"Error during {job.kind} of index #{job.index.id}: {job.error}")
+                    job.status = JobStatus.FAILED
+            if (job.status != JobStatus.COMPLETED):
+                job.index.recover(job.method, job.status == JobStatus.CANCELLED)
+        except Exception as e:
+            _logger.error(f"Error during {job.kind} of index #{job.index.id}: {e}")
+            job.error = str(e)
+            job.status = JobStatus.FAILED
+        finally:
+            messages.close()
+            self._finish(job)
+        self._dispatch()
+
+    def _finish(self, job:Job):
+        job.finished_on = datetime.datetime.now()
+        with self._lock:
+            key = (job.kind, str(job.status))
+            self._finished_counts[key] = self._finished_counts.get(key, 0) + 1
+            if (job.metrics):
+                self._last_metrics[job.index.id] = (job.kind, job.metrics)
+        if (self.on_job_finished != None):
+            self.on_job_finished(job)
+        _logger.info(f"Job {job.id} ({job.kind} index #{job.index.id}) {job.status}.")
+
+    def cancel(self, job_id:str) -> Job:
+        cancelled_queued = False
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if (job == None):
+                return None
+            if (job.status == JobStatus.QUEUED):
+                job.status = JobStatus.CANCELLED
+                cancelled_queued = True
+            elif (job.status == JobStatus.RUNNING and job.cancel_requested_on == None):
+                # Running jobs stop at the next phase or batch boundary, or are terminated after the grace period
+                job.cancel_requested_on = time.time()
+                job._cancel_event.set()
+        if (cancelled_queued):
+            # The job never started, so the index goes back to the state it had before being submitted
+            try:
+                job.index.recover(job.method, True, started=False)
+            except Exception as e:
+                _logger.error(f"Error recovering index #{job.index.id} after cancelling job {job.id}: {e}")
+            self._finish(job)
+        return job
+
+    def get(self, job_id:str) -> Job:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list(self) -> list:
+        with self._lock:
+            return list(self._jobs.values())
+
+    def get_status(self) -> dict:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {
+            "queued": len([j for j in jobs if j.status == JobStatus.QUEUED]),
+            "running": [j.get_status() for j in jobs if j.status == JobStatus.RUNNING],
+            "max_concurrency": self.max_concurrency,
+            "memory_budget_mb": int(self.memory_budget / 1024 / 1024) if self.memory_budget != None else None
+        }
+
+    def get_metrics(self) -> dict:
+        """
+        Return the number of finished jobs by kind and status, and the phase 
+        metrics of the last finished job of each index.
+        """
+        with self._lock:
+            return {
+                "finished": dict(self._finished_counts),
+                "last": dict(self._last_metrics)
+            }
+
+    def shutdown(self):
+        for job in self.list():
+            if (job.is_active()):
+                self.cancel(job.id)
+        # Workers are not daemonic, so they have to be stopped explicitly not to outlive the API
+        for job in self.list():
+            process = job._process
+            if (process != None and process.is_alive()):
+                _logger.info(f"Terminating process {process.pid} of job {job.id}...")
+                process.terminate()
+                process.join()
+        self._pool.shutdown(wait=False)
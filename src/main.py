@@ -1,15 +1,22 @@
 import os
 import logging
 import json
+import asyncio
+import numpy as np
 
 from dotenv import load_dotenv
-from fastapi import BackgroundTasks, FastAPI, Response, HTTPException
+from fastapi import FastAPI, Response, HTTPException
+from fastapi.responses import StreamingResponse
 from contextlib import asynccontextmanager
+from apscheduler.schedulers.background import BackgroundScheduler
 
-from db.index import NoIndex
 from db.kmeans import KMeansIndex
-from db.utils import DataSourceConfig
-from internals import IndexRequest, State
+from db.utils import DataSourceConfig, BuildOptions, IndexType, StalenessThresholds
+from db.database import DatabaseEngine, DatabaseEngineException
+from db.search import SearchIndexCache
+from db.pool import get_connection_pool
+from db.instrumentation import render_metrics
+from internals import IndexRequest, SearchRequest, BatchSearchRequest, JobQueue, JobStatus
 
 load_dotenv()
 
@@ -17,29 +24,101 @@ api_version = "0.0.2"
 
 _logger = logging.getLogger("uvicorn")
 
-state = State()
+jobs = JobQueue.from_environment()
+search_cache = SearchIndexCache.from_environment()
+# Rebuilt or updated indexes must be reloaded before being searched again
+jobs.on_job_finished = lambda job: search_cache.invalidate(job.index.id)
+
+def _check_indexes_staleness():
+    thresholds = StalenessThresholds.from_environment()
+    for index_id in DatabaseEngine.list_index_ids():
+        try:
+            if (jobs.get_active_job(index_id) != None):
+                continue
+
+            staleness = KMeansIndex.from_id(index_id).get_staleness()
+            _logger.info(f"Index #{index_id} staleness: {json.dumps(staleness, default=str)}")
+            if (KMeansIndex.is_stale(staleness, thresholds) == False):
+                continue
+
+            _logger.info(f"Index #{index_id} is stale. Queuing rebuild...")
+            with jobs.reserve(index_id):
+                index = KMeansIndex.from_id(index_id, BuildOptions.from_environment())
+                index.initialize_build(force=True)
+                jobs.submit("rebuild", index, "build", index.estimate_memory_usage(), reserved=True)
+        except Exception as e:
+            _logger.error(f"Error checking staleness of index #{index_id}: {e}")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):    
     _logger.info("Starting API...")
+    scheduler = BackgroundScheduler()
+    interval = int(os.environ.get("KMEANS_STALENESS_CHECK_MINUTES", 60))
+    if (interval > 0):
+        _logger.info(f"Checking indexes staleness every {interval} minutes...")
+        scheduler.add_job(_check_indexes_staleness, "interval", minutes=interval, max_instances=1, coalesce=True)
+        scheduler.start()
     yield
     _logger.info("Closing API...")
-    state.clear()
+    if (scheduler.running):
+        scheduler.shutdown(wait=False)
+    jobs.shutdown()
+    get_connection_pool().clear()
 
 api = FastAPI(lifespan=lifespan)
 
+def _job_response(job, status_code:int = 202):
+    j = json.dumps(job.get_status(), default=str)
+    return Response(content=j, status_code=status_code, media_type='application/json')
+
 @api.get("/")
 def welcome():
     return {
-        "server":  state.get_status(),
+        "server":  jobs.get_status(),
+        "pool": get_connection_pool().get_status(),
+        "search_cache": search_cache.get_status(),
         "version": api_version
     }
 
+_PHASE_METRICS = [
+    ("elapsed_seconds", "kmeans_phase_duration_seconds", "Wall time of the phase in the last job of the index."),
+    ("rows", "kmeans_phase_rows", "Rows processed by the phase in the last job of the index."),
+    ("rows_per_second", "kmeans_phase_rows_per_second", "Rows processed per second by the phase in the last job of the index."),
+    ("bytes_fetched", "kmeans_phase_bytes_fetched", "Bytes fetched from the database by the phase in the last job of the index."),
+    ("peak_rss_bytes", "kmeans_phase_peak_rss_bytes", "Peak resident memory of the worker at the end of the phase in the last job of the index."),
+    ("iterations", "kmeans_phase_iterations", "Mini-batch iterations done by the phase in the last job of the index."),
+    ("inertia", "kmeans_phase_inertia", "Sum of squared distances of vectors to their centroid, computed by the phase in the last job of the index.")
+]
+
+@api.get("/metrics")
+def metrics():
+    job_metrics = jobs.get_metrics()
+    active = jobs.list()
+    pool = get_connection_pool().get_status()
+
+    families = [
+        ("kmeans_info", "gauge", "API version.", [({"version": api_version}, 1)]),
+        ("kmeans_jobs", "gauge", "Jobs waiting or running.", [({"status": s}, len([j for j in active if j.status == s])) for s in [JobStatus.QUEUED, JobStatus.RUNNING]]),
+        ("kmeans_jobs_finished_total", "counter", "Jobs finished since the API started.", [({"kind": k, "status": s}, c) for (k, s), c in job_metrics["finished"].items()]),
+        ("kmeans_jobs_max_concurrency", "gauge", "Maximum number of jobs running at the same time.", [({}, jobs.max_concurrency)]),
+        ("kmeans_jobs_memory_budget_bytes", "gauge", "Memory available to running jobs.", [({}, jobs.memory_budget)]),
+        ("kmeans_pool_size", "gauge", "Maximum number of pooled connections.", [({}, pool["size"])]),
+        ("kmeans_pool_idle_connections", "gauge", "Idle pooled connections.", [({}, pool["idle"])]),
+        ("kmeans_pool_hits_total", "counter", "Connections served by an idle pooled connection.", [({}, pool["hits"])]),
+        ("kmeans_pool_misses_total", "counter", "Connections that had to be opened.", [({}, pool["misses"])]),
+        ("kmeans_pool_discarded_total", "counter", "Pooled connections discarded as broken or expired.", [({}, pool["discarded"])]),
+        ("kmeans_pool_token_refreshes_total", "counter", "Access token refreshes.", [({}, pool["token_refreshes"])])
+    ]
+    for key, name, help in _PHASE_METRICS:
+        samples = []
+        for index_id, (kind, phases) in job_metrics["last"].items():
+            samples.extend([({"index_id": index_id, "kind": kind, "phase": p["phase"]}, p[key]) for p in phases])
+        families.append((name, "gauge", help, samples))
+
+    return Response(content=render_metrics(families), status_code=200, media_type='text/plain; version=0.0.4')
+
 @api.post("/kmeans/build")
-def build(tasks: BackgroundTasks, indexRequest: IndexRequest, force: bool = False): 
-    if (isinstance(state.index, NoIndex) == False):        
-        raise HTTPException(detail=f"An index (#{state.index.id}) is already being built.", status_code=500)
-      
+def build(indexRequest: IndexRequest, force: bool = False, tune: bool = False, index_type: IndexType = None): 
     config = DataSourceConfig()
     config.source_table_schema = indexRequest.table.table_schema
     config.source_table_name = indexRequest.table.table_name
@@ -48,50 +127,158 @@ def build(tasks: BackgroundTasks, indexRequest: IndexRequest, force: bool = Fals
     config.vector_dimensions = indexRequest.vector.dimensions
       
     try:
-        state.set_status("initializing")
-        state.index = KMeansIndex.from_config(config)
-        state.index.initialize_build(force)
+        options = BuildOptions.from_environment()
+        options.tune = options.tune or tune
+        options.index_type = index_type or options.index_type
+        index = KMeansIndex.from_config(config, options)
+        # Reserved before initializing, which resets the metadata of an existing index
+        with jobs.reserve(index.get_existing_id()):
+            index.initialize_build(force)
+            job = jobs.submit("build", index, "build", index.estimate_memory_usage(), reserved=True)
     except Exception as e:
         _logger.error(f"Error during initialization: {e}")
-        state.set_status("error during initialization: " + str(e))
-        state.clear()
         raise HTTPException(detail=str(e), status_code=500)
 
-    tasks.add_task(_internal_build) 
+    return _job_response(job)
 
-    r = state.get_status()
-    j = json.dumps(r, default=str)
+@api.post("/kmeans/rebuild/{index_id}")
+def rebuild(index_id: int, resume: bool = False, tune: bool = False, index_type: IndexType = None, warm_start: bool = False): 
+    try:
+        options = BuildOptions.from_environment()
+        options.resume = resume
+        options.tune = options.tune or tune
+        options.warm_start = options.warm_start or warm_start
+        with jobs.reserve(index_id):
+            index = KMeansIndex.from_id(index_id, options, index_type) 
+            index.initialize_build(force=True)
+            job = jobs.submit("rebuild", index, "build", index.estimate_memory_usage(), reserved=True)
+    except Exception as e:
+        _logger.error(f"Error during initialization: {e}")
+        raise HTTPException(detail=str(e), status_code=500)
 
-    return Response(content=j, status_code=202, media_type='application/json')
+    return _job_response(job)
 
-@api.post("/kmeans/rebuild/{index_id}")
-def rebuild(tasks: BackgroundTasks, index_id: int): 
-    if (isinstance(state.index, NoIndex) == False):        
-        raise HTTPException(detail=f"An index (#{state.index.id}) is already being built.", status_code=500)
+@api.get("/kmeans/{index_id}/staleness")
+def staleness(index_id: int):
+    try:
+        staleness = KMeansIndex.from_id(index_id).get_staleness()
+    except Exception as e:
+        raise HTTPException(detail=str(e), status_code=500)
 
+    staleness["stale"] = KMeansIndex.is_stale(staleness, StalenessThresholds.from_environment())
+    j = json.dumps(staleness, default=str)
+
+    return Response(content=j, status_code=200, media_type='application/json')
+
+@api.post("/kmeans/{index_id}/rollback")
+def rollback(index_id: int):
     try:
-        state.index = KMeansIndex.from_id(index_id) 
-        state.set_status("initializing")
-        id = state.index.initialize_build(force=True)
+        # No job can be submitted for the index while switching version
+        with jobs.reserve(index_id):
+            version = KMeansIndex.from_id(index_id).rollback()
+    except Exception as e:
+        _logger.error(f"Error during rollback: {e}")
+        raise HTTPException(detail=str(e), status_code=500)
+    search_cache.invalidate(index_id)
+
+    j = json.dumps({"id": index_id, "version": version})
+    return Response(content=j, status_code=200, media_type='application/json')
+
+@api.post("/kmeans/update/{index_id}")
+def update(index_id: int): 
+    try:
+        index = KMeansIndex.from_id(index_id, BuildOptions.from_environment()) 
+        job = jobs.submit("update", index, "update", 0)
     except Exception as e:
         _logger.error(f"Error during initialization: {e}")
-        state.set_status("error during initialization: " + str(e))
-        state.clear()
         raise HTTPException(detail=str(e), status_code=500)
 
-    tasks.add_task(_internal_build) 
+    return _job_response(job)
+
+@api.post("/kmeans/{index_id}/search")
+def search(index_id: int, searchRequest: SearchRequest):
+    try:
+        index = search_cache.get(index_id)
+    except DatabaseEngineException as e:
+        raise HTTPException(detail=str(e), status_code=404)
+
+    probes = searchRequest.probes or index.recommended_probes or 1
+    try:
+        ids, distances = index.search(np.array(searchRequest.vector), searchRequest.k, probes, searchRequest.max_distance, searchRequest.rerank)[0]
+    except ValueError as e:
+        raise HTTPException(detail=str(e), status_code=400)
 
-    r = state.get_status()
+    rows = index.db.get_source_rows(ids) if searchRequest.include_rows else {}
+    r = {
+        "probes": probes,
+        "results": [{"id": int(i), "distance": float(d), "row": rows.get(int(i))} for i, d in zip(ids, distances)]
+    }
     j = json.dumps(r, default=str)
 
-    return Response(content=j, status_code=202, media_type='application/json')
+    return Response(content=j, status_code=200, media_type='application/json')
 
-def _internal_build():
+@api.post("/kmeans/{index_id}/search/batch")
+def batch_search(index_id: int, batchSearchRequest: BatchSearchRequest):
     try:
-        state.set_status("building")
-        state.index.build()
-    except Exception as e:
-        _logger.error(f"Error building index: {e}")
-        state.set_status("error during index build: " + str(e))
-    finally:
-        state.clear()
\ No newline at end of file
+        index = search_cache.get(index_id)
+    except DatabaseEngineException as e:
+        raise HTTPException(detail=str(e), status_code=404)
+
+    probes = batchSearchRequest.probes or index.recommended_probes or 1
+    try:
+        results = index.search(np.array(batchSearchRequest.vectors), batchSearchRequest.k, probes, batchSearchRequest.max_distance, batchSearchRequest.rerank)
+    except ValueError as e:
+        raise HTTPException(detail=str(e), status_code=400)
+
+    # Rows are read once for the whole batch, even if returned for more than one query
+    rows = index.db.get_source_rows(np.unique(np.concatenate([ids for ids, _ in results]))) if batchSearchRequest.include_rows and results else {}
+    r = {
+        "probes": probes,
+        "results": [[{"id": int(i), "distance": float(d), "row": rows.get(int(i))} for i, d in zip(ids, distances)] for ids, distances in results]
+    }
+    j = json.dumps(r, default=str)
+
+    return Response(content=j, status_code=200, media_type='application/json')
+
+@api.get("/kmeans/jobs")
+def list_jobs():
+    r = [job.get_status() for job in jobs.list()]
+    j = json.dumps(r, default=str)
+
+    return Response(content=j, status_code=200, media_type='application/json')
+
+@api.get("/kmeans/jobs/{job_id}")
+def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if (job == None):
+        raise HTTPException(detail=f"Job {job_id} not found.", status_code=404)
+
+    return _job_response(job, 200)
+
+@api.get("/kmeans/jobs/{job_id}/events")
+async def job_events(job_id: str):
+    job = jobs.get(job_id)
+    if (job == None):
+        raise HTTPException(detail=f"Job {job_id} not found.", status_code=404)
+
+    async def stream():
+        last = None
+        while True:
+            status = json.dumps(job.get_status(), default=str)
+            if (status != last):
+                yield f"data: {status}\n\n"
+                last = status
+            if (job.is_active() == False):
+                break
+            await asyncio.sleep(1)
+
+    return StreamingResponse(stream(), media_type='text/event-stream')
+
+@api.delete("/kmeans/jobs/{job_id}")
+def cancel_job(job_id: str):
+    job = jobs.cancel(job_id)
+    if (job == None):
+        raise HTTPException(detail=f"Job {job_id} not found.", status_code=404)
+
+    return _job_response(job)
+